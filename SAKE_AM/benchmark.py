@@ -0,0 +1,214 @@
+# *****************************************************************************
+# *                                                                           *
+# *                          Benchmarks for SAKE AM                           *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Throughput (operations per second) and latency distribution of the MAC,  *
+# *  the KDF, the key update and complete handshakes (gap 0, 1 and -1, and a  *
+# *  failed verification) for every hash suite and challenge size. Results   *
+# *  are written as JSON and can be compared with a stored baseline, in      *
+# *  which case the script exits with an error on a regression. The memory   *
+# *  taken by each session (tracemalloc) is reported along with them.        *
+# *                                                                           *
+# *****************************************************************************
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from sake_am import *
+
+CHALLENGE_SIZES = (128, 256, 384, 512)
+
+KEY_POOL = 256                          # Distinct keys cycled through, more than the HMAC cache holds
+SAMPLE_TIME = 20e-6                     # Minimum duration of one latency sample
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def measure(operation, duration):
+    # Runs 'operation(i)' for about 'duration' seconds. Operations are timed in
+    # samples of 'batch' calls so that the timer does not dominate fast ones.
+    batch = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(batch):
+            operation(i)
+        if time.perf_counter() - start >= SAMPLE_TIME or batch >= 1 << 16:
+            break
+        batch *= 2
+
+    samples = []
+    operations = 0
+    i = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline or len(samples) < 10:
+        start = time.perf_counter()
+        for _ in range(batch):
+            operation(i)
+            i += 1
+        samples.append((time.perf_counter() - start) / batch)
+        operations += batch
+
+    elapsed = sum(samples) * batch
+    samples.sort()
+    return {
+        "ops_per_sec": operations / elapsed,
+        "mean_us": elapsed / operations * 1e6,
+        "p50_us": percentile(samples, 0.50) * 1e6,
+        "p90_us": percentile(samples, 0.90) * 1e6,
+        "p99_us": percentile(samples, 0.99) * 1e6,
+    }
+
+def handshake_states(MAC_instance, KDF_instance, gap):
+    # Pool of (initiator keys, responder keys, responder past K_prime keys) where
+    # the Initiator is 'gap' epochs behind the Responder (ahead if negative)
+    states = []
+    for _ in range(KEY_POOL):
+        K, K_prime = os.urandom(MAC_instance.LENGTH), os.urandom(MAC_instance.LENGTH)
+        chain = [(K, K_prime)]
+        for _ in range(abs(gap)):
+            K, K_prime = update_key(K, KDF_instance), update_key(K_prime, KDF_instance)
+            chain.append((K, K_prime))
+        if gap >= 0:
+            states.append((chain[0], chain[-1], [pair[1] for pair in chain[:-1]]))
+        else:
+            states.append((chain[-1], chain[0], []))
+    return states
+
+def run_handshake(states, challenge_a, challenge_b, size, MAC_instance, KDF_instance):
+    def operation(i):
+        (iK, iK_prime), (rK, rK_prime), past = states[i % KEY_POOL]
+        initiator = Initiator("Initiator", "Responder", challenge_a, size, iK, iK_prime, MAC_instance, KDF_instance)
+        responder = Responder("Initiator", "Responder", challenge_b, size, rK, rK_prime, MAC_instance, KDF_instance, K_prime_past=past)
+        return SAKE_AM_Procedure(initiator, responder)
+    return operation
+
+def check_handshakes(operation, expected, name):
+    # Every state of the pool must give the expected outcome before it is timed,
+    # otherwise the benchmark would measure another path of the protocol
+    for i in range(KEY_POOL):
+        if operation(i) != expected:
+            raise RuntimeError(f"{name}: handshake {i} of the pool {'aborted' if expected else 'completed'}")
+
+def session_memory(MAC_instance, KDF_instance, size, count=2000):
+    # Bytes allocated per session: new Initiator and Responder, both of them in
+    # flight (after the 2nd message, what a server holds between messages) and
+    # what is left once closed. The HMAC cache is disabled so that it is not
+    # counted, and the keys and challenges given are allocated beforehand.
+    MAC_instance = type(MAC_instance)(cache_size=0) if isinstance(MAC_instance, HMAC) else MAC_instance
+    keys = [(os.urandom(MAC_instance.LENGTH), os.urandom(MAC_instance.LENGTH)) for _ in range(count)]
+    challenges = [(os.urandom(size), os.urandom(size)) for _ in range(count)]
+
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        initiators = [Initiator("Initiator", "Responder", challenges[i][0], size, *keys[i], MAC_instance, KDF_instance) for i in range(count)]
+        after_initiators = tracemalloc.get_traced_memory()[0]
+        responders = [Responder("Initiator", "Responder", challenges[i][1], size, *keys[i], MAC_instance, KDF_instance) for i in range(count)]
+        after_responders = tracemalloc.get_traced_memory()[0]
+
+        for initiator, responder in zip(initiators, responders):
+            initiator.start_session()
+            responder.receive_1st_message(initiator.id_a, initiator.r_a, initiator.tag_a)
+            initiator.receive_2nd_message(responder.sync, responder.r_b, responder.tag_b)
+        in_flight = tracemalloc.get_traced_memory()[0]
+
+        for initiator, responder in zip(initiators, responders):
+            initiator.close()
+            responder.close()
+        closed = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "initiator_bytes": (after_initiators - start) / count,
+        "responder_bytes": (after_responders - after_initiators) / count,
+        "in_flight_pair_bytes": (in_flight - start) / count,
+        "closed_pair_bytes": (closed - start) / count,
+    }
+
+def run_benchmarks(suites=tuple(SUITES), sizes=CHALLENGE_SIZES, duration=0.2):
+    # Returns the timings and the memory per session of every suite and size
+    results = {}
+    memory = {}
+    for suite in suites:
+        MAC_instance, KDF_instance = suite_instances(suite)
+        keys = [os.urandom(MAC_instance.LENGTH) for _ in range(KEY_POOL)]
+
+        results[f"{suite}/derive"] = measure(lambda i: KDF_instance.derive(keys[i % KEY_POOL], b"Session Key"), duration)
+        results[f"{suite}/update_key"] = measure(lambda i: update_key(keys[i % KEY_POOL], KDF_instance), duration)
+
+        for size in sizes:
+            challenge_a, challenge_b = os.urandom(size), os.urandom(size)
+            message = b"0" + b"Responder" + b"Initiator" + challenge_b + challenge_a
+            results[f"{suite}/{size}/mac"] = measure(lambda i: MAC_instance.mac(keys[i % KEY_POOL], message), duration)
+
+            for name, gap in (("handshake_gap0", 0), ("handshake_gap+1", 1), ("handshake_gap-1", -1)):
+                states = handshake_states(MAC_instance, KDF_instance, gap)
+                operation = run_handshake(states, challenge_a, challenge_b, size, MAC_instance, KDF_instance)
+                check_handshakes(operation, True, f"{suite}/{size}/{name}")
+                results[f"{suite}/{size}/{name}"] = measure(operation, duration)
+
+            # Keys unrelated on both sides: the 1st message fails to verify
+            states = [((keys[i], keys[-1 - i]), (keys[-1 - i], keys[i]), []) for i in range(KEY_POOL)]
+            operation = run_handshake(states, challenge_a, challenge_b, size, MAC_instance, KDF_instance)
+            check_handshakes(operation, False, f"{suite}/{size}/failed_verification")
+            results[f"{suite}/{size}/failed_verification"] = measure(operation, duration)
+            memory[f"{suite}/{size}"] = session_memory(MAC_instance, KDF_instance, size)
+    return results, memory
+
+def compare(results, baseline, tolerance, file=sys.stderr):
+    # Returns the names whose median latency grew more than 'tolerance' over the
+    # baseline. The median is used because it is far less sensitive than the mean
+    # to the noise of other processes. The comparison is written to 'file', by
+    # default stderr so that it never mixes with the JSON written to stdout.
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        ratio = result["p50_us"] / reference["p50_us"]
+        print(f"{name:40} {reference['p50_us']:10.2f} -> {result['p50_us']:10.2f} us ({ratio - 1:+.1%})", file=file)
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks of SAKE AM")
+    parser.add_argument("--suites", nargs="+", choices=list(SUITES), default=list(SUITES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(CHALLENGE_SIZES))
+    parser.add_argument("--duration", type=float, default=0.2, help="Seconds per benchmark")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed growth of the median latency before failing")
+    args = parser.parse_args()
+
+    results, memory = run_benchmarks(args.suites, args.sizes, args.duration)
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+        "memory": memory,
+    }
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions: " + ", ".join(regressions), file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,144 @@
+# *****************************************************************************
+# *                                                                           *
+# *                Test Vector Generation for SAKE AM Protocol                *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Deterministic generation of test vectors in the COMPLETED / ABORTED      *
+# *  format read by 'read_test_vector.py'. Every vector is derived from the   *
+# *  seed, the suite and its own index only, so the output is byte-identical  *
+# *  for the same parameters whatever the number of processes used. The       *
+# *  expected result of each vector is obtained by running the protocol.      *
+# *                                                                           *
+# *****************************************************************************
+
+import argparse
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from sake_am import *
+
+# Scenarios (state of the keys given to each entity before the handshake):
+# - in_sync:    both entities hold the same (K, K_prime).
+# - gap_ahead:  the Initiator is one epoch ahead of the Responder (gap -1).
+# - gap_behind: the Initiator is one epoch behind (gap 1). A Responder built from
+#               a test vector has no previous key, so the vector is ABORTED.
+# - mismatch:   each entity holds its own unrelated pair of keys.
+SCENARIOS = ("in_sync", "gap_ahead", "gap_behind", "mismatch")
+DEFAULT_MIX = {"in_sync": 4, "gap_ahead": 2, "gap_behind": 1, "mismatch": 3}
+
+DOMAIN = b"SAKE-AM test vectors"
+
+# Generated files are never named like the reference vectors committed in
+# test_generated/ (test_vectors_*.txt), so they cannot replace them
+DEFAULT_OUTPUT = "generated_vectors"
+FILE_PREFIX = "generated_vectors"
+
+def parse_mix(text):
+    # "in_sync=4,gap_ahead=2" -> {"in_sync": 4, "gap_ahead": 2}
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario {name!r}, expected one of {', '.join(SCENARIOS)}")
+        try:
+            mix[name] = int(weight) if weight else 1
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"The weight of {name} must be an integer, got {weight!r}") from None
+        if mix[name] < 0:
+            raise argparse.ArgumentTypeError(f"The weight of {name} must not be negative, got {mix[name]}")
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("The mix needs a positive weight")
+    return mix
+
+class VectorRandom:
+    # Byte stream of one vector, SHAKE256 over the seed, suite and index
+    def __init__(self, seed, suite, index, length):
+        material = DOMAIN + seed.to_bytes(8, "big") + suite.encode() + index.to_bytes(8, "big")
+        self.stream = hashlib.shake_256(material).digest(length)
+        self.offset = 0
+
+    def take(self, length):
+        chunk = self.stream[self.offset:self.offset + length]
+        self.offset += length
+        return chunk
+
+def choose_scenario(value, mix):
+    value %= sum(mix.values())
+    for name in SCENARIOS:
+        weight = mix.get(name, 0)
+        if value < weight:
+            return name
+        value -= weight
+
+def generate_vector(index, seed, suite, challenge_length, mix, MAC_instance, KDF_instance, id_a="Initiator", id_b="Responder"):
+    key_length = MAC_instance.LENGTH
+    random = VectorRandom(seed, suite, index, 8 + 2 * challenge_length + 4 * key_length)
+    scenario = choose_scenario(int.from_bytes(random.take(8), "big"), mix)
+    r_a = random.take(challenge_length)
+    r_b = random.take(challenge_length)
+    K, K_prime = random.take(key_length), random.take(key_length)
+
+    if scenario == "in_sync":
+        keys = (K, K_prime, K, K_prime)
+    elif scenario == "gap_ahead":
+        keys = (update_key(K, KDF_instance), update_key(K_prime, KDF_instance), K, K_prime)
+    elif scenario == "gap_behind":
+        keys = (K, K_prime, update_key(K, KDF_instance), update_key(K_prime, KDF_instance))
+    else:
+        keys = (K, K_prime, random.take(key_length), random.take(key_length))
+
+    initiator = Initiator(id_a, id_b, r_a, challenge_length, keys[0], keys[1], MAC_instance, KDF_instance)
+    responder = Responder(id_a, id_b, r_b, challenge_length, keys[2], keys[3], MAC_instance, KDF_instance)
+    fields = [id_a, r_a.hex(), id_b, r_b.hex(), str(challenge_length), MAC_instance.identifier, KDF_instance.identifier] + [key.hex() for key in keys]
+
+    if SAKE_AM_Procedure(initiator, responder):
+        return " ".join(["COMPLETED"] + fields + [initiator.session_key.hex(), responder.session_key.hex()])
+    return " ".join(["ABORTED"] + fields + [initiator.ERROR or responder.ERROR])
+
+def generate_shard(path, first, last, seed, suite, challenge_length, mix, force=False):
+    # Writes the vectors with index in [first, last) to 'path'
+    MAC_instance, KDF_instance = suite_instances(suite)
+    with open(path, "w" if force else "x", buffering=1 << 20) as file:
+        for index in range(first, last):
+            file.write(generate_vector(index, seed, suite, challenge_length, mix, MAC_instance, KDF_instance) + "\n")
+    return path
+
+def shard_paths(output_dir, count, suite, seed, shards):
+    if shards == 1:
+        return [os.path.join(output_dir, f"{FILE_PREFIX}_{count}_{suite}_{seed}.txt")]
+    return [os.path.join(output_dir, f"{FILE_PREFIX}_{count}_{suite}_{seed}_{shard:04d}.txt") for shard in range(shards)]
+
+def generate_test_vectors(output_dir, count, seed, suite="sha256", challenge_length=128, mix=DEFAULT_MIX, shards=1, workers=None, force=False):
+    # Existing files are only overwritten with 'force', and none is written otherwise
+    os.makedirs(output_dir, exist_ok=True)
+    paths = shard_paths(output_dir, count, suite, seed, shards)
+    existing = [path for path in paths if os.path.exists(path)]
+    if existing and not force:
+        raise FileExistsError(f"{existing[0]} already exists (use --force to overwrite it)")
+    bounds = [count * shard // shards for shard in range(shards + 1)]
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(generate_shard, path, bounds[shard], bounds[shard + 1], seed, suite, challenge_length, mix, force) for shard, path in enumerate(paths)]
+        return [future.result() for future in futures]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Deterministic generation of SAKE AM test vectors")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--suite", choices=list(SUITES), default="sha256")
+    parser.add_argument("--challenge-size", type=int, default=128)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="Weights of the scenarios, e.g. in_sync=4,gap_ahead=2,gap_behind=1,mismatch=3")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--force", action="store_true", help="Overwrite existing files")
+    args = parser.parse_args()
+
+    try:
+        paths = generate_test_vectors(args.output, args.count, args.seed, args.suite, args.challenge_size, args.mix, args.shards, args.workers, args.force)
+    except FileExistsError as error:
+        print(f"ERROR: {error}")
+        exit(1)
+    for path in paths:
+        print(path)
@@ -20,76 +20,191 @@
 # *****************************************************************************
 
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from sake_am import *
+from sake_batch import run_handshakes
 
-def read_test_vectors(filename):
-    test_vectors = []
+def parse_test_vector(line):
+    # Returns the tuple of the test in 'line', or None for an empty line
+    components = line.split()
+    if not components:
+        return None
+
+    if components[0] == 'COMPLETED':
+        id_a, challenge_value_a, id_b, challenge_value_b, challenge_length, mac_id, kdf_id, initiator_K, initiator_K_prime,responder_K, responder_K_prime, initiator_session_key, responder_session_key = components[1:]
+        initiator_K, responder_K = bytes.fromhex(initiator_K), bytes.fromhex(responder_K)
+        test_type = 0 if initiator_K == responder_K else 3
+        return (test_type,id_a, bytes.fromhex(challenge_value_a), id_b, bytes.fromhex(challenge_value_b), int(challenge_length), mac_id.upper(), kdf_id.upper(), initiator_K, bytes.fromhex(initiator_K_prime), responder_K, bytes.fromhex(responder_K_prime), bytes.fromhex(initiator_session_key), bytes.fromhex(responder_session_key))
+
+    elif components[0] == 'ABORTED':
+        id_a, challenge_value_a, id_b, challenge_value_b, challenge_length, mac_id, kdf_id, initiator_K, initiator_K_prime,responder_K, responder_K_prime = components[1:12]
+        error =' '.join(components[12:])
+        initiator_K, responder_K = bytes.fromhex(initiator_K), bytes.fromhex(responder_K)
+        test_type = 1 if initiator_K != responder_K else 2
+        return (test_type,id_a, bytes.fromhex(challenge_value_a), id_b, bytes.fromhex(challenge_value_b), int(challenge_length), mac_id.upper(), kdf_id.upper(), initiator_K, bytes.fromhex(initiator_K_prime), responder_K, bytes.fromhex(responder_K_prime), error)
+
+    raise ValueError(f"Unknown test type {components[0]}")
+
+def iter_test_vectors(filename):
+    # Yields (line number, test) one line at a time
     with open(filename, 'r') as file:
-        for line in file:
-            components = line.split()
-            if components[0] == 'COMPLETED':
-                id_a, challenge_value_a, id_b, challenge_value_b, challenge_length, mac_id, kdf_id, initiator_K, initiator_K_prime,responder_K, responder_K_prime, initiator_session_key, responder_session_key = components[1:]
-                
-                if bytes.fromhex(initiator_K) == bytes.fromhex(responder_K):
-                    test_vectors.append((0,id_a, bytes.fromhex(challenge_value_a), id_b, bytes.fromhex(challenge_value_b), int(challenge_length), mac_id.upper(), kdf_id.upper(), bytes.fromhex(initiator_K), bytes.fromhex(initiator_K_prime), bytes.fromhex(responder_K), bytes.fromhex(responder_K_prime), bytes.fromhex(initiator_session_key), bytes.fromhex(responder_session_key)))
-                elif bytes.fromhex(initiator_K) != bytes.fromhex(responder_K):
-                    test_vectors.append((3,id_a, bytes.fromhex(challenge_value_a), id_b, bytes.fromhex(challenge_value_b), int(challenge_length), mac_id.upper(), kdf_id.upper(), bytes.fromhex(initiator_K), bytes.fromhex(initiator_K_prime), bytes.fromhex(responder_K), bytes.fromhex(responder_K_prime), bytes.fromhex(initiator_session_key), bytes.fromhex(responder_session_key)))
-            
-            elif components[0] == 'ABORTED':
-                
-                id_a, challenge_value_a, id_b, challenge_value_b, challenge_length, mac_id, kdf_id, initiator_K, initiator_K_prime,responder_K, responder_K_prime = components[1:12]
-                error =' '.join(components[12:])
-
-                if bytes.fromhex(initiator_K) != bytes.fromhex(responder_K):
-                    test_vectors.append((1,id_a, bytes.fromhex(challenge_value_a), id_b, bytes.fromhex(challenge_value_b), int(challenge_length), mac_id.upper(), kdf_id.upper(), bytes.fromhex(initiator_K), bytes.fromhex(initiator_K_prime), bytes.fromhex(responder_K), bytes.fromhex(responder_K_prime), error))
-                if bytes.fromhex(initiator_K) == bytes.fromhex(responder_K):
-                    test_vectors.append((2,id_a, bytes.fromhex(challenge_value_a), id_b, bytes.fromhex(challenge_value_b), int(challenge_length), mac_id.upper(), kdf_id.upper(), bytes.fromhex(initiator_K), bytes.fromhex(initiator_K_prime), bytes.fromhex(responder_K), bytes.fromhex(responder_K_prime), error))
-                
-    return test_vectors
+        for line_number, line in enumerate(file, 1):
+            test = parse_test_vector(line)
+            if test is not None:
+                yield line_number, test
+
+def read_test_vectors(filename):
+    return [test for _, test in iter_test_vectors(filename)]
+
+def verify_test_vector(test, mac_dict, kdf_dict):
+    test_type = test[0]
+    MAC_instance = mac_dict[test[6]]
+    KDF_instance = kdf_dict[test[7]]
+
+    initiator = Initiator(test[1], test[3], test[2], test[5], test[8], test[9], MAC_instance, KDF_instance)
+    responder = Responder(test[1], test[3], test[4], test[5], test[10], test[11], MAC_instance, KDF_instance)
+
+    if test_type == 0 or test_type == 3:
+        return SAKE_AM_Procedure(initiator, responder) == True and initiator.session_key == test[12] and responder.session_key == test[13]
+
+    elif test_type == 1 or test_type == 2:
+        return SAKE_AM_Procedure(initiator, responder) == False and (initiator.ERROR == test[12] or responder.ERROR == test[12])
+
+    return False
+
+def verify_test_vectors(tests, mac_dict, kdf_dict):
+    # Expected to give the result of verify_test_vector for every test, with the
+    # tests of each suite and challenge size run as one batch (see sake_batch.py).
+    # sake_batch has its own copy of the protocol logic, so this is only a cross
+    # check of the batch API: the vectors are verified by verify_test_vector.
+    results = [False] * len(tests)
+    groups = {}
+    for index, test in enumerate(tests):
+        MAC_instance, KDF_instance = mac_dict.get(test[6]), kdf_dict.get(test[7])
+        if MAC_instance is None or KDF_instance is None:
+            continue
+        if len(test[2]) != len(test[4]) or any(len(key) != MAC_instance.LENGTH for key in test[8:12]):
+            results[index] = verify_test_vector(test, mac_dict, kdf_dict)
+            continue
+        groups.setdefault((test[6], test[7], len(test[2])), []).append(index)
+
+    for (mac_id, kdf_id, challenge_size), indexes in groups.items():
+        group = [tests[index] for index in indexes]
+        result = run_handshakes(mac_dict[mac_id], kdf_dict[kdf_id], [test[1] for test in group], [test[3] for test in group], challenge_size,
+                                b"".join(test[2] for test in group), b"".join(test[4] for test in group),
+                                b"".join(test[8] for test in group), b"".join(test[9] for test in group),
+                                b"".join(test[10] for test in group), b"".join(test[11] for test in group))
+        for row, (index, test) in enumerate(zip(indexes, group)):
+            if test[0] == 0 or test[0] == 3:
+                results[index] = result.completed(row) and result.initiator_session_key[row] == test[12] and result.responder_session_key[row] == test[13]
+            elif test[0] == 1 or test[0] == 2:
+                results[index] = not result.completed(row) and result.error(row) == test[12]
+    return results
 
 def analyze_test_vectors (test_vectors, mac_dict, kdf_dict):
     test_success = 0
     test_fail = 0
-    i=0
     for test in test_vectors:
-        test_type = test[0]
-        MAC_instance = mac_dict[test[6]]
-        KDF_instance = kdf_dict[test[7]]
-
-        initiator = Initiator(test[1], test[3], test[2], test[5], test[8], test[9], MAC_instance, KDF_instance)
-        responder = Responder(test[1], test[3], test[4], test[5], test[10], test[11], MAC_instance, KDF_instance)
-
-        if test_type == 0 or test_type == 3:
-            
-            if SAKE_AM_Procedure(initiator, responder) == True:
-                if initiator.session_key == test[12] and responder.session_key == test[13]:
-                    test_success += 1
-                else:
-                    test_fail += 1
-            else:
-                test_fail += 1
-        
-        elif test_type == 1 or test_type == 2:
-
-            if SAKE_AM_Procedure(initiator, responder) == False:
-                if initiator.ERROR == test[12] or responder.ERROR == test[12]:
-                    test_success += 1
-                else:
-                    test_fail += 1
-            else:
-                test_fail += 1
-        i+=1
+        if verify_test_vector(test, mac_dict, kdf_dict):
+            test_success += 1
+        else:
+            test_fail += 1
     
     print(f"Test Success: {test_success} || Test Fail: {test_fail}")
 
-def get_leaf_subclasses(cls):
-    leaf_subclasses = {}
-    for subclass in cls.__subclasses__():
-        if not subclass.__subclasses__():
-            leaf_subclasses[subclass.__name__] = subclass()
-        else:
-            leaf_subclasses.update(get_leaf_subclasses(subclass))
-    return leaf_subclasses
+# *****************************************************************************
+# *                                                                           *
+# *                         Parallel streaming verifier                       *
+# *                                                                           *
+# *  Description:                                                             *
+# *  The file is read in chunks of raw lines that are parsed and verified by  *
+# *  a pool of processes. Only a bounded number of chunks is in flight, so    *
+# *  the memory used does not depend on the size of the file, and the results *
+# *  are gathered in the order of the file.                                   *
+# *                                                                           *
+# *****************************************************************************
+
+worker_mac_dict = None
+worker_kdf_dict = None
+
+def init_worker():
+    global worker_mac_dict, worker_kdf_dict
+    # The registries only build the suites found in the file
+    worker_mac_dict = MAC_REGISTRY
+    worker_kdf_dict = KDF_REGISTRY
+
+def verify_lines(lines, cross_check=False):
+    # Result of every raw line: True or False, or None for an empty line. Every
+    # test runs through SAKE_AM_Procedure; a malformed test only fails its own
+    # line. With 'cross_check' the tests are also run by the batch API and a
+    # test whose batch result differs is failed as well.
+    if worker_mac_dict is None:
+        init_worker()
+    results = [None] * len(lines)
+    tests = []
+    test_indexes = []
+    for index, line in enumerate(lines):
+        try:
+            test = parse_test_vector(line)
+            if test is None:
+                continue
+            results[index] = verify_test_vector(test, worker_mac_dict, worker_kdf_dict)
+        except (ValueError, KeyError):
+            results[index] = False
+            continue
+        tests.append(test)
+        test_indexes.append(index)
+
+    if cross_check:
+        for index, success in zip(test_indexes, verify_test_vectors(tests, worker_mac_dict, worker_kdf_dict)):
+            if success != results[index]:
+                results[index] = False
+    return results
+
+def verify_chunk(first_line_number, lines, cross_check=False):
+    # Returns the number of successful tests and the line numbers of the failed ones
+    results = verify_lines(lines, cross_check)
+    failed_lines = [line_number for line_number, success in enumerate(results, first_line_number) if success is False]
+    return sum(success is True for success in results), failed_lines
+
+def iter_chunks(filename, chunk_size):
+    # Yields (number of the first line, raw lines) without parsing them
+    with open(filename, 'r') as file:
+        chunk = []
+        first_line_number = 1
+        for line_number, line in enumerate(file, 1):
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield first_line_number, chunk
+                chunk = []
+                first_line_number = line_number + 1
+        if chunk:
+            yield first_line_number, chunk
+
+def verify_test_vector_file(filename, workers=None, chunk_size=1000, max_pending=None, cross_check=False):
+    # Returns (number of successful tests, line numbers of the failed ones)
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or 2 * workers
+    test_success = 0
+    failed_lines = []
+
+    def collect(future):
+        nonlocal test_success
+        success, failed = future.result()
+        test_success += success
+        failed_lines.extend(failed)
+
+    with ProcessPoolExecutor(workers, initializer=init_worker) as executor:
+        pending = deque()
+        for first_line_number, lines in iter_chunks(filename, chunk_size):
+            pending.append(executor.submit(verify_chunk, first_line_number, lines, cross_check))
+            if len(pending) >= max_pending:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+
+    return test_success, failed_lines
 
 if __name__ == "__main__":
 
@@ -98,8 +213,8 @@ if __name__ == "__main__":
         print(f"ERROR: File {FILENAME} does not exist")
         exit(1)
 
-    mac_dict = get_leaf_subclasses(MAC)
-    kdf_dict = get_leaf_subclasses(KDF)
-    test_vectors = read_test_vectors(FILENAME)
+    test_success, failed_lines = verify_test_vector_file(FILENAME)
 
-    analyze_test_vectors(test_vectors, mac_dict, kdf_dict)
+    print(f"Test Success: {test_success} || Test Fail: {len(failed_lines)}")
+    if failed_lines:
+        print("Failed lines: " + ", ".join(str(line_number) for line_number in failed_lines))
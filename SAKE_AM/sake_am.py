@@ -21,8 +21,12 @@
 
 import os
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 import hashlib
 import hmac
+import threading
+
+HMAC_CACHE_SIZE = 64                    # Keyed HMAC states kept per MAC instance (0 disables the cache)
 
 # *****************************************************************************
 # *                                                                           *
@@ -43,27 +47,145 @@ class MAC (ABC):
     def mac(self, key, message):
         pass
 
+    def verify(self, key, message, tag):
+        return self.mac(key, message) == tag
+
+    def forget(self, key):
+        # Drop any per-key state kept for 'key' (nothing to drop by default)
+        pass
+
+# The HMAC keyed states (the hash of key^ipad and key^opad) only depend on the
+# key, so they are built once per key and cloned for every message. Entries are
+# indexed by the exact key bytes: an evolved key is always a different entry and
+# can never hit the state of the key it replaces. Retired keys are dropped with
+# forget() and the rest are evicted in LRU order once 'cache_size' is reached.
+
+_TRANS_36 = bytes((x ^ 0x36) for x in range(256))
+_TRANS_5C = bytes((x ^ 0x5C) for x in range(256))
+
+def hmac_key_blocks(key, hash, block_size):
+    # Returns the padded key blocks (key^ipad, key^opad) of HMAC
+    if len(key) > block_size:
+        key = hash(key).digest()
+    key = bytes(key).ljust(block_size, b"\0")
+    return key.translate(_TRANS_36), key.translate(_TRANS_5C)
+
 class HMAC (MAC):
-    def __init__ (self, identifier, length, hash):
+    def __init__ (self, identifier, length, hash, cache_size=HMAC_CACHE_SIZE):
         super().__init__(identifier, length)
         self.hash = hash
+        self.block_size = hash().block_size
+        self.cache_size = cache_size
+        self.keyed_states = OrderedDict()
+        self.lock = threading.Lock()
+
+    def keyed_state(self, key):
+        # Every access to the cache is made under the lock, the lookup and the
+        # reordering included. The keyed states of a missing key are computed
+        # outside of it.
+        keyed_states = self.keyed_states
+        with self.lock:
+            states = keyed_states.get(key)
+            if states is not None:
+                keyed_states.move_to_end(key)
+                return states
+
+        inner_block, outer_block = hmac_key_blocks(key, self.hash, self.block_size)
+        states = (self.hash(inner_block), self.hash(outer_block))
+
+        with self.lock:
+            keyed_states[key] = states
+            while len(keyed_states) > self.cache_size:
+                keyed_states.popitem(last=False)
+        return states
 
     def mac(self, key, message):
-        return hmac.new(key, message, self.hash).digest()
+        if self.cache_size <= 0:
+            return hmac.new(key, message, self.hash).digest()
+
+        # Sessions keep their keys in bytearrays, the cache is indexed by bytes
+        if type(key) is not bytes:
+            key = bytes(key)
+        inner_state, outer_state = self.keyed_state(key)
+        inner = inner_state.copy()
+        inner.update(message)
+        outer = outer_state.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+    def forget(self, key):
+        if type(key) is not bytes:
+            key = bytes(key)
+        with self.lock:
+            self.keyed_states.pop(key, None)
+
+    def clear_cache(self):
+        with self.lock:
+            self.keyed_states.clear()
+
+    def __getstate__(self):
+        # Hash objects and locks cannot be pickled, the cache is rebuilt on demand
+        state = self.__dict__.copy()
+        state["keyed_states"] = OrderedDict()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
 
 class HMAC_SHA256(HMAC):
 
-    def __init__(self):
-        super().__init__("hmac_sha256", 32,hashlib.sha256)
+    def __init__(self, cache_size=HMAC_CACHE_SIZE):
+        super().__init__("hmac_sha256", 32,hashlib.sha256, cache_size)
 
 class HMAC_SHA384(HMAC):
 
-    def __init__(self):
-        super().__init__("hmac_sha384", 48,hashlib.sha384)
+    def __init__(self, cache_size=HMAC_CACHE_SIZE):
+        super().__init__("hmac_sha384", 48,hashlib.sha384, cache_size)
     
 class HMAC_SHA512(HMAC):
+    def __init__(self, cache_size=HMAC_CACHE_SIZE):
+        super().__init__("hmac_sha512", 64, hashlib.sha512, cache_size)
+
+class HMAC_SHA3_256(HMAC):
+    def __init__(self, cache_size=HMAC_CACHE_SIZE):
+        super().__init__("hmac_sha3_256", 32, hashlib.sha3_256, cache_size)
+
+class HMAC_SHA3_384(HMAC):
+    def __init__(self, cache_size=HMAC_CACHE_SIZE):
+        super().__init__("hmac_sha3_384", 48, hashlib.sha3_384, cache_size)
+
+class HMAC_SHA3_512(HMAC):
+    def __init__(self, cache_size=HMAC_CACHE_SIZE):
+        super().__init__("hmac_sha3_512", 64, hashlib.sha3_512, cache_size)
+
+# BLAKE2 has a native keyed mode that is already a PRF, so the MAC is a single
+# pass over the message instead of the two hashes of HMAC. Keys are limited to
+# the digest size (64 bytes for BLAKE2b, 32 for BLAKE2s), the length of the keys
+# of the suite. The personalisation string separates the MAC from the KDF, which
+# are keyed with the same K_prime.
+
+class BLAKE2MAC(MAC):
+
+    PERSON = b"SAKE-MAC"
+
+    def __init__(self, identifier, hash):
+        super().__init__(identifier, hash.MAX_DIGEST_SIZE)
+        self.hash = hash
+
+    def mac(self, key, message):
+        return self.hash(message, key=key, digest_size=self.LENGTH, person=self.PERSON).digest()
+
+class BLAKE2B_MAC(BLAKE2MAC):
+
+    def __init__(self):
+        super().__init__("blake2b_mac", hashlib.blake2b)
+
+class BLAKE2S_MAC(BLAKE2MAC):
+
     def __init__(self):
-        super().__init__("hmac_sha512", 64, hashlib.sha512)
+        super().__init__("blake2s_mac", hashlib.blake2s)
 
 # *****************************************************************************
 # *                                                                           *
@@ -84,35 +206,32 @@ class KDF(ABC):
 
 class HKDF(KDF):
 
+    INFO = b"Session Key"
+
     def __init__(self, identifier, hash_function, digest_size):
         super().__init__(identifier)
         self.hash_function = hash_function
         self.digest_size = digest_size
+        self.block_size = hash_function().block_size
+        self.zero_salt = bytes(digest_size)
+        self.first_block_input = self.INFO + bytes([1])
 
     def derive(self, salt, input_key_material):
-        info = b"Session Key"
-        LENGTH = self.digest_size
-
         if salt is None:
-            salt = bytes([0] * self.digest_size)
-
-        input_key_material = self.hash_function(input_key_material).digest()
-
-        if len(input_key_material) < self.digest_size:
-            raise ValueError("Pseudo-key too short")
-
-        if LENGTH > 255 * self.digest_size:
-            raise ValueError("Requested key length too long")
+            salt = self.zero_salt
 
-        okm = b''
-        output_block = b''
-        counter = 1
+        # The expand step is keyed by 'salt' alone and LENGTH is the digest size,
+        # so the output is exactly the first block HMAC(salt, info || 0x01). The
+        # input key material never reaches that block: it was only hashed for a
+        # length check that the digest size always satisfies.
+        return self.first_block(salt)
 
-        while len(okm) < LENGTH:
-            hmac_input = output_block + info + bytes([counter])
-            output_block = hmac.new(salt, hmac_input, self.hash_function).digest()
-            okm += output_block
-        return okm[:LENGTH]
+    def first_block(self, key):
+        # HMAC(key, info || 0x01) computed directly from the padded key blocks,
+        # which avoids the setup cost of hmac.new() for single-use keys
+        inner_block, outer_block = hmac_key_blocks(key, self.hash_function, self.block_size)
+        inner = self.hash_function(inner_block + self.first_block_input).digest()
+        return self.hash_function(outer_block + inner).digest()
 
 class HKDF_SHA256(HKDF):
     
@@ -129,6 +248,135 @@ class HKDF_SHA512(HKDF):
     def __init__(self):
         super().__init__("hkdf_sha512",hashlib.sha512, hashlib.sha512().digest_size)
 
+class ExtractExpandHKDF(HKDF):
+    # HKDF of RFC 5869 with LENGTH equal to the digest size: the input key
+    # material is extracted into PRK = HMAC(salt, ikm) and the output is the
+    # first block HMAC(PRK, info || 0x01). The suites without test vectors to
+    # stay compatible with use it, so their session keys depend on the challenges.
+
+    def derive(self, salt, input_key_material):
+        if salt is None:
+            salt = self.zero_salt
+        pseudorandom_key = hmac.digest(salt, input_key_material, self.hash_function)
+        return self.first_block(pseudorandom_key)
+
+class HKDF_SHA3_256(ExtractExpandHKDF):
+
+    def __init__(self):
+        super().__init__("hkdf_sha3_256", hashlib.sha3_256, hashlib.sha3_256().digest_size)
+
+class HKDF_SHA3_384(ExtractExpandHKDF):
+
+    def __init__(self):
+        super().__init__("hkdf_sha3_384", hashlib.sha3_384, hashlib.sha3_384().digest_size)
+
+class HKDF_SHA3_512(ExtractExpandHKDF):
+
+    def __init__(self):
+        super().__init__("hkdf_sha3_512", hashlib.sha3_512, hashlib.sha3_512().digest_size)
+
+class BLAKE2KDF(KDF):
+    # Keyed BLAKE2 of the input key material with 'salt' as the key. Unlike the
+    # SHA-2 HKDF suites, which are kept byte-compatible with the existing test
+    # vectors, the output depends on the input key material.
+
+    PERSON = b"SAKE-KDF"
+
+    def __init__(self, identifier, hash):
+        super().__init__(identifier)
+        self.hash = hash
+        self.digest_size = hash.MAX_DIGEST_SIZE
+        self.zero_salt = bytes(self.digest_size)
+
+    def derive(self, salt, input_key_material):
+        if salt is None:
+            salt = self.zero_salt
+        return self.hash(input_key_material, key=salt, digest_size=self.digest_size, person=self.PERSON).digest()
+
+class BLAKE2B_KDF(BLAKE2KDF):
+
+    def __init__(self):
+        super().__init__("blake2b_kdf", hashlib.blake2b)
+
+class BLAKE2S_KDF(BLAKE2KDF):
+
+    def __init__(self):
+        super().__init__("blake2s_kdf", hashlib.blake2s)
+
+# *****************************************************************************
+# *                                                                           *
+# *                                 Suites                                    *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Lazy registry of the MAC and KDF classes by identifier.                  *
+# *                                                                           *
+# *****************************************************************************
+
+class Registry:
+    # Leaf subclasses of 'base' by identifier. The identifier of a class is its
+    # name in lower case (HMAC_SHA256 -> hmac_sha256), so the identifiers found
+    # in a test vector are resolved without building anything: an instance is
+    # only built the first time its identifier is asked for, and then reused.
+    # Subclasses defined later are found as well.
+
+    def __init__(self, base):
+        self.base = base
+        self.instances = {}
+
+    def classes(self):
+        found = {}
+        pending = list(self.base.__subclasses__())
+        while pending:
+            cls = pending.pop()
+            subclasses = cls.__subclasses__()
+            if subclasses:
+                pending.extend(subclasses)
+            else:
+                found[cls.__name__] = cls
+        return found
+
+    def __getitem__(self, identifier):
+        name = identifier.upper()
+        instance = self.instances.get(name)
+        if instance is None:
+            cls = self.classes().get(name)
+            if cls is None:
+                raise KeyError(identifier)
+            instance = self.instances.setdefault(name, cls())
+        return instance
+
+    def get(self, identifier, default=None):
+        try:
+            return self[identifier]
+        except KeyError:
+            return default
+
+    def __contains__(self, identifier):
+        return identifier.upper() in self.instances or identifier.upper() in self.classes()
+
+    def identifiers(self):
+        return sorted(name.lower() for name in self.classes())
+
+MAC_REGISTRY = Registry(MAC)
+KDF_REGISTRY = Registry(KDF)
+
+# Suites selectable by name (MAC identifier, KDF identifier)
+SUITES = {
+    "sha256": ("hmac_sha256", "hkdf_sha256"),
+    "sha384": ("hmac_sha384", "hkdf_sha384"),
+    "sha512": ("hmac_sha512", "hkdf_sha512"),
+    "sha3_256": ("hmac_sha3_256", "hkdf_sha3_256"),
+    "sha3_384": ("hmac_sha3_384", "hkdf_sha3_384"),
+    "sha3_512": ("hmac_sha3_512", "hkdf_sha3_512"),
+    "blake2b": ("blake2b_mac", "blake2b_kdf"),
+    "blake2s": ("blake2s_mac", "blake2s_kdf"),
+}
+
+def suite_instances(suite):
+    # (MAC instance, KDF instance) of a suite of SUITES, shared through the registries
+    mac_identifier, kdf_identifier = SUITES[suite]
+    return MAC_REGISTRY[mac_identifier], KDF_REGISTRY[kdf_identifier]
+
 
 # *****************************************************************************
 # *                                                                           *
@@ -139,17 +387,102 @@ class HKDF_SHA512(HKDF):
 # *                                                                           *
 # *****************************************************************************
 
+class MACInput:
+    # Preallocated buffers with the MAC inputs of one session, the identifiers
+    # are written once and only the challenges and the sync digit are copied in
+    # afterwards:
+    #   first   = id_a || id_b || r_a                   (1st message)
+    #   second  = sync || id_b || id_a || r_b || r_a    (2nd message)
+    #   forward = id_a || id_b || r_a || r_b            (3rd message)
+    # The 4th message (r_b || r_a) is a view of 'second'.
+
+    __slots__ = ("id_a", "id_b", "ids_ab", "ids_ba", "first", "second", "forward", "r_a_length")
+
+    def __init__(self, id_a, id_b):
+        self.id_a = id_a
+        self.id_b = id_b
+        self.ids_ab = id_a + id_b
+        self.ids_ba = id_b + id_a
+        self.first = bytearray(self.ids_ab)
+        self.forward = bytearray(self.ids_ab)
+        self.second = bytearray(b"0" + self.ids_ba)
+        self.r_a_length = 0
+
+    def set_challenges(self, r_a, r_b):
+        ids = len(self.ids_ab)
+        size = ids + len(r_a) + len(r_b)
+        if len(self.forward) != size:
+            self.forward = bytearray(size)
+            self.forward[:ids] = self.ids_ab
+            self.second = bytearray(1 + size)
+            self.second[1:1 + ids] = self.ids_ba
+        self.r_a_length = len(r_a)
+        self.forward[ids:ids + len(r_a)] = r_a
+        self.forward[ids + len(r_a):] = r_b
+        self.second[1 + ids:1 + ids + len(r_b)] = r_b
+        self.second[1 + ids + len(r_b):] = r_a
+
+    def message_1(self, r_a):
+        ids = len(self.ids_ab)
+        if len(self.first) != ids + len(r_a):
+            self.first = bytearray(ids + len(r_a))
+            self.first[:ids] = self.ids_ab
+        self.first[ids:] = r_a
+        return self.first
+
+    def message_2(self, sync):
+        if 0 <= sync <= 9:
+            self.second[0] = 0x30 + sync
+            return self.second
+        # Only windows of 10 epochs or more need a longer prefix
+        return str(sync).encode() + memoryview(self.second)[1:]
+
+    def message_3(self):
+        return self.forward
+
+    def message_4(self):
+        return memoryview(self.second)[1 + len(self.ids_ba):]
+
+    def challenges(self):
+        return memoryview(self.forward)[len(self.ids_ab):]
+
+def wipe(buffer):
+    # Overwrites a key buffer with zeros
+    buffer[:] = bytes(len(buffer))
+
 class Initiator:
-    def __init__(self, id_a, id_b, challenge_value, challenge_length, K, K_prime, MAC_instance, KDF_instance):
+    # 'instrumentation' (see sake_metrics.py) is optional, without it the MAC and
+    # KDF instances are used as given and nothing is recorded. K and K_prime are
+    # copied into bytearrays that evolve() updates in place and close() zeroes;
+    # keys that must outlive the session have to be copied out before.
+
+    __slots__ = ("id_a", "id_b", "mac_input", "r_a", "r_b", "challenge_length", "instrumentation", "MAC_instance", "KDF_instance",
+                 "K", "K_prime", "session_key", "tag_a", "tag_b", "tag_a_prime", "tag_b_prime", "ERROR")
+
+    def __init__(self, id_a, id_b, challenge_value, challenge_length, K, K_prime, MAC_instance, KDF_instance, instrumentation=None):
+        self.mac_input = None
+        self.K = bytearray()
+        self.K_prime = bytearray()
+        self.reset(id_a, id_b, challenge_value, challenge_length, K, K_prime, MAC_instance, KDF_instance, instrumentation)
+
+    def reset(self, id_a, id_b, challenge_value, challenge_length, K, K_prime, MAC_instance, KDF_instance, instrumentation=None):
+        # Prepares a new session, reusing the buffers of the previous one
         self.id_a = id_a
         self.id_b = id_b
+        id_a_bytes, id_b_bytes = str(id_a).encode(), str(id_b).encode()
+        if self.mac_input is None or self.mac_input.id_a != id_a_bytes or self.mac_input.id_b != id_b_bytes:
+            self.mac_input = MACInput(id_a_bytes, id_b_bytes)
         self.r_a = challenge_value
         self.r_b = None
         self.challenge_length = challenge_length
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            MAC_instance = instrumentation.wrap_mac(MAC_instance)
+            KDF_instance = instrumentation.wrap_kdf(KDF_instance)
         self.MAC_instance = MAC_instance
         self.KDF_instance = KDF_instance
-        self.K = K
-        self.K_prime = K_prime
+        self.K[:] = K
+        self.K_prime[:] = K_prime
         self.session_key = None
         self.tag_a = None
         self.tag_b = None
@@ -157,48 +490,155 @@ class Initiator:
         self.tag_b_prime = None
         self.ERROR = None
 
+    def close(self):
+        # Zeroes the keys and releases the tags and the session key
+        self.MAC_instance.forget(self.K_prime)
+        wipe(self.K)
+        wipe(self.K_prime)
+        self.r_a = self.r_b = None
+        self.session_key = None
+        self.tag_a = self.tag_b = self.tag_a_prime = self.tag_b_prime = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def abort(self, error):
+        self.ERROR = error
+        if self.instrumentation is not None:
+            self.instrumentation.event("abort", reason=error)
+
     def evolve (self):
-        self.K = update_key(self.K, self.KDF_instance)
-        self.K_prime = update_key(self.K_prime, self.KDF_instance)
+        if self.instrumentation is not None:
+            self.instrumentation.count("evolve")
+        self.MAC_instance.forget(self.K_prime)
+        self.K[:] = update_key(self.K, self.KDF_instance)
+        self.K_prime[:] = update_key(self.K_prime, self.KDF_instance)
 
     def start_session (self):
-        self.tag_a = self.MAC_instance.mac(self.K_prime, str(self.id_a).encode() + str(self.id_b).encode() + self.r_a)
+        self.tag_a = self.MAC_instance.mac(self.K_prime, self.mac_input.message_1(self.r_a))
 
     def receive_2nd_message(self, sync, r_b, tag_b):
 
         self.r_b = r_b 
-        if not Vrfy(self.K_prime, str(sync).encode() + str(self.id_b).encode() + str(self.id_a).encode() + r_b + self.r_a, tag_b, self.MAC_instance):
-            self.ERROR = "ERROR: Verification of the 2nd message failed"
+        self.mac_input.set_challenges(self.r_a, r_b)
+        if not Vrfy(self.K_prime, self.mac_input.message_2(sync), tag_b, self.MAC_instance):
+            self.abort("ERROR: Verification of the 2nd message failed")
             return
 
-        if sync == 1:
+        # A Responder 'sync' epochs ahead asks to catch up before deriving
+        for _ in range(sync):
             self.evolve()
    
-        self.session_key = self.KDF_instance.derive(self.K, self.r_a + self.r_b)
+        self.session_key = self.KDF_instance.derive(self.K, self.mac_input.challenges())
         self.evolve()
-        self.tag_a_prime = self.MAC_instance.mac(self.K_prime, str(self.id_a).encode() + str(self.id_b).encode() + self.r_a + self.r_b)
+        self.tag_a_prime = self.MAC_instance.mac(self.K_prime, self.mac_input.message_3())
         return self.tag_a_prime
 
     def receive_4th_message(self, tag_b_prime):
-        if not Vrfy(self.K_prime, self.r_b + self.r_a, tag_b_prime, self.MAC_instance):
-            self.ERROR = "ERROR: Verification of the 4th message failed"
+        if not Vrfy(self.K_prime, self.mac_input.message_4(), tag_b_prime, self.MAC_instance):
+            self.abort("ERROR: Verification of the 4th message failed")
             return
         return "Success"
 
+class KeyRing:
+    # Window of K_prime keys of the Responder around the current epoch j. Up to
+    # 'window' past keys are kept (oldest first) and the future keys are only
+    # derived when they are asked for, so a ring of size W does not cost W
+    # updates per epoch. Keys are held in bytearrays so that close() can zero
+    # them; plain lists are used because a deque weighs over 600 bytes.
+
+    __slots__ = ("KDF_instance", "window", "current", "past", "future")
+
+    def __init__(self, key, window, KDF_instance, past=()):
+        if window < 1:
+            raise ValueError("Window must be at least 1")
+        self.KDF_instance = KDF_instance
+        self.window = window
+        self.current = bytearray(key)
+        self.past = [bytearray(old) for old in list(past)[-window:]]
+        self.future = []
+
+    def before(self, distance):
+        if distance > len(self.past):
+            return None
+        return self.past[-distance]
+
+    def after(self, distance):
+        future = self.future
+        while len(future) < distance:
+            future.append(bytearray(update_key(future[-1] if future else self.current, self.KDF_instance)))
+        return future[distance - 1]
+
+    def key(self, gap):
+        # Key the Initiator holds when it is 'gap' epochs behind (gap > 0) or
+        # ahead (gap < 0) of the Responder
+        if gap == 0:
+            return self.current
+        if gap > 0:
+            return self.before(gap)
+        return self.after(-gap)
+
+    def advance(self):
+        # Moves to the next epoch and returns the key leaving the window, if any
+        retired = self.past.pop(0) if len(self.past) == self.window else None
+        self.past.append(self.current)
+        self.current = self.after(1)
+        del self.future[0]
+        return retired
+
+    def keys(self):
+        return [self.current] + self.past + self.future
+
+    def close(self):
+        for key in self.keys():
+            wipe(key)
+        self.past.clear()
+        self.future.clear()
+
 class Responder:
-    def __init__(self, id_a, id_b, challenge_value, challenge_length, K, K_prime, MAC_instance, KDF_instance):
+    # 'window' is the resynchronisation window W: the 1st message is accepted when
+    # the Initiator is up to W epochs behind or ahead. With W = 1 the behaviour is
+    # the one of the protocol (gap 0, 1 and -1). 'K_prime_past' and 'last_gap' carry
+    # the state of a previous handshake with the same peer: the older K_prime keys
+    # (oldest first) and the gap accepted last time, which is tried right after 0.
+    # 'replay_guard' (see sake_replay.py) is optional: a 1st message whose
+    # (id_a, r_a) was already accepted is rejected before any MAC is computed.
+    # 'instrumentation' and the key buffers work as in the Initiator.
+
+    __slots__ = ("id_a", "id_b", "mac_input", "r_a", "r_b", "challenge_length", "instrumentation", "MAC_instance", "KDF_instance", "K", "K_prime",
+                 "window", "replay_guard", "ring", "last_gap", "attempts", "sync", "gap", "session_key", "tag_b", "tag_b_prime", "ERROR")
+
+    def __init__(self, id_a, id_b, challenge_value, challenge_length, K, K_prime, MAC_instance, KDF_instance, window=1, K_prime_past=(), last_gap=None, instrumentation=None, replay_guard=None):
+        self.mac_input = None
+        self.K = bytearray()
+        self.reset(id_a, id_b, challenge_value, challenge_length, K, K_prime, MAC_instance, KDF_instance, window, K_prime_past, last_gap, instrumentation, replay_guard)
+
+    def reset(self, id_a, id_b, challenge_value, challenge_length, K, K_prime, MAC_instance, KDF_instance, window=1, K_prime_past=(), last_gap=None, instrumentation=None, replay_guard=None):
+        # Prepares a new session, reusing the buffers of the previous one
         self.id_a = id_a
         self.id_b = id_b
+        id_a_bytes, id_b_bytes = str(id_a).encode(), str(id_b).encode()
+        if self.mac_input is None or self.mac_input.id_a != id_a_bytes or self.mac_input.id_b != id_b_bytes:
+            self.mac_input = MACInput(id_a_bytes, id_b_bytes)
         self.r_a = None
         self.r_b = challenge_value
         self.challenge_length = challenge_length
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            MAC_instance = instrumentation.wrap_mac(MAC_instance)
+            KDF_instance = instrumentation.wrap_kdf(KDF_instance)
         self.MAC_instance = MAC_instance
         self.KDF_instance = KDF_instance
-        self.K = K
-        self.K_prime = K_prime
-        self.K_j_prime = self.K_prime
-        self.K_j_prime_before = None
-        self.K_j_prime_after = update_key(self.K_j_prime, KDF_instance)
+        self.K[:] = K
+        self.window = window
+        self.replay_guard = replay_guard
+        self.ring = KeyRing(K_prime, window, self.KDF_instance, K_prime_past)
+        self.K_prime = self.ring.current
+        self.last_gap = last_gap
+        self.attempts = 0
         self.sync = 0
         self.gap = None
         self.session_key = None
@@ -206,74 +646,169 @@ class Responder:
         self.tag_b_prime = None
         self.ERROR = None   
 
+    def close(self):
+        # Zeroes the keys and releases the tags and the session key
+        for key in self.ring.keys():
+            self.MAC_instance.forget(key)
+        self.ring.close()
+        wipe(self.K)
+        self.K_prime = None
+        self.r_a = self.r_b = None
+        self.session_key = None
+        self.tag_b = self.tag_b_prime = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def K_j_prime(self):
+        return self.ring.current
+
+    @property
+    def K_j_prime_before(self):
+        return self.ring.before(1)
+
+    @property
+    def K_j_prime_after(self):
+        return self.ring.after(1)
+
+    def abort(self, error):
+        self.ERROR = error
+        if self.instrumentation is not None:
+            self.instrumentation.event("abort", reason=error)
+
     def evolve (self):
-        self.K = update_key(self.K, self.KDF_instance)
-        self.K_j_prime_before = self.K_j_prime
-        self.K_j_prime = self.K_j_prime_after
-        self.K_j_prime_after = update_key(self.K_j_prime_after, self.KDF_instance)
+        if self.instrumentation is not None:
+            self.instrumentation.count("evolve")
+        self.K[:] = update_key(self.K, self.KDF_instance)
+        retired = self.ring.advance()
+        if retired is not None:
+            self.MAC_instance.forget(retired)
+            wipe(retired)
+
+    def candidate_gaps(self):
+        # Order in which the keys of the window are tried: in sync first, then
+        # the gap of the last handshake and then the closest epochs
+        gaps = [0]
+        if self.last_gap and abs(self.last_gap) <= self.window:
+            gaps.append(self.last_gap)
+        for distance in range(1, self.window + 1):
+            for gap in (distance, -distance):
+                if gap != self.last_gap:
+                    gaps.append(gap)
+        return gaps
 
     def receive_1st_message(self, id_a, r_a, tag_a):
 
         self.r_a = r_a
-        
-        if Vrfy(self.K_prime, str(id_a).encode() + str(self.id_b).encode() + r_a, tag_a, self.MAC_instance):
-            self.gap = 0
-            self.K_prime = self.K_j_prime
-            self.session_key = self.KDF_instance.derive(self.K, r_a + self.r_b)
-            self.evolve()
-            self.sync = 0
-        
-        elif Vrfy(self.K_j_prime_before, str(id_a).encode() + str(self.id_b).encode() + r_a, tag_a, self.MAC_instance):
-            self.gap = 1
-            self.K_prime = self.K_j_prime_before
-            self.sync = 1
+        if self.replay_guard is not None and self.replay_guard.seen(id_a, r_a):
+            self.abort("ERROR: Replayed 1st message")
+            return
 
-        elif Vrfy(self.K_j_prime_after, str(id_a).encode() + str(self.id_b).encode() + r_a, tag_a, self.MAC_instance):
-            self.gap = -1
-            self.K_prime = self.K_j_prime_after
-            self.evolve()
-            self.session_key = self.KDF_instance.derive(self.K, r_a + self.r_b)
+        if id_a == self.id_a:
+            message = self.mac_input.message_1(r_a)
+        else:
+            message = str(id_a).encode() + self.mac_input.id_b + r_a
+        self.attempts = 0
+
+        for gap in self.candidate_gaps():
+            key = self.ring.key(gap)
+            if key is None:
+                continue
+            self.attempts += 1
+            if Vrfy(key, message, tag_a, self.MAC_instance):
+                break
+        else:
+            self.abort("ERROR: Verification of the 1st message failed")
+            return
+
+        if self.replay_guard is not None:
+            self.replay_guard.add(id_a, r_a)
+        self.gap = gap
+        self.last_gap = gap
+        self.K_prime = key
+        if self.instrumentation is not None:
+            self.instrumentation.event("sync", gap=gap, sync=gap if gap > 0 else 0, attempts=self.attempts)
+        self.mac_input.set_challenges(r_a, self.r_b)
+
+        if gap == 0:
+            self.session_key = self.KDF_instance.derive(self.K, self.mac_input.challenges())
             self.evolve()
             self.sync = 0
 
+        elif gap > 0:
+            self.sync = gap
+
         else:
-            self.ERROR = "ERROR: Verification of the 1st message failed"
-            return
+            for _ in range(-gap):
+                self.evolve()
+            self.session_key = self.KDF_instance.derive(self.K, self.mac_input.challenges())
+            self.evolve()
+            self.sync = 0
         
-        self.tag_b = self.MAC_instance.mac(self.K_prime, str(self.sync).encode() + str(self.id_b).encode() + str(self.id_a).encode() + self.r_b + self.r_a)
+        self.tag_b = self.MAC_instance.mac(self.K_prime, self.mac_input.message_2(self.sync))
         return self.sync, self.r_b, self.tag_b
     
     def receive_3rd_message(self, tag_a_prime):
         if self.sync == 0:
             self.K_prime = self.K_j_prime
 
-            if not Vrfy(self.K_prime, str(self.id_a).encode() + str(self.id_b).encode() + self.r_a + self.r_b, tag_a_prime, self.MAC_instance):
-                self.ERROR = "ERROR: Verification of the 3rd message failed"
+            if not Vrfy(self.K_prime, self.mac_input.message_3(), tag_a_prime, self.MAC_instance):
+                self.abort("ERROR: Verification of the 3rd message failed")
                 return
         
-        elif self.sync == 1:
+        else:
+            # The Initiator has caught up with the epoch j and evolved once more
             self.K_prime = self.K_j_prime_after
 
-            if not Vrfy(self.K_prime, str(self.id_a).encode() + str(self.id_b).encode() + self.r_a + self.r_b, tag_a_prime):
-                self.ERROR = "ERROR: Verification of the 3rd message failed"
+            if not Vrfy(self.K_prime, self.mac_input.message_3(), tag_a_prime, self.MAC_instance):
+                self.abort("ERROR: Verification of the 3rd message failed")
                 return
             
-            self.session_key = self.KDF_instance.derive(self.K, self.r_a + self.r_b)
+            self.session_key = self.KDF_instance.derive(self.K, self.mac_input.challenges())
             self.evolve()
         
-        self.tag_b_prime = self.MAC_instance.mac(self.K_prime, self.r_b + self.r_a)
+        self.tag_b_prime = self.MAC_instance.mac(self.K_prime, self.mac_input.message_4())
         return self.tag_b_prime
 
+class SessionPool:
+    # Free list of closed sessions of one class (Initiator or Responder). acquire()
+    # takes the same arguments as the constructor and reuses a released session
+    # and its buffers when there is one; release() closes the session and keeps
+    # it for later, up to 'size' sessions.
+
+    def __init__(self, session_class, size=1024):
+        self.session_class = session_class
+        self.size = size
+        self.free = []
+
+    def acquire(self, *args, **kwargs):
+        if self.free:
+            session = self.free.pop()
+            session.reset(*args, **kwargs)
+            return session
+        return self.session_class(*args, **kwargs)
+
+    def release(self, session):
+        session.close()
+        if len(self.free) < self.size:
+            self.free.append(session)
+
 def Vrfy(Key, data, original_tag, MAC_instance):
     if Key == None:
         return False
-    calculated_tag = MAC_instance.mac(Key, data)
-    return calculated_tag == original_tag
+    return MAC_instance.verify(Key, data, original_tag)
 
 def update_key(Key, KDF_instance):
     return KDF_instance.derive(Key, b"Key Update")
 
-def SAKE_AM_Procedure(initiator,responder):
+def SAKE_AM_Procedure(initiator,responder, instrumentation=None):
+
+    if instrumentation is not None:
+        return SAKE_AM_Instrumented_Procedure(initiator, responder, instrumentation)
 
     Completed = True
     initiator.start_session()
@@ -297,6 +832,30 @@ def SAKE_AM_Procedure(initiator,responder):
     return Completed
 
 
+def SAKE_AM_Instrumented_Procedure(initiator, responder, instrumentation):
+    # Same steps as SAKE_AM_Procedure, timing each phase and reporting the
+    # handshake to 'instrumentation' once it completes or aborts
+    instrumentation.begin_handshake()
+    Completed = False
+
+    def phase_1():
+        initiator.start_session()
+        return responder.receive_1st_message(initiator.id_a, initiator.r_a, initiator.tag_a)
+
+    if instrumentation.timed("phase_1", phase_1) is None:
+        pass
+    elif instrumentation.timed("phase_2", initiator.receive_2nd_message, responder.sync, responder.r_b, responder.tag_b) is None:
+        pass
+    elif instrumentation.timed("phase_3", responder.receive_3rd_message, initiator.tag_a_prime) is None:
+        pass
+    elif instrumentation.timed("phase_4", initiator.receive_4th_message, responder.tag_b_prime) is None:
+        pass
+    else:
+        Completed = True
+
+    instrumentation.end_handshake(Completed)
+    return Completed
+
 
 if __name__ == "__main__":
 
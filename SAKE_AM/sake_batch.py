@@ -0,0 +1,218 @@
+# *****************************************************************************
+# *                                                                           *
+# *                       Batch Handshakes for SAKE AM                        *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Runs N handshakes of one suite from packed buffers instead of N          *
+# *  Initiator/Responder objects. The processing is row-batched, not          *
+# *  vectorised: the rows are unpacked into per-row lists and each of the     *
+# *  four phases is a Python loop over them, with one MAC or KDF call per     *
+# *  row, since hashlib has no multi-buffer API. The result of every row is   *
+# *  the one of SAKE_AM_Procedure with a Responder built with the default     *
+# *  window (gap 0, 1 and -1): same session keys, same final keys and same    *
+# *  errors.                                                                  *
+# *                                                                           *
+# *  The gain over the objects (about 2x) comes from not building sessions    *
+# *  and from skipping work: a verification whose key is the one that         *
+# *  produced the tag is known to succeed, so when both entities hold the     *
+# *  same key the MAC is computed once instead of twice, and the key updates  *
+# *  are shared by the whole batch.                                           *
+# *                                                                           *
+# *  Input buffers (row i at offset i * size):                                *
+# *     r_a, r_b                       challenges of 'challenge_size' bytes   *
+# *     iK, iK_prime, rK, rK_prime     keys of MAC_instance.LENGTH bytes      *
+# *                                                                           *
+# *****************************************************************************
+
+import hmac
+from sake_am import *
+
+COMPLETED = 0
+FAILED_1ST_MESSAGE = 1
+FAILED_2ND_MESSAGE = 2
+FAILED_3RD_MESSAGE = 3
+FAILED_4TH_MESSAGE = 4
+
+ERRORS = {
+    FAILED_1ST_MESSAGE: "ERROR: Verification of the 1st message failed",
+    FAILED_2ND_MESSAGE: "ERROR: Verification of the 2nd message failed",
+    FAILED_3RD_MESSAGE: "ERROR: Verification of the 3rd message failed",
+    FAILED_4TH_MESSAGE: "ERROR: Verification of the 4th message failed",
+}
+
+class BatchResult:
+    # 'status' holds one code per row (COMPLETED or the message that failed).
+    # Session keys are None where the entity did not derive one, as in the
+    # Initiator and Responder. The final keys are packed like the input ones and
+    # 'rK_prime_past' is the previous K_prime of each Responder (or None).
+
+    def __init__(self, count):
+        self.count = count
+        self.status = bytearray(count)
+        self.gap = [None] * count
+        self.initiator_session_key = [None] * count
+        self.responder_session_key = [None] * count
+        self.iK = None
+        self.iK_prime = None
+        self.rK = None
+        self.rK_prime = None
+        self.rK_prime_past = None
+
+    def completed(self, row):
+        return self.status[row] == COMPLETED
+
+    def error(self, row):
+        return ERRORS.get(self.status[row])
+
+def batch_mac(MAC_instance):
+    # One-shot MAC function: the keys of a batch are used once each, so the keyed
+    # states cached by HMAC would only be churned
+    if isinstance(MAC_instance, HMAC):
+        hash = MAC_instance.hash
+        return lambda key, message: hmac.digest(key, message, hash)
+    return MAC_instance.mac
+
+def id_pairs(id_a, id_b, count):
+    # (id_a || id_b, id_b || id_a) of every row, 'id_a' and 'id_b' being a single
+    # identifier for the whole batch or one per row
+    ids_a = [id_a] * count if isinstance(id_a, str) else id_a
+    ids_b = [id_b] * count if isinstance(id_b, str) else id_b
+    pairs = {}
+    result = []
+    for pair in zip(ids_a, ids_b):
+        encoded = pairs.get(pair)
+        if encoded is None:
+            a, b = str(pair[0]).encode(), str(pair[1]).encode()
+            encoded = pairs[pair] = (a + b, b + a)
+        result.append(encoded)
+    if len(result) != count:
+        raise ValueError("One identifier per row is needed")
+    return result
+
+def run_handshakes(MAC_instance, KDF_instance, id_a, id_b, challenge_size, r_a, r_b, iK, iK_prime, rK, rK_prime, rK_prime_past=None, last_gap=None):
+    # 'rK_prime_past' and 'last_gap' are optional sequences with the Responder
+    # state of a previous handshake (None where there is none)
+    length = MAC_instance.LENGTH
+    count = len(iK) // length
+    for buffer, size in ((r_a, challenge_size), (r_b, challenge_size), (iK, length), (iK_prime, length), (rK, length), (rK_prime, length)):
+        if len(buffer) != count * size:
+            raise ValueError("Buffers of the batch do not have the same number of rows")
+
+    mac = batch_mac(MAC_instance)
+    derive = KDF_instance.derive
+    updates = {}
+
+    def update(key):
+        updated = updates.get(key)
+        if updated is None:
+            updated = updates[key] = derive(key, b"Key Update")
+        return updated
+
+    r_a, r_b = bytes(r_a), bytes(r_b)
+    iK, iK_prime, rK, rK_prime = bytes(iK), bytes(iK_prime), bytes(rK), bytes(rK_prime)
+    ids = id_pairs(id_a, id_b, count)
+    result = BatchResult(count)
+    status = result.status
+
+    # State of every row between phases
+    ik = [iK[i * length:(i + 1) * length] for i in range(count)]
+    ikp = [iK_prime[i * length:(i + 1) * length] for i in range(count)]
+    rk = [rK[i * length:(i + 1) * length] for i in range(count)]
+    current = [rK_prime[i * length:(i + 1) * length] for i in range(count)]
+    past = list(rK_prime_past) if rK_prime_past is not None else [None] * count
+    challenges = [r_a[i * challenge_size:(i + 1) * challenge_size] + r_b[i * challenge_size:(i + 1) * challenge_size] for i in range(count)]
+    sync = [0] * count
+    responder_key = [None] * count          # K_prime of the Responder MACs
+    derived_with = [None] * count           # K of the first session key derived
+    tags = [None] * count
+
+    # Phase 1: start_session + receive_1st_message
+    for i in range(count):
+        ids_ab = ids[i][0]
+        r_a_i = challenges[i][:challenge_size]
+        message = ids_ab + r_a_i
+        initiator_key = ikp[i]
+        tag_a = mac(initiator_key, message)
+
+        gaps = [0]
+        previous_gap = last_gap[i] if last_gap is not None else None
+        if previous_gap and abs(previous_gap) <= 1:
+            gaps.append(previous_gap)
+        gaps += [gap for gap in (1, -1) if gap != previous_gap]
+
+        for gap in gaps:
+            key = current[i] if gap == 0 else past[i] if gap > 0 else update(current[i])
+            if key is None:
+                continue
+            if key == initiator_key or mac(key, message) == tag_a:
+                break
+        else:
+            status[i] = FAILED_1ST_MESSAGE
+            continue
+
+        result.gap[i] = gap
+        responder_key[i] = key
+        if gap == 0:
+            derived_with[i] = rk[i]
+            result.responder_session_key[i] = derive(rk[i], challenges[i])
+            rk[i], past[i], current[i] = update(rk[i]), current[i], update(current[i])
+        elif gap > 0:
+            sync[i] = gap
+        else:
+            rk[i], past[i], current[i] = update(rk[i]), current[i], update(current[i])
+            derived_with[i] = rk[i]
+            result.responder_session_key[i] = derive(rk[i], challenges[i])
+            rk[i], past[i], current[i] = update(rk[i]), current[i], update(current[i])
+
+        tags[i] = mac(key, str(sync[i]).encode() + ids[i][1] + challenges[i][challenge_size:] + r_a_i)
+
+    # Phase 2: receive_2nd_message
+    for i in range(count):
+        if status[i]:
+            continue
+        message = str(sync[i]).encode() + ids[i][1] + challenges[i][challenge_size:] + challenges[i][:challenge_size]
+        if ikp[i] != responder_key[i] and mac(ikp[i], message) != tags[i]:
+            status[i] = FAILED_2ND_MESSAGE
+            continue
+
+        for _ in range(sync[i]):
+            ik[i], ikp[i] = update(ik[i]), update(ikp[i])
+        if ik[i] == derived_with[i]:
+            result.initiator_session_key[i] = result.responder_session_key[i]
+        else:
+            derived_with[i] = ik[i]
+            result.initiator_session_key[i] = derive(ik[i], challenges[i])
+        ik[i], ikp[i] = update(ik[i]), update(ikp[i])
+        tags[i] = mac(ikp[i], ids[i][0] + challenges[i])
+
+    # Phase 3: receive_3rd_message
+    for i in range(count):
+        if status[i]:
+            continue
+        key = current[i] if sync[i] == 0 else update(current[i])
+        if key != ikp[i] and mac(key, ids[i][0] + challenges[i]) != tags[i]:
+            status[i] = FAILED_3RD_MESSAGE
+            continue
+
+        if sync[i]:
+            if rk[i] == derived_with[i]:
+                result.responder_session_key[i] = result.initiator_session_key[i]
+            else:
+                result.responder_session_key[i] = derive(rk[i], challenges[i])
+            rk[i], past[i], current[i] = update(rk[i]), current[i], update(current[i])
+        responder_key[i] = key
+        tags[i] = mac(key, challenges[i][challenge_size:] + challenges[i][:challenge_size])
+
+    # Phase 4: receive_4th_message
+    for i in range(count):
+        if status[i]:
+            continue
+        if ikp[i] != responder_key[i] and mac(ikp[i], challenges[i][challenge_size:] + challenges[i][:challenge_size]) != tags[i]:
+            status[i] = FAILED_4TH_MESSAGE
+
+    result.iK = bytearray(b"".join(ik))
+    result.iK_prime = bytearray(b"".join(ikp))
+    result.rK = bytearray(b"".join(rk))
+    result.rK_prime = bytearray(b"".join(current))
+    result.rK_prime_past = past
+    return result
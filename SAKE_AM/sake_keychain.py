@@ -0,0 +1,115 @@
+# *****************************************************************************
+# *                                                                           *
+# *                        Key Chain Engine for SAKE AM                       *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Batched evolution of the master key pairs (K, K_prime) of SAKE AM. The   *
+# *  chains are advanced with the same function as 'update_key', so every    *
+# *  key produced here matches the one obtained by calling 'update_key'      *
+# *  epoch after epoch. Sparse checkpoints allow a drifted device to be       *
+# *  re-synchronised without starting again from its provisioning keys.      *
+# *                                                                           *
+# *****************************************************************************
+
+from bisect import bisect_right, insort
+from sake_am import *
+
+def key_step(KDF_instance):
+    # Returns a function equivalent to 'update_key(Key, KDF_instance)'. For the
+    # HKDF suites the update is a single HMAC block, computed without going
+    # through 'derive'.
+    if isinstance(KDF_instance, HKDF) and type(KDF_instance).derive is HKDF.derive:
+        return KDF_instance.first_block
+    return lambda Key: update_key(Key, KDF_instance)
+
+def fast_forward(Key, epochs, KDF_instance):
+    # Applies 'update_key' 'epochs' times to a single key
+    step = key_step(KDF_instance)
+    for _ in range(epochs):
+        Key = step(Key)
+    return Key
+
+def advance_chains(chains, epochs, KDF_instance):
+    # Advances many (K, K_prime) pairs in one call. 'epochs' is either the same
+    # number of epochs for every chain or a sequence with one value per chain.
+    step = key_step(KDF_instance)
+    if isinstance(epochs, int):
+        epochs = [epochs] * len(chains)
+    elif len(epochs) != len(chains):
+        raise ValueError(f"{len(chains)} chains but {len(epochs)} numbers of epochs")
+
+    advanced = []
+    append = advanced.append
+    for (K, K_prime), n in zip(chains, epochs):
+        for _ in range(n):
+            K = step(K)
+            K_prime = step(K_prime)
+        append((K, K_prime))
+    return advanced
+
+class KeyChain:
+    # Key chain of one device. The pair of the epoch 0 is the provisioning pair
+    # and a checkpoint is stored every 'checkpoint_interval' epochs reached, so
+    # any epoch is at most 'checkpoint_interval - 1' updates away from a stored
+    # pair. Stored checkpoints are old key material: call 'forget_before' once
+    # an epoch is confirmed to keep the forward secrecy of the older epochs.
+
+    def __init__(self, K, K_prime, KDF_instance, checkpoint_interval=64, epoch=0):
+        if checkpoint_interval < 1:
+            raise ValueError("Checkpoint interval must be at least 1")
+        self.KDF_instance = KDF_instance
+        self.checkpoint_interval = checkpoint_interval
+        self.step = key_step(KDF_instance)
+        self.checkpoints = {epoch: (K, K_prime)}
+        self.checkpoint_epochs = [epoch]
+
+    def nearest_checkpoint(self, epoch):
+        i = bisect_right(self.checkpoint_epochs, epoch) - 1
+        if i < 0:
+            raise ValueError(f"Epoch {epoch} is older than the first checkpoint")
+        start = self.checkpoint_epochs[i]
+        return start, self.checkpoints[start]
+
+    def add_checkpoint(self, epoch, K, K_prime):
+        if epoch not in self.checkpoints:
+            insort(self.checkpoint_epochs, epoch)
+        self.checkpoints[epoch] = (K, K_prime)
+
+    def keys_at(self, epoch):
+        start, (K, K_prime) = self.nearest_checkpoint(epoch)
+        step = self.step
+        interval = self.checkpoint_interval
+        for current in range(start + 1, epoch + 1):
+            K = step(K)
+            K_prime = step(K_prime)
+            if current % interval == 0:
+                self.add_checkpoint(current, K, K_prime)
+        return K, K_prime
+
+    def iter_keys(self, first_epoch, last_epoch):
+        # Yields (epoch, K, K_prime) for the closed range of epochs
+        K, K_prime = self.keys_at(first_epoch)
+        yield first_epoch, K, K_prime
+        for current in range(first_epoch + 1, last_epoch + 1):
+            K = self.step(K)
+            K_prime = self.step(K_prime)
+            if current % self.checkpoint_interval == 0:
+                self.add_checkpoint(current, K, K_prime)
+            yield current, K, K_prime
+
+    def resync(self, K_prime, expected_epoch, window):
+        # Looks for the epoch whose K_prime is the one held by the device, within
+        # 'window' epochs of 'expected_epoch'. Returns (epoch, K, K_prime) or None.
+        first_epoch = max(self.checkpoint_epochs[0], expected_epoch - window)
+        for epoch, K, candidate in self.iter_keys(first_epoch, expected_epoch + window):
+            if candidate == K_prime:
+                return epoch, K, candidate
+        return None
+
+    def forget_before(self, epoch):
+        # Drops every checkpoint older than 'epoch' except the one needed to reach it
+        start, _ = self.nearest_checkpoint(epoch)
+        i = self.checkpoint_epochs.index(start)
+        for old in self.checkpoint_epochs[:i]:
+            del self.checkpoints[old]
+        del self.checkpoint_epochs[:i]
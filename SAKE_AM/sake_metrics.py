@@ -0,0 +1,174 @@
+# *****************************************************************************
+# *                                                                           *
+# *                       Instrumentation for SAKE AM                         *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Opt-in counters, phase timings and structured events for 'Initiator',    *
+# *  'Responder' and 'SAKE_AM_Procedure'. An entity built without an          *
+# *  'instrumentation' keeps its MAC/KDF instances untouched, so the only     *
+# *  cost left when disabled is a check against None. Events are sent to a    *
+# *  sink: in memory, JSON lines or the Prometheus text format.               *
+# *                                                                           *
+# *  Counters: mac, vrfy, kdf, evolve                                         *
+# *  Phases:   phase_1 (start_session + receive_1st_message),                 *
+# *            phase_2 (receive_2nd_message), phase_3 (receive_3rd_message),  *
+# *            phase_4 (receive_4th_message)                                  *
+# *  Events:   sync {gap, sync, attempts}, abort {reason},                    *
+# *            handshake {completed, counters, phases}                        *
+# *                                                                           *
+# *****************************************************************************
+
+import json
+import time
+
+class CountingMAC:
+    # Forwards to a MAC instance and counts the MACs computed and verified
+    def __init__(self, MAC_instance, instrumentation):
+        self.MAC_instance = MAC_instance
+        self.instrumentation = instrumentation
+        self.identifier = MAC_instance.identifier
+        self.LENGTH = MAC_instance.LENGTH
+
+    def mac(self, key, message):
+        self.instrumentation.count("mac")
+        return self.MAC_instance.mac(key, message)
+
+    def verify(self, key, message, tag):
+        self.instrumentation.count("vrfy")
+        return self.mac(key, message) == tag
+
+    def forget(self, key):
+        self.MAC_instance.forget(key)
+
+class CountingKDF:
+    # Forwards to a KDF instance and counts the derivations
+    def __init__(self, KDF_instance, instrumentation):
+        self.KDF_instance = KDF_instance
+        self.instrumentation = instrumentation
+        self.identifier = KDF_instance.identifier
+
+    def derive(self, salt, input_key_material):
+        self.instrumentation.count("kdf")
+        return self.KDF_instance.derive(salt, input_key_material)
+
+class Instrumentation:
+    # Counters of the handshake in progress and the sink receiving the events.
+    # One instance can be shared by the Initiator and the Responder of a
+    # handshake; the counters are reset by 'begin_handshake'.
+
+    def __init__(self, sink=None):
+        self.sink = sink if sink is not None else MemorySink()
+        self.counters = {}
+        self.phases = {}
+
+    def wrap_mac(self, MAC_instance):
+        return CountingMAC(MAC_instance, self)
+
+    def wrap_kdf(self, KDF_instance):
+        return CountingKDF(KDF_instance, self)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def event(self, name, **fields):
+        fields["event"] = name
+        self.sink.emit(fields)
+
+    def begin_handshake(self):
+        self.counters = {}
+        self.phases = {}
+
+    def timed(self, name, step, *args):
+        # Runs 'step(*args)' recording its duration as the phase 'name'
+        start = time.perf_counter()
+        result = step(*args)
+        self.phases[name] = time.perf_counter() - start
+        return result
+
+    def end_handshake(self, completed):
+        self.event("handshake", completed=completed, counters=dict(self.counters), phases=dict(self.phases))
+
+# *****************************************************************************
+# *                                                                           *
+# *                                   SINKS                                   *
+# *                                                                           *
+# *****************************************************************************
+
+class MemorySink:
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+class JSONLinesSink:
+    # One JSON object per line, to an open text file or to a path
+    def __init__(self, file):
+        if isinstance(file, str):
+            file = open(file, "a")
+        self.file = file
+
+    def emit(self, event):
+        self.file.write(json.dumps(event, sort_keys=True) + "\n")
+
+    def close(self):
+        self.file.close()
+
+class PrometheusSink:
+    # Aggregates the events and renders them in the Prometheus text format
+
+    def __init__(self, prefix="sake"):
+        self.prefix = prefix
+        self.operations = {}
+        self.handshakes = {}
+        self.gaps = {}
+        self.attempts = {}
+        self.aborts = {}
+        self.phase_seconds = {}
+        self.phase_count = {}
+
+    def emit(self, event):
+        name = event["event"]
+        if name == "handshake":
+            outcome = "completed" if event["completed"] else "aborted"
+            self.handshakes[outcome] = self.handshakes.get(outcome, 0) + 1
+            for counter, value in event["counters"].items():
+                self.operations[counter] = self.operations.get(counter, 0) + value
+            for phase, seconds in event["phases"].items():
+                self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+                self.phase_count[phase] = self.phase_count.get(phase, 0) + 1
+        elif name == "sync":
+            gap = str(event["gap"])
+            self.gaps[gap] = self.gaps.get(gap, 0) + 1
+            attempts = str(event["attempts"])
+            self.attempts[attempts] = self.attempts.get(attempts, 0) + 1
+        elif name == "abort":
+            reason = event["reason"]
+            self.aborts[reason] = self.aborts.get(reason, 0) + 1
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {self.prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{escape(label)}"' for key, label in labels)
+                suffix = "{" + label_text + "}" if label_text else ""
+                lines.append(f"{self.prefix}_{name}{suffix} {value}")
+
+        family("operations_total", "counter", "MAC, Vrfy, KDF and evolve operations", [((("operation", key),), value) for key, value in sorted(self.operations.items())])
+        family("handshakes_total", "counter", "Handshakes by outcome", [((("outcome", key),), value) for key, value in sorted(self.handshakes.items())])
+        family("accepted_gap_total", "counter", "Accepted 1st messages by gap", [((("gap", key),), value) for key, value in sorted(self.gaps.items())])
+        family("vrfy_attempts_total", "counter", "Accepted 1st messages by MAC attempts needed", [((("attempts", key),), value) for key, value in sorted(self.attempts.items())])
+        family("aborts_total", "counter", "Aborted handshakes by reason", [((("reason", key),), value) for key, value in sorted(self.aborts.items())])
+
+        lines.append(f"# HELP {self.prefix}_phase_seconds Time spent in each phase of the handshake")
+        lines.append(f"# TYPE {self.prefix}_phase_seconds summary")
+        for phase in sorted(self.phase_count):
+            lines.append(f'{self.prefix}_phase_seconds_sum{{phase="{phase}"}} {self.phase_seconds[phase]}')
+            lines.append(f'{self.prefix}_phase_seconds_count{{phase="{phase}"}} {self.phase_count[phase]}')
+        return "\n".join(lines) + "\n"
+
+def escape(label):
+    return str(label).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
@@ -0,0 +1,145 @@
+# *****************************************************************************
+# *                                                                           *
+# *                       Replay Guard for SAKE AM                            *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Bounded-memory record of the (id_a, r_a) pairs of the 1st messages the   *
+# *  Responder has accepted. A replayed message is rejected before any MAC    *
+# *  is computed. The pairs are kept in a ring of Bloom filters: new pairs    *
+# *  go to the newest filter and the oldest one is cleared when the newest   *
+# *  is full or its period has elapsed, so a pair is remembered for at least  *
+# *  (generations - 1) periods and the memory never grows.                    *
+# *                                                                           *
+# *  A Bloom filter has no false negatives but some false positives: a fresh  *
+# *  1st message is wrongly rejected with probability 'false_positive_rate'   *
+# *  at most, and the Initiator simply retries with a new challenge.          *
+# *                                                                           *
+# *****************************************************************************
+
+import hashlib
+import math
+import os
+import time
+
+class BloomFilter:
+    # The positions of a pair are given by enhanced double hashing (the step h2
+    # grows by i at every position), which avoids the excess false positives of
+    # plain double hashing in small filters. 'bits' is a power of two.
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.mask = bits - 1
+        self.hashes = hashes
+        self.array = bytearray(bits // 8)
+        self.count = 0
+
+    def contains(self, h1, h2):
+        array, mask = self.array, self.mask
+        for i in range(self.hashes):
+            position = h1 & mask
+            if not array[position >> 3] & (1 << (position & 7)):
+                return False            # A fresh pair usually stops at the first bits
+            h1 += h2
+            h2 += i
+        return True
+
+    def add(self, h1, h2):
+        array, mask = self.array, self.mask
+        for i in range(self.hashes):
+            position = h1 & mask
+            array[position >> 3] |= 1 << (position & 7)
+            h1 += h2
+            h2 += i
+        self.count += 1
+
+    def clear(self):
+        self.array[:] = bytes(len(self.array))
+        self.count = 0
+
+    def false_positive_rate(self):
+        return (1.0 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+class ReplayGuard:
+    # 'capacity' pairs per filter with a 'false_positive_rate' for the whole ring
+    # when every filter is full. 'period' (seconds, None for no limit) bounds the
+    # time covered by one filter. 'clock' is only meant to be replaced in tests
+    # and simulations.
+
+    def __init__(self, capacity=100000, false_positive_rate=1e-6, generations=2, period=None, clock=time.monotonic):
+        if capacity < 1 or generations < 2 or not 0 < false_positive_rate < 1:
+            raise ValueError("Invalid replay guard parameters")
+        # The rate of each filter is set so that the ring meets the target
+        rate = 1.0 - (1.0 - false_positive_rate) ** (1.0 / generations)
+        bits = 1 << max(6, math.ceil(math.log2(-capacity * math.log(rate) / math.log(2) ** 2)))
+        hashes = max(1, math.ceil(-math.log2(rate)))
+
+        self.capacity = capacity
+        self.period = period
+        self.clock = clock
+        # Keyed hash, so that a client cannot choose the positions it sets
+        self.hasher = hashlib.blake2b(key=os.urandom(16), digest_size=16)
+        self.filters = [BloomFilter(bits, hashes) for _ in range(generations)]
+        self.newest = 0
+        self.started = clock()
+        self.lookups = 0
+        self.hits = 0
+        self.insertions = 0
+        self.rotations = 0
+
+    def hash_pair(self, id_a, r_a):
+        # (h1, h2) of the double hashing of (id_a, r_a)
+        id_a = str(id_a).encode()
+        hasher = self.hasher.copy()
+        hasher.update(len(id_a).to_bytes(2, "big") + id_a)
+        hasher.update(r_a)
+        digest = int.from_bytes(hasher.digest(), "little")
+        return digest >> 64, digest & 0xFFFFFFFFFFFFFFFF
+
+    def rotate(self):
+        self.newest = (self.newest + 1) % len(self.filters)
+        self.filters[self.newest].clear()
+        self.started = self.clock()
+        self.rotations += 1
+
+    def expire(self):
+        if self.period is not None and self.clock() - self.started >= self.period:
+            self.rotate()
+
+    def seen(self, id_a, r_a):
+        # True if (id_a, r_a) was recorded (or is a false positive)
+        self.expire()
+        self.lookups += 1
+        h1, h2 = self.hash_pair(id_a, r_a)
+        for bloom in self.filters:
+            if bloom.count and bloom.contains(h1, h2):
+                self.hits += 1
+                return True
+        return False
+
+    def add(self, id_a, r_a):
+        self.expire()
+        if self.filters[self.newest].count >= self.capacity:
+            self.rotate()
+        self.filters[self.newest].add(*self.hash_pair(id_a, r_a))
+        self.insertions += 1
+
+    def false_positive_rate(self):
+        # Current probability that a fresh pair is reported as seen
+        fresh = 1.0
+        for bloom in self.filters:
+            fresh *= 1.0 - bloom.false_positive_rate()
+        return 1.0 - fresh
+
+    def memory(self):
+        return sum(len(bloom.array) for bloom in self.filters)
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "insertions": self.insertions,
+            "rotations": self.rotations,
+            "entries": sum(bloom.count for bloom in self.filters),
+            "memory_bytes": self.memory(),
+            "false_positive_rate": self.false_positive_rate(),
+        }
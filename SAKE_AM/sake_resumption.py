@@ -0,0 +1,229 @@
+# *****************************************************************************
+# *                                                                           *
+# *                      Session Resumption for SAKE AM                       *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Abbreviated handshake for peers that reconnect often. After a complete   *
+# *  handshake the Responder issues a ticket: a random identifier and a       *
+# *  secret bound to the session key, kept in a TicketCache bounded in size   *
+# *  and lifetime. A returning Initiator presents the ticket in a single      *
+# *  round trip that derives a fresh session key from the ticket secret and   *
+# *  fresh challenges, without evolving K and K_prime. Every ticket is used   *
+# *  once: a resumption replaces it with the next one.                        *
+# *                                                                           *
+# *  The MAC of the suite is used as the PRF for every derivation. The KDF    *
+# *  cannot be used for it, since the SHA-2 HKDF suites ignore the input key  *
+# *  material and would give the same key for any challenges. Ticket secrets  *
+# *  and session keys are used once, so they are MACed without going through  *
+# *  the keyed states cached by HMAC (see batch_mac in sake_batch.py).        *
+# *                                                                           *
+# *  Messages:                                                                *
+# *     1. id_a, ticket_id, r_a, tag_a                                        *
+# *        tag_a = MAC(secret, "resume 1" || id_a || id_b || ticket_id || r_a)*
+# *     2. r_b, next_ticket_id, tag_b                                         *
+# *        tag_b = MAC(secret, "resume 2" || id_b || id_a || r_b || r_a       *
+# *                            || next_ticket_id)                             *
+# *     session_key = MAC(secret, "resume key" || r_a || r_b)                 *
+# *     next secret = MAC(secret, "resume ticket" || r_a || r_b               *
+# *                               || next_ticket_id)                          *
+# *                                                                           *
+# *****************************************************************************
+
+import hmac
+import os
+import time
+from collections import OrderedDict
+from sake_am import *
+from sake_batch import batch_mac
+
+TICKET_ID_LENGTH = 16
+
+def ticket_secret(MAC_instance, session_key, ticket_id):
+    # Secret of the ticket issued after a complete handshake
+    return batch_mac(MAC_instance)(session_key, b"resume ticket" + ticket_id)
+
+class Ticket:
+    # Ticket as held by the Initiator
+    __slots__ = ("id_b", "ticket_id", "secret")
+
+    def __init__(self, id_b, ticket_id, secret):
+        self.id_b = id_b
+        self.ticket_id = bytes(ticket_id)
+        self.secret = secret
+
+    @classmethod
+    def from_session(cls, initiator, ticket_id):
+        # Ticket of a completed handshake, from the identifier sent by the Responder
+        return cls(initiator.id_b, ticket_id, ticket_secret(initiator.MAC_instance, initiator.session_key, bytes(ticket_id)))
+
+class TicketCache:
+    # Tickets issued by the Responder, at most one per peer. Beyond 'size'
+    # tickets the least recently used one is evicted, and a ticket older than
+    # 'ttl' seconds is refused and dropped. 'clock' is only meant to be replaced
+    # in tests and simulations.
+
+    def __init__(self, size=100000, ttl=3600.0, clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.tickets = OrderedDict()        # ticket_id -> (id_a, secret, expiry)
+        self.peers = {}                     # id_a -> ticket_id
+        self.issued = 0
+        self.resumed = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def store(self, id_a, secret, ticket_id=None):
+        # Stores a ticket for 'id_a' in place of its previous one and returns its identifier
+        self.invalidate(id_a)
+        if ticket_id is None:
+            ticket_id = os.urandom(TICKET_ID_LENGTH)
+        self.tickets[ticket_id] = (id_a, secret, self.clock() + self.ttl)
+        self.peers[id_a] = ticket_id
+        self.issued += 1
+        while len(self.tickets) > self.size:
+            old_id, (old_peer, _, _) = self.tickets.popitem(last=False)
+            del self.peers[old_peer]
+            self.evicted += 1
+        return ticket_id
+
+    def issue(self, id_a, MAC_instance, session_key):
+        # Ticket for the session key of a completed handshake
+        ticket_id = os.urandom(TICKET_ID_LENGTH)
+        return self.store(id_a, ticket_secret(MAC_instance, session_key, ticket_id), ticket_id)
+
+    def lookup(self, ticket_id, id_a):
+        # Secret of a valid ticket of 'id_a', or None. The ticket stays in the
+        # cache until consume(), so that a forged message cannot discard it.
+        entry = self.tickets.get(bytes(ticket_id))
+        if entry is None or entry[0] != id_a:
+            self.misses += 1
+            return None
+        if self.clock() >= entry[2]:
+            self.expired += 1
+            self.invalidate(id_a)
+            return None
+        self.tickets.move_to_end(bytes(ticket_id))
+        return entry[1]
+
+    def consume(self, ticket_id):
+        entry = self.tickets.pop(bytes(ticket_id), None)
+        if entry is not None:
+            del self.peers[entry[0]]
+            self.resumed += 1
+
+    def invalidate(self, id_a):
+        ticket_id = self.peers.pop(id_a, None)
+        if ticket_id is not None:
+            del self.tickets[ticket_id]
+
+    def stats(self):
+        return {
+            "tickets": len(self.tickets),
+            "issued": self.issued,
+            "resumed": self.resumed,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+# *****************************************************************************
+# *                                                                           *
+# *                             RESUMPTION PROTOCOL                           *
+# *                                                                           *
+# *****************************************************************************
+
+class ResumptionInitiator:
+    # On success 'session_key' is the new key and 'ticket' the ticket to present
+    # next time. The ticket used is spent whatever the outcome.
+
+    __slots__ = ("id_a", "id_b", "ids_ab", "ids_ba", "ticket", "r_a", "MAC_instance", "mac", "session_key", "tag_a", "ERROR")
+
+    def __init__(self, id_a, ticket, challenge_value, MAC_instance):
+        self.id_a = id_a
+        self.id_b = ticket.id_b
+        id_a_bytes, id_b_bytes = str(id_a).encode(), str(ticket.id_b).encode()
+        self.ids_ab = id_a_bytes + id_b_bytes
+        self.ids_ba = id_b_bytes + id_a_bytes
+        self.ticket = ticket
+        self.r_a = challenge_value
+        self.MAC_instance = MAC_instance
+        self.mac = batch_mac(MAC_instance)
+        self.session_key = None
+        self.tag_a = None
+        self.ERROR = None
+
+    def start_session(self):
+        ticket = self.ticket
+        self.tag_a = self.mac(ticket.secret, b"resume 1" + self.ids_ab + ticket.ticket_id + self.r_a)
+        return self.id_a, ticket.ticket_id, self.r_a, self.tag_a
+
+    def receive_2nd_message(self, r_b, next_ticket_id, tag_b):
+        secret = self.ticket.secret
+        challenges = bytes(self.r_a) + bytes(r_b)
+        next_ticket_id = bytes(next_ticket_id)
+        if not hmac.compare_digest(self.mac(secret, b"resume 2" + self.ids_ba + bytes(r_b) + bytes(self.r_a) + next_ticket_id), bytes(tag_b)):
+            self.ERROR = "ERROR: Verification of the resumption message failed"
+            self.ticket = None
+            return
+
+        self.session_key = self.mac(secret, b"resume key" + challenges)
+        self.ticket = Ticket(self.id_b, next_ticket_id, self.mac(secret, b"resume ticket" + challenges + next_ticket_id))
+        return "Success"
+
+    def close(self):
+        self.session_key = None
+        self.tag_a = None
+
+class ResumptionResponder:
+
+    __slots__ = ("id_b", "r_b", "MAC_instance", "mac", "tickets", "session_key", "tag_b", "ERROR")
+
+    def __init__(self, id_b, challenge_value, MAC_instance, tickets):
+        self.id_b = id_b
+        self.r_b = challenge_value
+        self.MAC_instance = MAC_instance
+        self.mac = batch_mac(MAC_instance)
+        self.tickets = tickets
+        self.session_key = None
+        self.tag_b = None
+        self.ERROR = None
+
+    def receive_1st_message(self, id_a, ticket_id, r_a, tag_a):
+        ticket_id = bytes(ticket_id)
+        secret = self.tickets.lookup(ticket_id, id_a)
+        if secret is None:
+            self.ERROR = "ERROR: Unknown or expired ticket"
+            return
+
+        id_a_bytes, id_b_bytes = str(id_a).encode(), str(self.id_b).encode()
+        if not hmac.compare_digest(self.mac(secret, b"resume 1" + id_a_bytes + id_b_bytes + ticket_id + bytes(r_a)), bytes(tag_a)):
+            self.ERROR = "ERROR: Verification of the resumption message failed"
+            return
+
+        # The ticket is spent before anything is sent back
+        self.tickets.consume(ticket_id)
+        challenges = bytes(r_a) + bytes(self.r_b)
+        next_ticket_id = os.urandom(TICKET_ID_LENGTH)
+        self.tickets.store(id_a, self.mac(secret, b"resume ticket" + challenges + next_ticket_id), next_ticket_id)
+        self.session_key = self.mac(secret, b"resume key" + challenges)
+        self.tag_b = self.mac(secret, b"resume 2" + id_b_bytes + id_a_bytes + bytes(self.r_b) + bytes(r_a) + next_ticket_id)
+        return self.r_b, next_ticket_id, self.tag_b
+
+    def close(self):
+        self.session_key = None
+        self.tag_b = None
+
+def Resumption_Procedure(initiator, responder):
+
+    message_1 = initiator.start_session()
+    message_2 = responder.receive_1st_message(*message_1)
+    if message_2 is None:
+        initiator.ticket = None
+        return False
+
+    return initiator.receive_2nd_message(*message_2) is not None
@@ -0,0 +1,331 @@
+# *****************************************************************************
+# *                                                                           *
+# *                          Sans-IO API for SAKE AM                          *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Connection objects that drive the Initiator and the Responder from raw   *
+# *  bytes, without doing any I/O: received bytes go in with receive_data(),  *
+# *  which returns the events of the handshake, and the bytes to send come    *
+# *  out of data_to_send(). They can be plugged into any transport (blocking  *
+# *  sockets, asyncio, an embedded radio stack). Messages use the format of   *
+# *  sake_wire.py.                                                            *
+# *                                                                           *
+# *  KeyPrefetcher moves the key updates of evolve() off the handshake: used  *
+# *  as the KDF instance of the sessions, the keys of the next epoch are      *
+# *  derived once a handshake completes, on an idle hook or a worker pool,    *
+# *  and evolve() finds them ready.                                           *
+# *                                                                           *
+# *  Events: HandshakeCompleted(id_a, session_key, gap)                       *
+# *          HandshakeFailed(error)                                           *
+# *                                                                           *
+# *****************************************************************************
+
+import hashlib
+from collections import deque
+from concurrent.futures import Future
+from sake_am import *
+from sake_wire import *
+
+KEY_UPDATE = b"Key Update"
+
+class HandshakeCompleted:
+    __slots__ = ("id_a", "session_key", "gap")
+
+    def __init__(self, id_a, session_key, gap):
+        self.id_a = id_a
+        self.session_key = session_key
+        self.gap = gap
+
+class HandshakeFailed:
+    __slots__ = ("error",)
+
+    def __init__(self, error):
+        self.error = error
+
+# *****************************************************************************
+# *                                                                           *
+# *                          PRE-DERIVATION OF KEYS                           *
+# *                                                                           *
+# *****************************************************************************
+
+class KeyPrefetcher:
+    # Stands for a KDF instance. prefetch() schedules update_key() of some keys:
+    # on 'executor' if there is one, otherwise they wait for idle(), to be called
+    # when the application has nothing else to do. A key update found ready is
+    # returned (and forgotten) instead of derived; any other derivation goes to
+    # the KDF.
+    #
+    # The keys prepared are the secret keys of the next epoch, so they are kept
+    # as few and as briefly as possible: at most 'size' of them (the oldest are
+    # dropped), only the last ones prefetched for each peer (discard() drops
+    # them once a new state of the peer is committed), and in bytearrays zeroed
+    # when they are used or dropped. Entries are found by a digest of the key
+    # they update, not by the key itself.
+
+    def __init__(self, KDF_instance, executor=None, size=64):
+        self.KDF_instance = KDF_instance
+        self.identifier = KDF_instance.identifier
+        self.executor = executor
+        self.size = size
+        self.ready = {}                 # digest -> [peer, key while queued, updated key, Future or None]
+        self.peers = {}                 # peer -> digests of its entries
+        self.queue = deque()
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self, *keys, peer=None):
+        if peer is not None:
+            self.discard(peer)
+        for key in keys:
+            digest = key_digest(key)
+            if digest in self.ready:
+                continue
+            if self.executor is not None:
+                self.ready[digest] = [peer, None, self.executor.submit(next_key, bytes(key), self.KDF_instance)]
+            else:
+                self.ready[digest] = [peer, bytearray(key), None]
+                self.queue.append(digest)
+            if peer is not None:
+                self.peers.setdefault(peer, []).append(digest)
+        while len(self.ready) > self.size:
+            self.drop(next(iter(self.ready)))
+
+    def idle(self, budget=None):
+        # Derives up to 'budget' queued keys (all of them by default) and returns
+        # the number derived
+        derived = 0
+        queue, ready = self.queue, self.ready
+        while queue and (budget is None or derived < budget):
+            entry = ready.get(queue.popleft())
+            if entry is not None and entry[1] is not None:
+                entry[2] = next_key(entry[1], self.KDF_instance)
+                wipe(entry[1])
+                entry[1] = None
+                derived += 1
+        return derived
+
+    def pending(self):
+        return len(self.queue)
+
+    def take(self, digest):
+        # Removes the entry of 'digest' and returns its updated key or Future
+        entry = self.ready.pop(digest, None)
+        if entry is None:
+            return None
+        peer, key, updated = entry
+        if peer is not None:
+            digests = self.peers[peer]
+            digests.remove(digest)
+            if not digests:
+                del self.peers[peer]
+        if key is not None:
+            wipe(key)
+        return updated
+
+    def drop(self, digest):
+        wipe_update(self.take(digest))
+
+    def discard(self, peer):
+        # Drops the keys prefetched for 'peer', e.g. once its new state is committed
+        for digest in list(self.peers.get(peer, ())):
+            self.drop(digest)
+
+    def derive(self, salt, input_key_material):
+        if input_key_material == KEY_UPDATE:
+            updated = self.take(key_digest(salt))
+            if isinstance(updated, Future):
+                # A derivation still running is not waited for
+                if updated.done():
+                    updated = updated.result()
+                else:
+                    wipe_update(updated)
+                    updated = None
+            if updated is not None:
+                self.hits += 1
+                key = bytes(updated)
+                wipe(updated)
+                return key
+            self.misses += 1
+        return self.KDF_instance.derive(salt, input_key_material)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "keys": len(self.ready), "queued": len(self.queue)}
+
+def key_digest(key):
+    return hashlib.blake2b(key, digest_size=16).digest()
+
+def next_key(key, KDF_instance):
+    return bytearray(update_key(bytes(key), KDF_instance))
+
+def wipe_update(updated):
+    # Zeroes an updated key, or the one a Future will produce once it finishes
+    if isinstance(updated, Future):
+        if not updated.cancel():
+            updated.add_done_callback(lambda future: future.exception() is None and wipe(future.result()))
+    elif updated is not None:
+        wipe(updated)
+
+def find_prefetcher(KDF_instance):
+    # KeyPrefetcher of a KDF instance, also behind the wrappers that forward to
+    # a 'KDF_instance' (CountingKDF of sake_metrics.py), or None
+    while not isinstance(KDF_instance, KeyPrefetcher):
+        KDF_instance = getattr(KDF_instance, "KDF_instance", None)
+        if KDF_instance is None:
+            return None
+    return KDF_instance
+
+def prefetch_next_epoch(session, K, K_prime, peer):
+    # Schedules the next update of K and K_prime if 'session' uses a KeyPrefetcher
+    prefetcher = find_prefetcher(session.KDF_instance)
+    if prefetcher is not None:
+        prefetcher.prefetch(K, K_prime, peer=peer)
+
+def discard_prefetched(session, peer):
+    # Drops the keys prefetched for 'peer' if 'session' uses a KeyPrefetcher
+    prefetcher = find_prefetcher(session.KDF_instance)
+    if prefetcher is not None:
+        prefetcher.discard(peer)
+
+# *****************************************************************************
+# *                                                                           *
+# *                                CONNECTIONS                                *
+# *                                                                           *
+# *****************************************************************************
+
+class Connection:
+    # Bytes received and to send of one handshake. 'closed' is set once the
+    # handshake has completed or failed; later data is ignored.
+
+    def __init__(self):
+        self.decoder = FrameDecoder()
+        self.outgoing = bytearray()
+        self.closed = False
+
+    def send(self, message_type, *fields):
+        self.outgoing += encode_message(message_type, *fields)
+
+    def data_to_send(self):
+        data = bytes(self.outgoing)
+        self.outgoing.clear()
+        return data
+
+    def receive_data(self, data):
+        # Returns the events caused by 'data'. A malformed or unexpected message
+        # raises WireError.
+        events = []
+        for message_type, fields in self.decoder.feed(data):
+            if self.closed:
+                break
+            events.extend(self.handle(message_type, fields))
+        return events
+
+    def fail(self, error, notify=False):
+        # 'notify' sends the error to the other entity
+        if notify:
+            self.send(MESSAGE_ABORT, error.encode())
+        self.closed = True
+        return [HandshakeFailed(error)]
+
+class InitiatorConnection(Connection):
+    # Handshake of an Initiator built by the caller, started with start(). Its
+    # keys are left in the Initiator, to be copied out before close().
+
+    def __init__(self, initiator):
+        super().__init__()
+        self.initiator = initiator
+        self.expected = None
+
+    def start(self):
+        initiator = self.initiator
+        initiator.start_session()
+        self.send(MESSAGE_1, initiator.mac_input.id_a, initiator.r_a, initiator.tag_a)
+        self.expected = MESSAGE_2
+
+    def handle(self, message_type, fields):
+        initiator = self.initiator
+        if message_type == MESSAGE_ABORT:
+            initiator.ERROR = str(fields[0], "utf-8")
+            return self.fail(initiator.ERROR)
+        if message_type != self.expected:
+            raise WireError("Unexpected message")
+
+        if message_type == MESSAGE_2:
+            tag_a_prime = initiator.receive_2nd_message(*fields)
+            if tag_a_prime is None:
+                return self.fail(initiator.ERROR)
+            self.send(MESSAGE_3, tag_a_prime)
+            self.expected = MESSAGE_4
+            return []
+
+        if initiator.receive_4th_message(fields[0]) is None:
+            return self.fail(initiator.ERROR)
+        self.closed = True
+        prefetch_next_epoch(initiator, initiator.K, initiator.K_prime, initiator.id_b)
+        return [HandshakeCompleted(initiator.id_a, initiator.session_key, None)]
+
+class ResponderConnection(Connection):
+    # Handshake of the Responder with whichever peer sends the 1st message.
+    # 'load(id_a)' returns the Responder of the peer built from its stored key
+    # state (None or KeyError for an unknown peer) and 'commit(responder)'
+    # stores its evolved keys, like KeyStore.load_responder/commit_responder.
+    # Handshakes of the same peer must not overlap, as in ResponderServer: 'load'
+    # can lock the state of the peer, and 'release(id_a)' is then called once
+    # the handshake ends, or on close() if the connection is dropped before.
+
+    def __init__(self, load, commit, release=None):
+        super().__init__()
+        self.load = load
+        self.commit = commit
+        self.release = release
+        self.responder = None
+        self.expected = MESSAGE_1
+
+    def handle(self, message_type, fields):
+        if message_type != self.expected:
+            raise WireError("Unexpected message")
+
+        if message_type == MESSAGE_1:
+            id_a = str(fields[0], "utf-8")
+            try:
+                responder = self.load(id_a)
+            except KeyError:
+                responder = None
+            if responder is None:
+                return self.fail("ERROR: Unknown peer", notify=True)
+            self.responder = responder
+            message_2 = responder.receive_1st_message(id_a, *fields[1:])
+            if message_2 is None:
+                return self.close_responder(self.fail(responder.ERROR, notify=True))
+            self.commit(responder)
+            discard_prefetched(responder, responder.id_a)
+            self.send(MESSAGE_2, *message_2)
+            self.expected = MESSAGE_3
+            return []
+
+        responder = self.responder
+        tag_b_prime = responder.receive_3rd_message(fields[0])
+        if tag_b_prime is None:
+            return self.close_responder(self.fail(responder.ERROR, notify=True))
+        self.commit(responder)
+        discard_prefetched(responder, responder.id_a)
+        self.send(MESSAGE_4, tag_b_prime)
+        self.closed = True
+        prefetch_next_epoch(responder, responder.K, responder.K_j_prime, responder.id_a)
+        event = HandshakeCompleted(responder.id_a, responder.session_key, responder.gap)
+        return self.close_responder([event])
+
+    def close_responder(self, events):
+        # The state is committed, the keys left in the Responder are zeroed and
+        # the peer released
+        responder, self.responder = self.responder, None
+        responder.close()
+        if self.release is not None:
+            self.release(responder.id_a)
+        return events
+
+    def close(self):
+        # Ends a handshake left unfinished, e.g. by a lost connection or a
+        # WireError. Safe to call more than once.
+        self.closed = True
+        if self.responder is not None:
+            self.close_responder([])
@@ -0,0 +1,391 @@
+# *****************************************************************************
+# *                                                                           *
+# *                      Asyncio Server and Client for SAKE AM                *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Network transport for the 'Initiator' and 'Responder' state machines.    *
+# *  One Responder server serves many peers at once over TCP or Unix sockets, *
+# *  keeping the key state of every peer indexed by its identifier 'id_a'.    *
+# *  The MAC/KDF work of each message can be offloaded to a thread or a       *
+# *  process pool. Running this script starts a load test on loopback.        *
+# *                                                                           *
+# *****************************************************************************
+
+import argparse
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from sake_am import *
+from sake_resumption import *
+from sake_wire import *
+
+def run_responder_step(responder, step, *args):
+    # Runs one message of the Responder. The Responder is returned along with the
+    # result because a process pool works on a copy of it.
+    result = getattr(responder, step)(*args)
+    return result, responder
+
+class PeerState:
+    # Key state the Responder keeps for one peer between handshakes
+    def __init__(self, K, K_prime, K_prime_past=(), last_gap=None):
+        self.K = K
+        self.K_prime = K_prime
+        self.K_prime_past = tuple(K_prime_past)
+        self.last_gap = last_gap
+        self.lock = asyncio.Lock()
+
+    def load(self, id_a, id_b, challenge_value, challenge_length, MAC_instance, KDF_instance, window):
+        return Responder(id_a, id_b, challenge_value, challenge_length, self.K, self.K_prime, MAC_instance, KDF_instance, window, self.K_prime_past, self.last_gap)
+
+    def commit(self, responder):
+        # The Responder keeps its keys in buffers zeroed by close(), they are copied
+        self.K = bytes(responder.K)
+        self.K_prime = bytes(responder.K_j_prime)
+        self.K_prime_past = tuple(bytes(key) for key in responder.ring.past)
+        self.last_gap = responder.last_gap
+
+# *****************************************************************************
+# *                                                                           *
+# *                                  SERVER                                   *
+# *                                                                           *
+# *****************************************************************************
+
+class ResponderServer:
+    # 'max_handshakes' bounds the handshakes in progress: once reached, new
+    # connections wait before their first message is read, which pushes back on
+    # the clients through the socket buffers. 'timeout' applies to every read.
+    # 'replay_guard' (see sake_replay.py) is checked in the event loop rather
+    # than by the Responder, which may run in another process. With a
+    # TicketCache in 'tickets' (see sake_resumption.py) a ticket is sent after
+    # every 4th message and resumption messages are accepted.
+
+    def __init__(self, id_b, challenge_length, MAC_instance, KDF_instance, window=1, timeout=5.0, max_handshakes=1024, executor=None, replay_guard=None, tickets=None):
+        self.id_b = id_b
+        self.challenge_length = challenge_length
+        self.MAC_instance = MAC_instance
+        self.KDF_instance = KDF_instance
+        self.window = window
+        self.timeout = timeout
+        self.executor = executor
+        self.replay_guard = replay_guard
+        self.tickets = tickets
+        self.slots = asyncio.Semaphore(max_handshakes)
+        self.peers = {}
+        self.server = None
+        self.completed = 0
+        self.resumed = 0
+        self.aborted = 0
+        self.timeouts = 0
+
+    def provision(self, id_a, K, K_prime):
+        self.peers[id_a] = PeerState(K, K_prime)
+
+    async def run_step(self, responder, step, *args):
+        if self.executor is None:
+            return run_responder_step(responder, step, *args)
+        if isinstance(self.executor, ProcessPoolExecutor):
+            # Received fields are views of the frame, they are copied to be pickled
+            args = [bytes(arg) if isinstance(arg, memoryview) else arg for arg in args]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, run_responder_step, responder, step, *args)
+
+    async def start_tcp(self, host="127.0.0.1", port=0, backlog=1024):
+        self.server = await asyncio.start_server(self.handle_connection, host, port, backlog=backlog)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def start_unix(self, path, backlog=1024):
+        self.server = await asyncio.start_unix_server(self.handle_connection, path, backlog=backlog)
+        return path
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            async with self.slots:
+                await self.handshake(reader, writer)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            self.aborted += 1
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def send(self, writer, message_type, *fields):
+        writer.write(encode_message(message_type, *fields))
+        await writer.drain()
+
+    async def abort(self, writer, error):
+        self.aborted += 1
+        await self.send(writer, MESSAGE_ABORT, error.encode())
+
+    async def handshake(self, reader, writer):
+        message_type, fields = await read_message(reader, self.timeout)
+        if message_type == MESSAGE_RESUME_1 and self.tickets is not None:
+            await self.resume(writer, fields)
+            return
+        if message_type != MESSAGE_1:
+            raise WireError("Unexpected message")
+        id_a, r_a, tag_a = str(fields[0], "utf-8"), fields[1], fields[2]
+
+        peer = self.peers.get(id_a)
+        if peer is None:
+            await self.abort(writer, "ERROR: Unknown peer")
+            return
+
+        # Handshakes of the same peer are serialised, each one works on the key
+        # state committed by the previous one
+        async with peer.lock:
+            if self.replay_guard is not None and self.replay_guard.seen(id_a, r_a):
+                await self.abort(writer, "ERROR: Replayed 1st message")
+                return
+            responder = peer.load(id_a, self.id_b, os.urandom(self.challenge_length), self.challenge_length, self.MAC_instance, self.KDF_instance, self.window)
+
+            # The keys left in the Responder are zeroed once the state is committed
+            try:
+                message_2, responder = await self.run_step(responder, "receive_1st_message", id_a, r_a, tag_a)
+                if message_2 is None:
+                    await self.abort(writer, responder.ERROR)
+                    return
+                if self.replay_guard is not None:
+                    self.replay_guard.add(id_a, r_a)
+                peer.commit(responder)
+                await self.send(writer, MESSAGE_2, *message_2)
+
+                message_type, fields = await read_message(reader, self.timeout)
+                if message_type != MESSAGE_3:
+                    raise WireError("Unexpected message")
+
+                tag_b_prime, responder = await self.run_step(responder, "receive_3rd_message", fields[0])
+                if tag_b_prime is None:
+                    await self.abort(writer, responder.ERROR)
+                    return
+                peer.commit(responder)
+                writer.write(encode_message(MESSAGE_4, tag_b_prime))
+                if self.tickets is not None:
+                    # Replaces the ticket of a previous session of the peer
+                    ticket_id = self.tickets.issue(id_a, self.MAC_instance, responder.session_key)
+                    writer.write(encode_message(MESSAGE_TICKET, ticket_id))
+                await writer.drain()
+                self.completed += 1
+            finally:
+                responder.close()
+
+    async def resume(self, writer, fields):
+        # A resumption costs a few MACs and does not touch the key state of the
+        # peer, so it runs in the event loop without the lock of the peer. The
+        # ticket is looked up and consumed with no await in between.
+        id_a = str(fields[0], "utf-8")
+        responder = ResumptionResponder(self.id_b, os.urandom(self.challenge_length), self.MAC_instance, self.tickets)
+        try:
+            message_2 = responder.receive_1st_message(id_a, *fields[1:])
+            if message_2 is None:
+                await self.abort(writer, responder.ERROR)
+                return
+            await self.send(writer, MESSAGE_RESUME_2, *message_2)
+            self.resumed += 1
+        finally:
+            responder.close()
+
+# *****************************************************************************
+# *                                                                           *
+# *                                  CLIENT                                   *
+# *                                                                           *
+# *****************************************************************************
+
+async def open_connection(address):
+    if isinstance(address, str):
+        return await asyncio.open_unix_connection(address)
+    return await asyncio.open_connection(*address)
+
+async def initiate(address, initiator, timeout=5.0, on_ticket=None):
+    # Runs one handshake of 'initiator' against the server at 'address', either a
+    # (host, port) pair or the path of a Unix socket. Returns True on success,
+    # otherwise the reason is left in 'initiator.ERROR'. If the server issues
+    # tickets, 'on_ticket' is called with the Ticket of the new session.
+    reader, writer = await open_connection(address)
+    try:
+        initiator.start_session()
+        writer.write(encode_message(MESSAGE_1, initiator.mac_input.id_a, initiator.r_a, initiator.tag_a))
+        await writer.drain()
+
+        message_type, fields = await read_message(reader, timeout)
+        if message_type == MESSAGE_ABORT:
+            initiator.ERROR = str(fields[0], "utf-8")
+            return False
+        if message_type != MESSAGE_2:
+            raise WireError("Unexpected message")
+        tag_a_prime = initiator.receive_2nd_message(*fields)
+        if tag_a_prime is None:
+            return False
+        writer.write(encode_message(MESSAGE_3, tag_a_prime))
+        await writer.drain()
+
+        message_type, fields = await read_message(reader, timeout)
+        if message_type == MESSAGE_ABORT:
+            initiator.ERROR = str(fields[0], "utf-8")
+            return False
+        if message_type != MESSAGE_4:
+            raise WireError("Unexpected message")
+        if initiator.receive_4th_message(fields[0]) is None:
+            return False
+
+        if on_ticket is not None:
+            message_type, fields = await read_message(reader, timeout)
+            if message_type != MESSAGE_TICKET:
+                raise WireError("Unexpected message")
+            on_ticket(Ticket.from_session(initiator, fields[0]))
+        return True
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+async def resume(address, initiator, timeout=5.0):
+    # Runs one resumption of a ResumptionInitiator. On success the new session
+    # key and the next ticket are left in 'initiator'. The ticket presented is
+    # spent in any case and a failed resumption is followed by a full handshake.
+    reader, writer = await open_connection(address)
+    try:
+        id_a, ticket_id, r_a, tag_a = initiator.start_session()
+        writer.write(encode_message(MESSAGE_RESUME_1, str(id_a).encode(), ticket_id, r_a, tag_a))
+        await writer.drain()
+
+        message_type, fields = await read_message(reader, timeout)
+        if message_type == MESSAGE_ABORT:
+            initiator.ERROR = str(fields[0], "utf-8")
+            initiator.ticket = None
+            return False
+        if message_type != MESSAGE_RESUME_2:
+            raise WireError("Unexpected message")
+        return initiator.receive_2nd_message(*fields) is not None
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+# *****************************************************************************
+# *                                                                           *
+# *                                 LOAD TEST                                 *
+# *                                                                           *
+# *****************************************************************************
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+async def load_test(peers=1000, handshakes=10000, concurrency=256, suite="sha256", challenge_length=128, unix_path=None, executor=None, timeout=5.0, resumption=False):
+    # With 'resumption' every client resumes with its ticket once it holds one
+    MAC_instance, KDF_instance = suite_instances(suite)
+
+    tickets = TicketCache(size=peers) if resumption else None
+    server = ResponderServer("Responder", challenge_length, MAC_instance, KDF_instance, timeout=timeout, max_handshakes=concurrency, executor=executor, tickets=tickets)
+    clients = []
+    for i in range(peers):
+        id_a = f"Initiator-{i}"
+        K = os.urandom(MAC_instance.LENGTH)
+        K_prime = os.urandom(MAC_instance.LENGTH)
+        server.provision(id_a, K, K_prime)
+        clients.append([id_a, K, K_prime, None])
+
+    if unix_path is not None:
+        address = await server.start_unix(unix_path)
+    else:
+        address = await server.start_tcp()
+
+    latencies = []
+    failures = 0
+    remaining = handshakes
+
+    async def worker(own_clients):
+        # Each worker owns a disjoint set of peers, so the key state of a client
+        # is never used by two handshakes at once
+        nonlocal remaining, failures
+        i = 0
+        while remaining > 0:
+            remaining -= 1
+            client = own_clients[i % len(own_clients)]
+            i += 1
+            if client[3] is not None:
+                initiator = ResumptionInitiator(client[0], client[3], os.urandom(challenge_length), MAC_instance)
+                start = time.perf_counter()
+                try:
+                    success = await resume(address, initiator, timeout)
+                except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError, WireError):
+                    success = False
+                latencies.append(time.perf_counter() - start)
+                client[3] = initiator.ticket if success else None
+                initiator.close()
+                if not success:
+                    failures += 1
+                continue
+
+            initiator = Initiator(client[0], "Responder", os.urandom(challenge_length), challenge_length, client[1], client[2], MAC_instance, KDF_instance)
+            on_ticket = (lambda ticket, client=client: client.__setitem__(3, ticket)) if resumption else None
+            start = time.perf_counter()
+            try:
+                success = await initiate(address, initiator, timeout, on_ticket)
+            except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError, WireError):
+                success = False
+            latencies.append(time.perf_counter() - start)
+            client[1], client[2] = bytes(initiator.K), bytes(initiator.K_prime)
+            initiator.close()
+            if not success:
+                failures += 1
+
+    workers = min(concurrency, peers)
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(clients[w::workers]) for w in range(workers)))
+    elapsed = time.perf_counter() - start
+    await server.close()
+
+    latencies.sort()
+    return {
+        "handshakes": len(latencies),
+        "resumed": server.resumed,
+        "failures": failures,
+        "seconds": elapsed,
+        "handshakes_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Load test of the SAKE AM server on loopback")
+    parser.add_argument("--peers", type=int, default=1000)
+    parser.add_argument("--handshakes", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--suite", choices=list(SUITES), default="sha256")
+    parser.add_argument("--challenge-size", type=int, default=128)
+    parser.add_argument("--unix", metavar="PATH", help="Use a Unix socket instead of TCP")
+    parser.add_argument("--pool", choices=["none", "thread", "process"], default="none", help="Offload the MAC/KDF work")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--resumption", action="store_true", help="Resume with session tickets after the first handshake")
+    args = parser.parse_args()
+
+    executor = None
+    if args.pool == "thread":
+        executor = ThreadPoolExecutor(args.workers)
+    elif args.pool == "process":
+        executor = ProcessPoolExecutor(args.workers)
+
+    report = asyncio.run(load_test(args.peers, args.handshakes, args.concurrency, args.suite, args.challenge_size, args.unix, executor, resumption=args.resumption))
+    if executor is not None:
+        executor.shutdown()
+
+    print(f"Handshakes: {report['handshakes']} || Resumed: {report['resumed']} || Failures: {report['failures']}")
+    print(f"Handshakes/sec: {report['handshakes_per_second']:.1f} || p50: {report['p50_ms']:.2f} ms || p99: {report['p99_ms']:.2f} ms")
@@ -0,0 +1,342 @@
+# *****************************************************************************
+# *                                                                           *
+# *                  Fleet Desynchronisation Simulator for SAKE AM            *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Discrete-event simulation of a fleet of Initiators handshaking with one  *
+# *  or more Responders over a lossy network. Every message runs the real     *
+# *  state machines of sake_am.py; a lost message leaves both entities with   *
+# *  the keys they had evolved so far, so the peers drift into gap 1 or -1    *
+# *  and the resynchronisation logic is exercised as in the field. With      *
+# *  'rollback' a device that loses a message also forgets the keys evolved  *
+# *  in that attempt (state not persisted), which can push it beyond the     *
+# *  window of the Responder.                                                 *
+# *                                                                           *
+# *  The key state of every peer is independent of the others, so the fleet  *
+# *  is split in shards simulated by separate processes and the reports are   *
+# *  added up. MAC and KDF operations are counted with sake_metrics.py and    *
+# *  turned into CPU time with the measured cost of each operation, to size  *
+# *  the Responders.                                                          *
+# *                                                                           *
+# *  Events (simulated time in seconds):                                      *
+# *     START         the device opens a handshake and sends the 1st message  *
+# *     TO_RESPONDER  1st or 3rd message delivered to the Responder           *
+# *     TO_INITIATOR  2nd, 4th or abort message delivered to the Initiator    *
+# *                                                                           *
+# *****************************************************************************
+
+import argparse
+import heapq
+import json
+import os
+import random
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from sake_am import *
+from sake_metrics import Instrumentation
+
+START = 0
+TO_RESPONDER = 1
+TO_INITIATOR = 2
+
+OPERATIONS = ("mac", "vrfy", "kdf")
+
+class FleetShard:
+    # Devices 'first' to 'first + count - 1' of the fleet. Device d talks to the
+    # Responder d % responders. Every device handshakes on average once per
+    # 'interval' seconds and retries 'retry' seconds after a failure, which is
+    # noticed after 'timeout' seconds when a message is lost.
+
+    def __init__(self, first, count, responders, suite, challenge_length, window, loss, rollback, interval, retry, latency, timeout, seed):
+        self.first = first
+        self.count = count
+        self.responders = responders
+        self.challenge_length = challenge_length
+        self.window = window
+        self.loss = loss
+        self.rollback = rollback
+        self.interval = interval
+        self.retry = retry
+        self.latency = latency
+        self.timeout = timeout
+        self.random = random.Random(seed)
+
+        # The instances are wrapped once, every session of a side shares them
+        MAC_instance, KDF_instance = suite_instances(suite)
+        self.initiator_counters = Instrumentation()
+        self.initiator_suite = (self.initiator_counters.wrap_mac(MAC_instance), self.initiator_counters.wrap_kdf(KDF_instance))
+        self.responder_counters = [Instrumentation() for _ in range(responders)]
+        self.responder_suites = [(counters.wrap_mac(MAC_instance), counters.wrap_kdf(KDF_instance)) for counters in self.responder_counters]
+
+        # Key state of every device (Initiator side, then Responder side)
+        length = MAC_instance.LENGTH
+        self.iK = []
+        self.iK_prime = []
+        for _ in range(count):
+            self.iK.append(self.random.randbytes(length))
+            self.iK_prime.append(self.random.randbytes(length))
+        self.rK = list(self.iK)
+        self.rK_prime = list(self.iK_prime)
+        self.rK_prime_past = [()] * count
+        self.last_gap = [None] * count
+
+        self.sessions = {}                  # device -> [initiator, responder, start time, keys at start]
+        self.last_error = [None] * count
+        self.events = []
+        self.sequence = 0
+
+        self.attempts = 0
+        self.completed = 0
+        self.resynchronised = 0
+        self.lost = Counter()               # message number -> messages lost
+        self.errors = Counter()             # error -> handshakes aborted
+        self.gaps = Counter()               # gap accepted by the Responder -> 1st messages
+
+    def schedule(self, at, kind, device, message=0):
+        self.sequence += 1
+        heapq.heappush(self.events, (at, self.sequence, kind, device, message))
+
+    def send(self, now, kind, device, message):
+        # Delivers 'message' after the latency, unless it is lost
+        if self.random.random() < self.loss:
+            self.lost[message] += 1
+            self.fail(now, device, f"Timeout: {ordinal(message)} message lost", self.sessions[device][2] + self.timeout)
+            return
+        self.schedule(now + self.latency, kind, device, message)
+
+    def fail(self, now, device, error, noticed):
+        initiator, responder, _, keys = self.sessions.pop(device)
+        if self.rollback and error.startswith("Timeout") and self.random.random() < self.rollback:
+            self.iK[device], self.iK_prime[device] = keys
+        else:
+            self.save_initiator(device, initiator)
+        initiator.close()
+        if responder is not None:
+            responder.close()
+        self.errors[error] += 1
+        self.last_error[device] = error
+        self.schedule(noticed + self.retry, START, device)
+
+    def save_initiator(self, device, initiator):
+        self.iK[device] = bytes(initiator.K)
+        self.iK_prime[device] = bytes(initiator.K_prime)
+
+    def commit_responder(self, device, responder):
+        self.rK[device] = bytes(responder.K)
+        self.rK_prime[device] = bytes(responder.K_j_prime)
+        self.rK_prime_past[device] = tuple(bytes(key) for key in responder.ring.past)
+        self.last_gap[device] = responder.last_gap
+
+    def identifiers(self, device):
+        return f"device-{self.first + device}", f"responder-{(self.first + device) % self.responders}"
+
+    def handle(self, now, kind, device, message):
+        if kind == START:
+            self.attempts += 1
+            id_a, id_b = self.identifiers(device)
+            MAC_instance, KDF_instance = self.initiator_suite
+            initiator = Initiator(id_a, id_b, self.random.randbytes(self.challenge_length), self.challenge_length, self.iK[device], self.iK_prime[device], MAC_instance, KDF_instance)
+            self.sessions[device] = [initiator, None, now, (self.iK[device], self.iK_prime[device])]
+            initiator.start_session()
+            self.send(now, TO_RESPONDER, device, 1)
+            return
+
+        session = self.sessions[device]
+        initiator, responder = session[0], session[1]
+
+        if kind == TO_RESPONDER and message == 1:
+            id_a, id_b = self.identifiers(device)
+            MAC_instance, KDF_instance = self.responder_suites[(self.first + device) % self.responders]
+            responder = session[1] = Responder(id_a, id_b, self.random.randbytes(self.challenge_length), self.challenge_length, self.rK[device], self.rK_prime[device],
+                                               MAC_instance, KDF_instance, self.window, self.rK_prime_past[device], self.last_gap[device])
+            result = responder.receive_1st_message(initiator.id_a, initiator.r_a, initiator.tag_a)
+            if result is None:
+                self.fail(now, device, responder.ERROR, now + self.latency)
+                return
+            self.gaps[responder.gap] += 1
+            self.commit_responder(device, responder)
+            self.send(now, TO_INITIATOR, device, 2)
+
+        elif kind == TO_INITIATOR and message == 2:
+            result = initiator.receive_2nd_message(responder.sync, responder.r_b, responder.tag_b)
+            if result is None:
+                self.fail(now, device, initiator.ERROR, now)
+                return
+            self.save_initiator(device, initiator)
+            self.send(now, TO_RESPONDER, device, 3)
+
+        elif kind == TO_RESPONDER and message == 3:
+            result = responder.receive_3rd_message(initiator.tag_a_prime)
+            if result is None:
+                self.fail(now, device, responder.ERROR, now + self.latency)
+                return
+            self.commit_responder(device, responder)
+            self.send(now, TO_INITIATOR, device, 4)
+
+        else:
+            if initiator.receive_4th_message(responder.tag_b_prime) is None:
+                self.fail(now, device, initiator.ERROR, now)
+                return
+            self.completed += 1
+            if responder.gap != 0:
+                self.resynchronised += 1
+            self.last_error[device] = None
+            del self.sessions[device]
+            initiator.close()
+            responder.close()
+            self.schedule(now + self.random.expovariate(1.0 / self.interval), START, device)
+
+    def run(self, duration):
+        # First handshakes spread over one interval, so the fleet does not start at once
+        for device in range(self.count):
+            self.schedule(self.random.uniform(0.0, self.interval), START, device)
+
+        events = self.events
+        while events and events[0][0] < duration:
+            now, _, kind, device, message = heapq.heappop(events)
+            self.handle(now, kind, device, message)
+        return self.report()
+
+    def report(self):
+        # Handshakes still in progress at the end of the simulation are left out
+        return {
+            "attempts": self.attempts - len(self.sessions),
+            "completed": self.completed,
+            "resynchronised": self.resynchronised,
+            "lost": dict(self.lost),
+            "errors": dict(self.errors),
+            "gaps": dict(self.gaps),
+            "desynchronised": sum(1 for error in self.last_error if error == "ERROR: Verification of the 1st message failed"),
+            "initiator_operations": operations(self.initiator_counters),
+            "responder_operations": [operations(counters) for counters in self.responder_counters],
+        }
+
+def ordinal(number):
+    return {1: "1st", 2: "2nd", 3: "3rd"}.get(number, f"{number}th")
+
+def operations(instrumentation):
+    counters = instrumentation.counters
+    return {name: counters.get(name, 0) for name in OPERATIONS}
+
+def simulate_shard(arguments):
+    first, count, options, duration = arguments
+    return FleetShard(first, count, **options).run(duration)
+
+def merge(reports):
+    total = {"attempts": 0, "completed": 0, "resynchronised": 0, "desynchronised": 0}
+    lost, errors, gaps = Counter(), Counter(), Counter()
+    initiator = Counter()
+    responders = None
+    for report in reports:
+        for name in total:
+            total[name] += report[name]
+        lost.update(report["lost"])
+        errors.update(report["errors"])
+        gaps.update(report["gaps"])
+        initiator.update(report["initiator_operations"])
+        if responders is None:
+            responders = [Counter() for _ in report["responder_operations"]]
+        for counter, shard in zip(responders, report["responder_operations"]):
+            counter.update(shard)
+    total["lost"] = dict(lost)
+    total["errors"] = dict(errors)
+    total["gaps"] = {str(gap): count for gap, count in sorted(gaps.items())}
+    total["initiator_operations"] = dict(initiator)
+    total["responder_operations"] = [dict(counter) for counter in responders]
+    return total
+
+def operation_costs(suite, challenge_length, samples=20000):
+    # Seconds per MAC and per KDF derivation of the suite, for the CPU estimate
+    MAC_instance, KDF_instance = suite_instances(suite)
+    key = os.urandom(MAC_instance.LENGTH)
+    message = os.urandom(2 * challenge_length + 32)
+    start = time.perf_counter()
+    for i in range(samples):
+        MAC_instance.mac(key, message)
+    mac = (time.perf_counter() - start) / samples
+    start = time.perf_counter()
+    for i in range(samples):
+        KDF_instance.derive(key, message)
+    kdf = (time.perf_counter() - start) / samples
+    return mac, kdf
+
+def simulate(devices=10000, responders=1, duration=3600.0, suite="sha256", challenge_length=128, window=1, loss=0.01, rollback=0.0,
+             interval=60.0, retry=5.0, latency=0.02, timeout=1.0, processes=None, seed=0):
+    processes = processes or os.cpu_count()
+    options = dict(responders=responders, suite=suite, challenge_length=challenge_length, window=window, loss=loss, rollback=rollback,
+                   interval=interval, retry=retry, latency=latency, timeout=timeout)
+    shards = max(1, min(processes, devices))
+    bounds = [devices * i // shards for i in range(shards + 1)]
+    work = [(bounds[i], bounds[i + 1] - bounds[i], dict(options, seed=seed * 1000003 + i), duration) for i in range(shards)]
+
+    start = time.perf_counter()
+    if shards == 1:
+        reports = [simulate_shard(work[0])]
+    else:
+        with ProcessPoolExecutor(shards) as executor:
+            reports = list(executor.map(simulate_shard, work))
+    elapsed = time.perf_counter() - start
+
+    report = merge(reports)
+    completed = report["completed"]
+    attempts = report["attempts"]
+    mac_cost, kdf_cost = operation_costs(suite, challenge_length)
+
+    def per_session(counters):
+        return {name: counters.get(name, 0) / completed if completed else 0.0 for name in OPERATIONS}
+
+    responder_total = Counter()
+    for counters in report["responder_operations"]:
+        responder_total.update(counters)
+    report.update({
+        "parameters": dict(options, devices=devices, duration=duration, seed=seed),
+        "wall_seconds": elapsed,
+        "simulated_handshakes_per_second": attempts / elapsed,
+        "throughput": completed / duration,
+        "abort_rate": (attempts - completed) / attempts if attempts else 0.0,
+        "resync_rate": report["resynchronised"] / completed if completed else 0.0,
+        "initiator_operations_per_session": per_session(report["initiator_operations"]),
+        "responder_operations_per_session": per_session(responder_total),
+        # The MAC count includes the verifications (vrfy)
+        "responder_cores": [(counters.get("mac", 0) * mac_cost + counters.get("kdf", 0) * kdf_cost) / duration for counters in report["responder_operations"]],
+    })
+    return report
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Discrete-event simulation of a fleet of SAKE AM peers over a lossy network")
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--responders", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=3600.0, help="Simulated seconds")
+    parser.add_argument("--suite", choices=list(SUITES), default="sha256")
+    parser.add_argument("--challenge-size", type=int, default=128)
+    parser.add_argument("--window", type=int, default=1, help="Resynchronisation window of the Responders")
+    parser.add_argument("--loss", type=float, default=0.01, help="Probability of losing each message")
+    parser.add_argument("--rollback", type=float, default=0.0, help="Probability that a device forgets the keys of a failed attempt")
+    parser.add_argument("--interval", type=float, default=60.0, help="Mean seconds between the handshakes of a device")
+    parser.add_argument("--retry", type=float, default=5.0, help="Seconds before retrying a failed handshake")
+    parser.add_argument("--latency", type=float, default=0.02, help="One-way latency in seconds")
+    parser.add_argument("--timeout", type=float, default=1.0)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    report = simulate(args.devices, args.responders, args.duration, args.suite, args.challenge_size, args.window, args.loss, args.rollback,
+                      args.interval, args.retry, args.latency, args.timeout, args.processes, args.seed)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+
+    print(f"Handshakes: {report['attempts']} || Completed: {report['completed']} || Simulated handshakes/sec: {report['simulated_handshakes_per_second']:.0f}")
+    print(f"Throughput: {report['throughput']:.1f} sessions/s || Resync rate: {report['resync_rate']:.2%} || Abort rate: {report['abort_rate']:.2%} || Desynchronised devices: {report['desynchronised']}")
+    print(f"Gaps: {report['gaps']}")
+    for error, count in sorted(report["errors"].items()):
+        print(f"    {count:10}  {error}")
+    for side in ("initiator", "responder"):
+        per_session = report[f"{side}_operations_per_session"]
+        print(f"{side.capitalize()} per session: " + " || ".join(f"{name}: {per_session[name]:.2f}" for name in OPERATIONS))
+    for index, cores in enumerate(report["responder_cores"]):
+        print(f"Responder {index}: {cores:.4f} cores")
@@ -0,0 +1,307 @@
+# *****************************************************************************
+# *                                                                           *
+# *                    Memory-mapped Key-State Store for SAKE AM              *
+# *                                                                           *
+# *  Description:                                                             *
+# *  File of fixed-size records, one per provisioned peer, holding the key    *
+# *  state the Responder needs between handshakes: K, K_prime, the previous   *
+# *  K_prime keys of the resynchronisation window and the last gap. The file  *
+# *  is mapped in memory and shared by every process that opens it; records   *
+# *  are found by hashing the peer identifier (open addressing).              *
+# *                                                                           *
+# *  Every record keeps two copies of the state. A commit writes the copy     *
+# *  not in use with a higher sequence number and a CRC, so a write cut by a  *
+# *  crash leaves the previous copy valid. The handshakes of a peer are      *
+# *  serialised by a lock per record: a thread lock within the process and a  *
+# *  byte-range lock (fcntl) across processes, since fcntl locks are held by  *
+# *  the process and do not exclude its own threads. A commit requires the    *
+# *  lock of the record to be held by the calling thread.                     *
+# *                                                                           *
+# *  File layout:                                                             *
+# *     header (64) | record 0 | record 1 | ...                               *
+# *     record = used (1) | id length (1) | id | copy 0 | copy 1              *
+# *     copy   = sequence (8) | last gap (2) | past count (2) | K | K_prime   *
+# *              | past K_prime keys (window) | crc32 (4)                     *
+# *                                                                           *
+# *****************************************************************************
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from sake_am import *
+
+MAGIC = b"SAKESTOR"
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct(">8sHHHHQ")      # magic, version, key length, window, id length, capacity
+HEADER_SIZE = 64
+RECORD_HEAD = struct.Struct(">BB")      # used, id length
+COPY_HEAD = struct.Struct(">QhH")       # sequence, last gap, past count
+CRC = struct.Struct(">I")
+
+NO_GAP = -32768                         # 'last_gap' of None
+
+class StoreError(Exception):
+    pass
+
+class PeerRecord:
+    def __init__(self, K, K_prime, K_prime_past, last_gap, sequence):
+        self.K = K
+        self.K_prime = K_prime
+        self.K_prime_past = K_prime_past
+        self.last_gap = last_gap
+        self.sequence = sequence
+
+class KeyStore:
+
+    def __init__(self, path, durable=False):
+        # Opens an existing store. With 'durable' every commit is flushed to disk
+        # before returning.
+        self.path = path
+        self.durable = durable
+        self.header_lock = threading.Lock()
+        self.slot_locks = {}            # slot -> threading.Lock
+        self.holders = {}               # slot -> identifier of the thread holding the lock
+        self.fd = os.open(path, os.O_RDWR)
+        try:
+            header = os.pread(self.fd, HEADER.size, 0)
+            magic, version, self.key_length, self.window, self.id_length, self.capacity = HEADER.unpack(header)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise StoreError(f"{path} is not a key store of version {FORMAT_VERSION}")
+            self.copy_size = COPY_HEAD.size + (2 + self.window) * self.key_length + CRC.size
+            self.record_size = RECORD_HEAD.size + self.id_length + 2 * self.copy_size
+            self.map = mmap.mmap(self.fd, HEADER_SIZE + self.capacity * self.record_size)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    @classmethod
+    def create(cls, path, capacity, key_length, window=1, id_length=64, durable=False):
+        # Creates an empty store. 'capacity' should exceed the number of peers by
+        # a margin (load factor below 0.7) to keep the probe sequences short.
+        if not 0 < id_length < 256:
+            raise StoreError("Identifier length must be between 1 and 255")
+        copy_size = COPY_HEAD.size + (2 + window) * key_length + CRC.size
+        record_size = RECORD_HEAD.size + id_length + 2 * copy_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.ftruncate(fd, HEADER_SIZE + capacity * record_size)
+            os.pwrite(fd, HEADER.pack(MAGIC, FORMAT_VERSION, key_length, window, id_length, capacity), 0)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return cls(path, durable)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # -------------------------------------------------------------------------
+    # Records
+    # -------------------------------------------------------------------------
+
+    def record_offset(self, slot):
+        return HEADER_SIZE + slot * self.record_size
+
+    def encode_id(self, peer_id):
+        encoded = str(peer_id).encode()
+        if len(encoded) > self.id_length:
+            raise StoreError(f"Identifier longer than {self.id_length} bytes")
+        return encoded
+
+    def probe(self, encoded_id):
+        # Slots to look at for 'encoded_id', in order
+        start = int.from_bytes(hashlib.blake2b(encoded_id, digest_size=8).digest(), "big") % self.capacity
+        for i in range(self.capacity):
+            yield (start + i) % self.capacity
+
+    def find_slot(self, peer_id):
+        # Slot of 'peer_id', or None if it is not provisioned
+        encoded_id = self.encode_id(peer_id)
+        for slot in self.probe(encoded_id):
+            offset = self.record_offset(slot)
+            used, length = RECORD_HEAD.unpack_from(self.map, offset)
+            if not used:
+                return None
+            start = offset + RECORD_HEAD.size
+            if length == len(encoded_id) and self.map[start:start + length] == encoded_id:
+                return slot
+        return None
+
+    @contextmanager
+    def file_lock(self, offset, length):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, length, offset)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+    def lock_slot(self, slot):
+        lock = self.slot_locks.get(slot) or self.slot_locks.setdefault(slot, threading.Lock())
+        lock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.record_size, self.record_offset(slot))
+        except BaseException:
+            lock.release()
+            raise
+        self.holders[slot] = threading.get_ident()
+
+    def unlock_slot(self, slot):
+        if self.holders.get(slot) != threading.get_ident():
+            raise StoreError("Record not locked by this thread")
+        del self.holders[slot]
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, self.record_size, self.record_offset(slot))
+        self.slot_locks[slot].release()
+
+    def acquire(self, peer_id):
+        # Exclusive access to the record of 'peer_id' across threads and
+        # processes, to be held from the load to the last commit of a handshake.
+        # Blocks until the record is free; the lock is not reentrant.
+        slot = self.find_slot(peer_id)
+        if slot is None:
+            raise KeyError(peer_id)
+        self.lock_slot(slot)
+        return slot
+
+    def release(self, peer_id):
+        slot = self.find_slot(peer_id)
+        if slot is None:
+            raise KeyError(peer_id)
+        self.unlock_slot(slot)
+
+    @contextmanager
+    def locked(self, peer_id):
+        # acquire() and release() around a block. Blocking: an event loop should
+        # run it in a thread of its own.
+        slot = self.acquire(peer_id)
+        try:
+            yield slot
+        finally:
+            self.unlock_slot(slot)
+
+    def provision(self, peer_id, K, K_prime, K_prime_past=(), last_gap=None):
+        encoded_id = self.encode_id(peer_id)
+        # The header is locked while a slot is claimed, so two threads or
+        # processes never claim the same free slot
+        with self.header_lock, self.file_lock(0, HEADER_SIZE):
+            for slot in self.probe(encoded_id):
+                offset = self.record_offset(slot)
+                used, length = RECORD_HEAD.unpack_from(self.map, offset)
+                start = offset + RECORD_HEAD.size
+                if used and not (length == len(encoded_id) and self.map[start:start + length] == encoded_id):
+                    continue
+                self.lock_slot(slot)
+                try:
+                    if not used:
+                        self.map[start:start + len(encoded_id)] = encoded_id
+                    self.write_copy(slot, K, K_prime, K_prime_past, last_gap)
+                    # The record becomes visible once the identifier and the
+                    # keys are in place
+                    RECORD_HEAD.pack_into(self.map, offset, 1, len(encoded_id))
+                    self.flush(offset, self.record_size)
+                finally:
+                    self.unlock_slot(slot)
+                return slot
+        raise StoreError("Key store is full")
+
+    # -------------------------------------------------------------------------
+    # Copies of the state
+    # -------------------------------------------------------------------------
+
+    def copy_offset(self, slot, copy):
+        return self.record_offset(slot) + RECORD_HEAD.size + self.id_length + copy * self.copy_size
+
+    def read_copy(self, slot, copy):
+        # Returns the PeerRecord of the copy, or None if it is empty or corrupted
+        offset = self.copy_offset(slot, copy)
+        data = self.map[offset:offset + self.copy_size]
+        (crc,) = CRC.unpack_from(data, len(data) - CRC.size)
+        sequence, last_gap, past_count = COPY_HEAD.unpack_from(data)
+        if sequence == 0 or crc != zlib.crc32(data[:-CRC.size]):
+            return None
+        keys = COPY_HEAD.size
+        length = self.key_length
+        K = data[keys:keys + length]
+        K_prime = data[keys + length:keys + 2 * length]
+        past_start = keys + 2 * length
+        past = [data[past_start + i * length:past_start + (i + 1) * length] for i in range(past_count)]
+        return PeerRecord(K, K_prime, past, None if last_gap == NO_GAP else last_gap, sequence)
+
+    def current_copy(self, slot):
+        # Index and PeerRecord of the valid copy with the highest sequence number
+        best = (None, None)
+        for copy in (0, 1):
+            record = self.read_copy(slot, copy)
+            if record is not None and (best[1] is None or record.sequence > best[1].sequence):
+                best = (copy, record)
+        return best
+
+    def write_copy(self, slot, K, K_prime, K_prime_past, last_gap):
+        copy, record = self.current_copy(slot)
+        target = 0 if copy is None else 1 - copy
+        sequence = 1 if record is None else record.sequence + 1
+
+        past = list(K_prime_past)[-self.window:]
+        for key in [K, K_prime] + past:
+            if len(key) != self.key_length:
+                raise StoreError(f"Keys of this store have {self.key_length} bytes")
+
+        data = bytearray(self.copy_size)
+        COPY_HEAD.pack_into(data, 0, sequence, NO_GAP if last_gap is None else last_gap, len(past))
+        keys = b"".join([K, K_prime] + past)
+        data[COPY_HEAD.size:COPY_HEAD.size + len(keys)] = keys
+        CRC.pack_into(data, len(data) - CRC.size, zlib.crc32(data[:-CRC.size]))
+
+        offset = self.copy_offset(slot, target)
+        self.map[offset:offset + self.copy_size] = data
+        self.flush(offset, self.copy_size)
+
+    def flush(self, offset, length):
+        if self.durable:
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            self.map.flush(start, offset + length - start)
+
+    # -------------------------------------------------------------------------
+    # Handshakes
+    # -------------------------------------------------------------------------
+
+    def load(self, peer_id):
+        # Needs no lock to read: a commit writes the copy not in use, and a copy
+        # read half written fails its CRC, so the previous one is returned
+        slot = self.find_slot(peer_id)
+        if slot is None:
+            return None
+        return self.current_copy(slot)[1]
+
+    def commit(self, peer_id, K, K_prime, K_prime_past=(), last_gap=None):
+        # Only from the thread holding the lock of the record (acquire or locked)
+        slot = self.find_slot(peer_id)
+        if slot is None:
+            raise KeyError(peer_id)
+        if self.holders.get(slot) != threading.get_ident():
+            raise StoreError("Commit without holding the lock of the record")
+        self.write_copy(slot, K, K_prime, K_prime_past, last_gap)
+
+    def load_responder(self, peer_id, id_b, challenge_value, challenge_length, MAC_instance, KDF_instance, **options):
+        # Responder for a handshake with 'peer_id' built from its stored state.
+        # The lock of the record must be held until the handshake ends, so that
+        # the state committed is not overwritten by a concurrent handshake.
+        record = self.load(peer_id)
+        if record is None:
+            raise KeyError(peer_id)
+        return Responder(peer_id, id_b, challenge_value, challenge_length, record.K, record.K_prime, MAC_instance, KDF_instance, self.window, record.K_prime_past, record.last_gap, **options)
+
+    def commit_responder(self, responder):
+        # Stores the evolved keys of 'responder' as the state of its peer
+        self.commit(responder.id_a, responder.K, responder.K_j_prime, responder.ring.past, responder.last_gap)
@@ -0,0 +1,163 @@
+# *****************************************************************************
+# *                                                                           *
+# *                         Wire Format for SAKE AM                           *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Versioned, length-prefixed binary encoding of the four messages of       *
+# *  SAKE AM, of the resumption messages (see sake_resumption.py) and of the  *
+# *  abort notification. Decoding returns 'memoryview' slices of the received *
+# *  frame, so no field is copied while parsing.                              *
+# *                                                                           *
+# *  Frame layout (big-endian):                                               *
+# *     length (4) | version (1) | type (1) | fields                          *
+# *  where 'length' counts the bytes after itself and every field is          *
+# *     u16         integer (2)                                               *
+# *     bytes16     length (2) | bytes                                        *
+# *     bytes8      length (1) | bytes                                        *
+# *                                                                           *
+# *****************************************************************************
+
+import asyncio
+import struct
+
+VERSION = 1
+
+MESSAGE_1 = 1                           # id_a, r_a, tag_a
+MESSAGE_2 = 2                           # sync, r_b, tag_b
+MESSAGE_3 = 3                           # tag_a_prime
+MESSAGE_4 = 4                           # tag_b_prime
+MESSAGE_TICKET = 5                      # ticket_id (after the 4th message)
+MESSAGE_RESUME_1 = 6                    # id_a, ticket_id, r_a, tag_a
+MESSAGE_RESUME_2 = 7                    # r_b, next_ticket_id, tag_b
+MESSAGE_ABORT = 0xFF                    # error
+
+U16 = 0
+BYTES16 = 1
+BYTES8 = 2
+
+SCHEMAS = {
+    MESSAGE_1: (BYTES16, BYTES16, BYTES8),
+    MESSAGE_2: (U16, BYTES16, BYTES8),
+    MESSAGE_3: (BYTES8,),
+    MESSAGE_4: (BYTES8,),
+    MESSAGE_TICKET: (BYTES8,),
+    MESSAGE_RESUME_1: (BYTES16, BYTES8, BYTES16, BYTES8),
+    MESSAGE_RESUME_2: (BYTES16, BYTES8, BYTES8),
+    MESSAGE_ABORT: (BYTES16,),
+}
+
+LENGTH = struct.Struct(">I")
+HEADER = struct.Struct(">IBB")
+PREFIX = {U16: struct.Struct(">H"), BYTES16: struct.Struct(">H"), BYTES8: struct.Struct(">B")}
+
+MAX_PAYLOAD = 1 << 16
+
+class WireError(ValueError):
+    pass
+
+def encode_message(message_type, *fields):
+    # Returns the whole frame. The frame is written in one preallocated buffer
+    # instead of concatenating the fields.
+    schema = SCHEMAS[message_type]
+    if len(fields) != len(schema):
+        raise WireError(f"Message {message_type} has {len(schema)} fields")
+
+    size = HEADER.size
+    for kind, field in zip(schema, fields):
+        size += PREFIX[kind].size
+        if kind != U16:
+            size += len(field)
+
+    frame = bytearray(size)
+    HEADER.pack_into(frame, 0, size - LENGTH.size, VERSION, message_type)
+    offset = HEADER.size
+    for kind, field in zip(schema, fields):
+        prefix = PREFIX[kind]
+        if kind == U16:
+            prefix.pack_into(frame, offset, field)
+            offset += prefix.size
+            continue
+        try:
+            prefix.pack_into(frame, offset, len(field))
+        except struct.error:
+            raise WireError("Field too long") from None
+        offset += prefix.size
+        frame[offset:offset + len(field)] = field
+        offset += len(field)
+    return frame
+
+def decode_payload(payload):
+    # Parses the bytes that follow the length of a frame. Returns the message type
+    # and its fields, integers or memoryview slices of 'payload'.
+    view = memoryview(payload)
+    if len(view) < 2:
+        raise WireError("Truncated header")
+    version, message_type = view[0], view[1]
+    if version != VERSION:
+        raise WireError(f"Unsupported version {version}")
+    schema = SCHEMAS.get(message_type)
+    if schema is None:
+        raise WireError(f"Unknown message type {message_type}")
+
+    fields = []
+    offset = 2
+    for kind in schema:
+        prefix = PREFIX[kind]
+        if offset + prefix.size > len(view):
+            raise WireError("Truncated field")
+        (value,) = prefix.unpack_from(view, offset)
+        offset += prefix.size
+        if kind == U16:
+            fields.append(value)
+            continue
+        if offset + value > len(view):
+            raise WireError("Truncated field")
+        fields.append(view[offset:offset + value])
+        offset += value
+
+    if offset != len(view):
+        raise WireError("Trailing bytes")
+    return message_type, fields
+
+def decode_message(frame):
+    # Parses a whole frame, length included
+    view = memoryview(frame)
+    if len(view) < LENGTH.size:
+        raise WireError("Truncated length")
+    (length,) = LENGTH.unpack_from(view)
+    if length != len(view) - LENGTH.size:
+        raise WireError("Frame length mismatch")
+    return decode_payload(view[LENGTH.size:])
+
+class FrameDecoder:
+    # Incremental decoder for a byte stream. Every complete frame is taken out of
+    # the stream buffer once and its fields are views of that copy.
+
+    def __init__(self, max_payload=MAX_PAYLOAD):
+        self.buffer = bytearray()
+        self.max_payload = max_payload
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= LENGTH.size:
+            (length,) = LENGTH.unpack_from(self.buffer)
+            if length > self.max_payload:
+                raise WireError("Frame too long")
+            end = LENGTH.size + length
+            if len(self.buffer) < end:
+                break
+            with memoryview(self.buffer) as view:
+                payload = bytes(view[LENGTH.size:end])
+            del self.buffer[:end]
+            messages.append(decode_payload(payload))
+        return messages
+
+async def read_message(reader, timeout, max_payload=MAX_PAYLOAD):
+    # Reads one frame from an asyncio StreamReader
+    header = await asyncio.wait_for(reader.readexactly(LENGTH.size), timeout)
+    (length,) = LENGTH.unpack(header)
+    if length > max_payload:
+        raise WireError("Frame too long")
+    payload = await asyncio.wait_for(reader.readexactly(length), timeout)
+    return decode_payload(payload)
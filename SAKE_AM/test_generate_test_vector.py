@@ -0,0 +1,34 @@
+# *****************************************************************************
+# *                                                                           *
+# *                        Test Vector Generator Tests                        *
+# *                                                                           *
+# *  Description:                                                             *
+# *  The --mix option must only accept known scenarios with integer weights   *
+# *  that are not negative and add up to a positive total.                    *
+# *                                                                           *
+# *****************************************************************************
+
+import argparse
+import unittest
+from generate_test_vector import parse_mix
+
+class MixTests(unittest.TestCase):
+
+    def test_valid_mix(self):
+        self.assertEqual(parse_mix("in_sync=4, gap_ahead=0,mismatch"), {"in_sync": 4, "gap_ahead": 0, "mismatch": 1})
+
+    def test_invalid_mix(self):
+        cases = {
+            "in_sync=-1,mismatch=3": "must not be negative",
+            "in_sync=1.5": "must be an integer",
+            "in_sync=x": "must be an integer",
+            "unknown=1": "Unknown scenario",
+            "in_sync=0,mismatch=0": "needs a positive weight",
+        }
+        for text, message in cases.items():
+            with self.subTest(text=text):
+                with self.assertRaisesRegex(argparse.ArgumentTypeError, message):
+                    parse_mix(text)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+# *****************************************************************************
+# *                                                                           *
+# *                        Test Vector Verifier Tests                         *
+# *                                                                           *
+# *  Description:                                                             *
+# *  The verifier must run the state machines of sake_am.py, so a broken      *
+# *  Initiator or Responder fails the vectors, and a malformed record must    *
+# *  only fail its own line.                                                  *
+# *                                                                           *
+# *****************************************************************************
+
+import os
+import unittest
+from unittest import mock
+from read_test_vector import verify_chunk, verify_lines
+from sake_am import *
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+VECTORS = os.path.join(DIRECTORY, "test_generated", "test_vectors_100_sha256_1.txt")
+
+def vector_lines():
+    with open(VECTORS) as file:
+        return file.readlines()
+
+class VerifierTests(unittest.TestCase):
+
+    def test_generated_vectors_pass(self):
+        for cross_check in (False, True):
+            results = verify_lines(vector_lines(), cross_check)
+            self.assertTrue(all(result is not False for result in results))
+            self.assertEqual(sum(result is True for result in results), 100)
+
+    def test_broken_state_machines_fail(self):
+        lines = vector_lines()
+        completed = sum(line.startswith("COMPLETED") for line in lines)
+        for cls, name in ((Initiator, "receive_2nd_message"), (Responder, "receive_3rd_message")):
+            with self.subTest(method=f"{cls.__name__}.{name}"):
+                with mock.patch.object(cls, name, lambda *args: None):
+                    results = verify_lines(lines)
+                self.assertGreaterEqual(sum(result is False for result in results), completed)
+
+    def test_broken_mac_fails(self):
+        with mock.patch.object(HMAC, "mac", lambda self, key, message: bytes(self.LENGTH)), \
+             mock.patch.object(HMAC, "verify", lambda self, key, message, tag: False):
+            results = verify_lines(vector_lines())
+        self.assertTrue(any(result is False for result in results))
+
+    def test_malformed_record_fails_its_line(self):
+        lines = vector_lines()[:3]
+        fields = lines[0].split()
+        # 64-byte keys are too long for BLAKE2s
+        bad = ["ABORTED"] + fields[1:6] + ["blake2s_mac", "blake2s_kdf"] + ["00" * 64] * 4 + ["ERROR: Verification of the 1st message failed"]
+        lines.insert(1, " ".join(bad) + "\n")
+        lines.insert(2, "UNKNOWN record\n")
+        success, failed = verify_chunk(1, lines)
+        self.assertEqual(failed, [2, 3])
+        self.assertEqual(success, 3)
+
+if __name__ == "__main__":
+    unittest.main()
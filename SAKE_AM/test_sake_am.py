@@ -0,0 +1,223 @@
+# *****************************************************************************
+# *                                                                           *
+# *                              Suite Tests                                  *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Every suite must complete a handshake, and the suites not bound to the   *
+# *  existing test vectors must derive session keys that depend on the        *
+# *  challenges. The resynchronisation window must accept exactly the gaps    *
+# *  up to W, wipe the keys leaving it, and pooled sessions must behave as    *
+# *  new ones. The keyed-state cache of HMAC must give the MACs of hmac.new.  *
+# *                                                                           *
+# *****************************************************************************
+
+import hashlib
+import hmac
+import os
+import threading
+import unittest
+from unittest import mock
+import sake_am
+from sake_am import *
+
+SHA2_SUITES = ("sha256", "sha384", "sha512")
+
+class SuiteTests(unittest.TestCase):
+
+    def session_keys(self, suite, count=5):
+        MAC_instance, KDF_instance = suite_instances(suite)
+        K, K_prime = os.urandom(MAC_instance.LENGTH), os.urandom(MAC_instance.LENGTH)
+        keys = set()
+        for _ in range(count):
+            initiator = Initiator("Initiator", "Responder", os.urandom(16), 16, K, K_prime, MAC_instance, KDF_instance)
+            responder = Responder("Initiator", "Responder", os.urandom(16), 16, K, K_prime, MAC_instance, KDF_instance)
+            self.assertTrue(SAKE_AM_Procedure(initiator, responder))
+            self.assertEqual(initiator.session_key, responder.session_key)
+            keys.add(initiator.session_key)
+        return keys
+
+    def test_session_keys_depend_on_challenges(self):
+        for suite in SUITES:
+            if suite in SHA2_SUITES:
+                continue
+            with self.subTest(suite=suite):
+                self.assertEqual(len(self.session_keys(suite)), 5)
+
+    def test_sha3_hkdf_is_rfc_5869(self):
+        for KDF_class, hash_function in ((HKDF_SHA3_256, hashlib.sha3_256), (HKDF_SHA3_384, hashlib.sha3_384), (HKDF_SHA3_512, hashlib.sha3_512)):
+            salt, input_key_material = os.urandom(32), os.urandom(40)
+            pseudorandom_key = hmac.new(salt, input_key_material, hash_function).digest()
+            expected = hmac.new(pseudorandom_key, b"Session Key\x01", hash_function).digest()
+            self.assertEqual(KDF_class().derive(salt, input_key_material), expected)
+
+class HMACCacheTests(unittest.TestCase):
+
+    def test_matches_hmac_new(self):
+        for HMAC_class, hash_function in ((HMAC_SHA256, hashlib.sha256), (HMAC_SHA384, hashlib.sha384), (HMAC_SHA512, hashlib.sha512),
+                                         (HMAC_SHA3_256, hashlib.sha3_256), (HMAC_SHA3_384, hashlib.sha3_384), (HMAC_SHA3_512, hashlib.sha3_512)):
+            for cache_size in (HMAC_CACHE_SIZE, 2, 0):
+                MAC_instance = HMAC_class(cache_size=cache_size)
+                # Keys shorter than, as long as and longer than the block
+                for key in (os.urandom(32), bytearray(os.urandom(32)), os.urandom(MAC_instance.block_size), os.urandom(200), b""):
+                    for message in (b"", os.urandom(300), bytearray(os.urandom(40)), memoryview(os.urandom(64))):
+                        expected = hmac.new(bytes(key), bytes(message), hash_function).digest()
+                        with self.subTest(HMAC=HMAC_class.__name__, cache_size=cache_size, key_length=len(key)):
+                            self.assertEqual(MAC_instance.mac(key, message), expected)
+                            self.assertEqual(MAC_instance.mac(key, message), expected)
+                            self.assertTrue(MAC_instance.verify(key, message, expected))
+                self.assertLessEqual(len(MAC_instance.keyed_states), max(cache_size, 0))
+
+    def test_cached_key_is_not_rekeyed(self):
+        MAC_instance = HMAC_SHA256()
+        key = os.urandom(32)
+        with mock.patch.object(sake_am, "hmac_key_blocks", wraps=hmac_key_blocks) as key_blocks:
+            for _ in range(10):
+                MAC_instance.mac(key, os.urandom(16))
+        self.assertEqual(key_blocks.call_count, 1)
+
+    def test_forget(self):
+        MAC_instance = HMAC_SHA256()
+        key = bytearray(os.urandom(32))
+        MAC_instance.mac(key, b"message")
+        self.assertIn(bytes(key), MAC_instance.keyed_states)
+        MAC_instance.forget(key)
+        self.assertNotIn(bytes(key), MAC_instance.keyed_states)
+        MAC_instance.forget(key)
+        self.assertEqual(MAC_instance.mac(key, b"message"), hmac.new(key, b"message", hashlib.sha256).digest())
+
+    def test_lru_eviction(self):
+        MAC_instance = HMAC_SHA256(cache_size=3)
+        keys = [os.urandom(32) for _ in range(4)]
+        for key in keys[:3]:
+            MAC_instance.mac(key, b"message")
+        # Using the oldest key makes keys[1] the least recently used one
+        MAC_instance.mac(keys[0], b"message")
+        MAC_instance.mac(keys[3], b"message")
+        self.assertEqual(list(MAC_instance.keyed_states), [keys[2], keys[0], keys[3]])
+
+    def test_concurrent_use(self):
+        MAC_instance = HMAC_SHA256(cache_size=8)
+        keys = [os.urandom(32) for _ in range(32)]
+        expected = {key: hmac.new(key, b"message", hashlib.sha256).digest() for key in keys}
+        errors = []
+
+        def worker(seed):
+            for i in range(2000):
+                key = keys[(seed * 7 + i) % len(keys)]
+                if MAC_instance.mac(key, b"message") != expected[key]:
+                    errors.append(key)
+                if i % 5 == 0:
+                    MAC_instance.forget(key)
+
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(MAC_instance.keyed_states), 8)
+
+class MACInputTests(unittest.TestCase):
+
+    def test_messages_match_concatenation(self):
+        mac_input = MACInput(b"Initiator", b"Responder")
+        for challenge_length in (16, 16, 128, 0):
+            r_a, r_b = os.urandom(challenge_length), os.urandom(challenge_length)
+            self.assertEqual(bytes(mac_input.message_1(r_a)), b"InitiatorResponder" + r_a)
+            mac_input.set_challenges(r_a, r_b)
+            for sync in (0, 1, 9, 10, 123):
+                self.assertEqual(bytes(mac_input.message_2(sync)), str(sync).encode() + b"ResponderInitiator" + r_b + r_a)
+            self.assertEqual(bytes(mac_input.message_3()), b"InitiatorResponder" + r_a + r_b)
+            self.assertEqual(bytes(mac_input.message_4()), r_b + r_a)
+            self.assertEqual(bytes(mac_input.challenges()), r_a + r_b)
+
+WINDOW_SUITES = ("sha256", "blake2s", "sha3_256")
+
+def key_chain(key, length, KDF_instance):
+    chain = [key]
+    for _ in range(length - 1):
+        chain.append(update_key(chain[-1], KDF_instance))
+    return chain
+
+class WindowTests(unittest.TestCase):
+    # The Responder is at epoch W + 1 with its W previous K_prime keys, and the
+    # Initiator 'gap' epochs behind it (ahead if negative)
+
+    def chains(self, MAC_instance, KDF_instance, window):
+        length = 2 * window + 4
+        return key_chain(os.urandom(MAC_instance.LENGTH), length, KDF_instance), key_chain(os.urandom(MAC_instance.LENGTH), length, KDF_instance)
+
+    def sessions(self, chains, gap, window, MAC_instance, KDF_instance, initiator_pool=None, responder_pool=None):
+        K_chain, K_prime_chain = chains
+        responder_epoch = window + 1
+        initiator_epoch = responder_epoch - gap
+        r_a, r_b = os.urandom(16), os.urandom(16)
+        initiator_args = ("Initiator", "Responder", r_a, 16, K_chain[initiator_epoch], K_prime_chain[initiator_epoch], MAC_instance, KDF_instance)
+        responder_args = ("Initiator", "Responder", r_b, 16, K_chain[responder_epoch], K_prime_chain[responder_epoch], MAC_instance, KDF_instance, window, K_prime_chain[1:responder_epoch])
+        if initiator_pool is None:
+            return Initiator(*initiator_args), Responder(*responder_args)
+        return initiator_pool.acquire(*initiator_args), responder_pool.acquire(*responder_args)
+
+    def outcome(self, initiator, responder):
+        completed = SAKE_AM_Procedure(initiator, responder)
+        return (completed, initiator.ERROR or responder.ERROR, initiator.session_key, responder.session_key,
+                bytes(initiator.K), bytes(initiator.K_prime), bytes(responder.K), bytes(responder.K_j_prime), responder.gap)
+
+    def test_gaps_of_the_window(self):
+        for suite in WINDOW_SUITES:
+            MAC_instance, KDF_instance = suite_instances(suite)
+            for window in (1, 3):
+                chains = self.chains(MAC_instance, KDF_instance, window)
+                for gap in range(-window - 1, window + 2):
+                    with self.subTest(suite=suite, window=window, gap=gap):
+                        completed, error, initiator_key, responder_key, iK, iK_prime, rK, rK_prime, accepted = self.outcome(*self.sessions(chains, gap, window, MAC_instance, KDF_instance))
+                        if abs(gap) > window:
+                            self.assertFalse(completed)
+                            self.assertEqual(error, "ERROR: Verification of the 1st message failed")
+                            continue
+                        self.assertTrue(completed)
+                        self.assertEqual(accepted, gap)
+                        self.assertEqual(initiator_key, responder_key)
+                        # Both end one epoch after the most advanced of them
+                        epoch = window + 1 + max(0, -gap) + 1
+                        self.assertEqual((iK, iK_prime), (chains[0][epoch], chains[1][epoch]))
+                        self.assertEqual((rK, rK_prime), (chains[0][epoch], chains[1][epoch]))
+
+    def test_retired_keys_are_wiped(self):
+        MAC_instance, KDF_instance = suite_instances("sha256")
+        window = 2
+        chains = self.chains(MAC_instance, KDF_instance, window)
+        initiator, responder = self.sessions(chains, 0, window, MAC_instance, KDF_instance)
+        oldest = responder.ring.past[0]
+        self.assertEqual(bytes(oldest), chains[1][1])
+        self.assertTrue(SAKE_AM_Procedure(initiator, responder))
+        self.assertEqual(oldest, bytearray(len(oldest)))
+        self.assertNotIn(chains[1][1], [bytes(key) for key in responder.ring.keys()])
+
+        keys = responder.ring.keys() + [responder.K]
+        responder.close()
+        initiator_keys = [initiator.K, initiator.K_prime]
+        initiator.close()
+        for key in keys + initiator_keys:
+            self.assertEqual(key, bytearray(len(key)))
+
+    def test_pooled_sessions_match_new_ones(self):
+        for suite in WINDOW_SUITES:
+            MAC_instance, KDF_instance = suite_instances(suite)
+            window = 2
+            initiator_pool, responder_pool = SessionPool(Initiator), SessionPool(Responder)
+            chains = self.chains(MAC_instance, KDF_instance, window)
+            # The pools are reused across every gap, failures included
+            for gap in list(range(-window - 1, window + 2)) * 2:
+                with self.subTest(suite=suite, gap=gap):
+                    pooled = self.sessions(chains, gap, window, MAC_instance, KDF_instance, initiator_pool, responder_pool)
+                    new = self.sessions(chains, gap, window, MAC_instance, KDF_instance)
+                    for initiator, responder in (pooled, new):
+                        initiator.r_a, responder.r_b = pooled[0].r_a, pooled[1].r_b
+                    self.assertEqual(self.outcome(*pooled), self.outcome(*new))
+                    initiator_pool.release(pooled[0])
+                    responder_pool.release(pooled[1])
+            self.assertEqual((len(initiator_pool.free), len(responder_pool.free)), (1, 1))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+# *****************************************************************************
+# *                                                                           *
+# *                     Batch API against SAKE_AM_Procedure                   *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Fuzz test of sake_batch.run_handshakes: random key states (in sync,      *
+# *  1 to 3 epochs apart, corrupted keys, previous K_prime and last gap) are  *
+# *  run by the batch API and by Initiator/Responder objects, and every row   *
+# *  must give the same outcome, error, session keys and final keys. A weak   *
+# *  MAC with 1-byte tags makes some forged tags pass, so that the failure    *
+# *  of every message is reached.                                             *
+# *                                                                           *
+# *****************************************************************************
+
+import hashlib
+import random
+import unittest
+from sake_am import *
+from sake_batch import run_handshakes
+
+class WEAK_MAC(MAC):
+    def __init__(self):
+        super().__init__("weak_mac", 32)
+
+    def mac(self, key, message):
+        return hashlib.sha256(bytes(key[:1]) + bytes(message)).digest()[:1]
+
+class WEAK_KDF(KDF):
+    def __init__(self):
+        super().__init__("weak_kdf")
+
+    def derive(self, salt, input_key_material):
+        # A third of the keys share their first byte, which is all WEAK_MAC uses
+        return bytes([hashlib.sha256(salt).digest()[0] % 3]) + hashlib.sha256(bytes(salt) + b"x").digest()[1:]
+
+def random_rows(MAC_instance, KDF_instance, count, challenge_size, rng):
+    length = MAC_instance.LENGTH
+    rows = []
+    for i in range(count):
+        chain = [(rng.randbytes(length), rng.randbytes(length))]
+        for _ in range(3):
+            chain.append((update_key(chain[-1][0], KDF_instance), update_key(chain[-1][1], KDF_instance)))
+        iK, iK_prime = chain[rng.randrange(4)]
+        epoch = rng.randrange(4)
+        rK, rK_prime = chain[epoch]
+        corrupted = rng.randrange(8)
+        if corrupted == 1:
+            iK = rng.randbytes(length)
+        elif corrupted == 2:
+            rK = rng.randbytes(length)
+        elif corrupted == 3:
+            iK_prime = rng.randbytes(length)
+        past = chain[epoch - 1][1] if epoch > 0 and rng.random() < 0.7 else None
+        last_gap = rng.choice([None, 0, 1, -1, 2])
+        rows.append((f"Initiator-{i % 5}", rng.randbytes(challenge_size), rng.randbytes(challenge_size), iK, iK_prime, rK, rK_prime, past, last_gap))
+    return rows
+
+class BatchAgainstProcedure(unittest.TestCase):
+
+    def check(self, MAC_instance, KDF_instance, count, challenge_size=16, seed=0):
+        rng = random.Random(seed)
+        rows = random_rows(MAC_instance, KDF_instance, count, challenge_size, rng)
+        columns = list(zip(*rows))
+        result = run_handshakes(MAC_instance, KDF_instance, list(columns[0]), "Responder", challenge_size,
+                                b"".join(columns[1]), b"".join(columns[2]), b"".join(columns[3]), b"".join(columns[4]),
+                                b"".join(columns[5]), b"".join(columns[6]), list(columns[7]), list(columns[8]))
+
+        length = MAC_instance.LENGTH
+        errors = set()
+        for i, (id_a, r_a, r_b, iK, iK_prime, rK, rK_prime, past, last_gap) in enumerate(rows):
+            initiator = Initiator(id_a, "Responder", r_a, challenge_size, iK, iK_prime, MAC_instance, KDF_instance)
+            responder = Responder(id_a, "Responder", r_b, challenge_size, rK, rK_prime, MAC_instance, KDF_instance, K_prime_past=[past] if past else (), last_gap=last_gap)
+            completed = SAKE_AM_Procedure(initiator, responder)
+            error = initiator.ERROR or responder.ERROR
+            errors.add(error)
+            keys = slice(i * length, (i + 1) * length)
+            self.assertEqual(result.completed(i), completed, i)
+            self.assertEqual(result.error(i), error, i)
+            self.assertEqual(result.initiator_session_key[i], initiator.session_key, i)
+            self.assertEqual(result.responder_session_key[i], responder.session_key, i)
+            self.assertEqual(bytes(result.iK[keys]), bytes(initiator.K), i)
+            self.assertEqual(bytes(result.iK_prime[keys]), bytes(initiator.K_prime), i)
+            self.assertEqual(bytes(result.rK[keys]), bytes(responder.K), i)
+            self.assertEqual(bytes(result.rK_prime[keys]), bytes(responder.K_j_prime), i)
+            self.assertEqual(result.rK_prime_past[i], responder.ring.before(1), i)
+            self.assertEqual(result.gap[i], responder.gap, i)
+        return errors
+
+    def test_sha2_suites(self):
+        for suite in ("sha256", "sha512"):
+            with self.subTest(suite=suite):
+                self.check(*suite_instances(suite), 500)
+
+    def test_other_suites(self):
+        for suite in ("sha3_256", "blake2s"):
+            with self.subTest(suite=suite):
+                self.check(*suite_instances(suite), 200)
+
+    def test_every_message_can_fail(self):
+        errors = self.check(WEAK_MAC(), WEAK_KDF(), 5000)
+        for message in ("1st", "2nd", "3rd", "4th"):
+            self.assertIn(f"ERROR: Verification of the {message} message failed", errors)
+        self.assertIn(None, errors)
+
+if __name__ == "__main__":
+    unittest.main()
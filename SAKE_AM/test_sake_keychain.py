@@ -0,0 +1,91 @@
+# *****************************************************************************
+# *                                                                           *
+# *                             Key Chain Tests                               *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Every key of the key chain engine must match the one obtained calling    *
+# *  'update_key' epoch after epoch, for the HKDF shortcut and the other      *
+# *  suites, and dropping checkpoints must not change any key still reached.  *
+# *                                                                           *
+# *****************************************************************************
+
+import os
+import unittest
+from sake_am import *
+from sake_keychain import *
+
+SUITES_TESTED = ("sha256", "sha512", "sha3_256", "blake2s")
+
+def reference_chain(K, K_prime, epochs, KDF_instance):
+    chain = [(K, K_prime)]
+    for _ in range(epochs):
+        K, K_prime = update_key(K, KDF_instance), update_key(K_prime, KDF_instance)
+        chain.append((K, K_prime))
+    return chain
+
+class KeyChainTests(unittest.TestCase):
+
+    def suites(self):
+        for suite in SUITES_TESTED:
+            MAC_instance, KDF_instance = suite_instances(suite)
+            K, K_prime = os.urandom(MAC_instance.LENGTH), os.urandom(MAC_instance.LENGTH)
+            yield suite, KDF_instance, K, K_prime, reference_chain(K, K_prime, 40, KDF_instance)
+
+    def test_fast_forward(self):
+        for suite, KDF_instance, K, K_prime, chain in self.suites():
+            with self.subTest(suite=suite):
+                for epochs in (0, 1, 7, 40):
+                    self.assertEqual(fast_forward(K, epochs, KDF_instance), chain[epochs][0])
+                    self.assertEqual(fast_forward(K_prime, epochs, KDF_instance), chain[epochs][1])
+
+    def test_advance_chains(self):
+        for suite, KDF_instance, K, K_prime, chain in self.suites():
+            with self.subTest(suite=suite):
+                self.assertEqual(advance_chains([(K, K_prime)] * 2, 5, KDF_instance), [chain[5]] * 2)
+                self.assertEqual(advance_chains([(K, K_prime)] * 3, [0, 3, 40], KDF_instance), [chain[0], chain[3], chain[40]])
+
+    def test_advance_chains_needs_one_number_per_chain(self):
+        KDF_instance = suite_instances("sha256")[1]
+        chains = [(os.urandom(32), os.urandom(32))] * 3
+        for epochs in ([1, 2], [1, 2, 3, 4]):
+            with self.assertRaises(ValueError):
+                advance_chains(chains, epochs, KDF_instance)
+
+    def test_keys_at(self):
+        for suite, KDF_instance, K, K_prime, chain in self.suites():
+            with self.subTest(suite=suite):
+                key_chain = KeyChain(K, K_prime, KDF_instance, checkpoint_interval=8)
+                for epoch in (40, 3, 17, 0, 39):
+                    self.assertEqual(key_chain.keys_at(epoch), chain[epoch])
+                self.assertEqual(key_chain.checkpoint_epochs, [0, 8, 16, 24, 32, 40])
+                self.assertEqual([(epoch, K, K_prime) for epoch, K, K_prime in key_chain.iter_keys(5, 12)],
+                                 [(epoch,) + chain[epoch] for epoch in range(5, 13)])
+
+    def test_resync(self):
+        for suite, KDF_instance, K, K_prime, chain in self.suites():
+            with self.subTest(suite=suite):
+                key_chain = KeyChain(K, K_prime, KDF_instance, checkpoint_interval=8)
+                # A device that drifted 3 epochs ahead and one 2 behind
+                self.assertEqual(key_chain.resync(chain[23][1], 20, 4), (23,) + chain[23])
+                self.assertEqual(key_chain.resync(chain[18][1], 20, 4), (18,) + chain[18])
+                self.assertIsNone(key_chain.resync(chain[30][1], 20, 4))
+                self.assertIsNone(key_chain.resync(os.urandom(len(K)), 20, 4))
+
+    def test_forget_before(self):
+        for suite, KDF_instance, K, K_prime, chain in self.suites():
+            with self.subTest(suite=suite):
+                key_chain = KeyChain(K, K_prime, KDF_instance, checkpoint_interval=8)
+                key_chain.keys_at(40)
+                key_chain.forget_before(20)
+                # The checkpoint of epoch 16 is kept to reach epoch 20
+                self.assertEqual(key_chain.checkpoint_epochs, [16, 24, 32, 40])
+                self.assertEqual(sorted(key_chain.checkpoints), [16, 24, 32, 40])
+                for epoch in (16, 20, 33, 40):
+                    self.assertEqual(key_chain.keys_at(epoch), chain[epoch])
+                self.assertEqual(key_chain.resync(chain[21][1], 20, 2), (21,) + chain[21])
+                with self.assertRaises(ValueError):
+                    key_chain.keys_at(15)
+                self.assertNotIn(chain[0], list(key_chain.checkpoints.values()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+# *****************************************************************************
+# *                                                                           *
+# *                            Instrumentation Tests                          *
+# *                                                                           *
+# *  Description:                                                             *
+# *  The counters of CountingMAC and CountingKDF over a single handshake, the *
+# *  events the entities send to the sink, and the text rendered by           *
+# *  PrometheusSink.                                                          *
+# *                                                                           *
+# *****************************************************************************
+
+import io
+import json
+import os
+import unittest
+from sake_am import *
+from sake_metrics import *
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.MAC_instance, self.KDF_instance = suite_instances("sha256")
+        self.K, self.K_prime = os.urandom(32), os.urandom(32)
+
+    def handshake(self, initiator_keys, sink=None):
+        instrumentation = Instrumentation(sink)
+        initiator = Initiator("Initiator", "Responder", os.urandom(16), 16, *initiator_keys, self.MAC_instance, self.KDF_instance, instrumentation=instrumentation)
+        responder = Responder("Initiator", "Responder", os.urandom(16), 16, self.K, self.K_prime, self.MAC_instance, self.KDF_instance, instrumentation=instrumentation)
+        return SAKE_AM_Procedure(initiator, responder, instrumentation), instrumentation
+
+    def test_counting_wrappers(self):
+        instrumentation = Instrumentation()
+        MAC_instance = instrumentation.wrap_mac(self.MAC_instance)
+        KDF_instance = instrumentation.wrap_kdf(self.KDF_instance)
+        tag = MAC_instance.mac(self.K, b"message")
+        self.assertEqual(tag, self.MAC_instance.mac(self.K, b"message"))
+        self.assertTrue(MAC_instance.verify(self.K, b"message", tag))
+        self.assertEqual(update_key(self.K, KDF_instance), update_key(self.K, self.KDF_instance))
+        # Vrfy recomputes the tag, so it counts as a MAC too
+        self.assertEqual(instrumentation.counters, {"mac": 2, "vrfy": 1, "kdf": 1})
+
+    def test_counters_of_a_handshake(self):
+        completed, instrumentation = self.handshake((self.K, self.K_prime))
+        self.assertTrue(completed)
+        # One MAC and one Vrfy for each of the 4 messages, a session key and the
+        # update of K and K_prime on each side, and one evolve on each side
+        self.assertEqual(instrumentation.counters, {"mac": 8, "vrfy": 4, "kdf": 6, "evolve": 2})
+
+    def test_events_of_a_handshake(self):
+        completed, instrumentation = self.handshake((self.K, self.K_prime))
+        self.assertTrue(completed)
+        sync, handshake = instrumentation.sink.events
+        self.assertEqual(sync, {"event": "sync", "gap": 0, "sync": 0, "attempts": 1})
+        self.assertEqual(handshake["event"], "handshake")
+        self.assertTrue(handshake["completed"])
+        self.assertEqual(handshake["counters"], instrumentation.counters)
+        self.assertEqual(sorted(handshake["phases"]), ["phase_1", "phase_2", "phase_3", "phase_4"])
+        self.assertTrue(all(seconds >= 0 for seconds in handshake["phases"].values()))
+
+    def test_events_of_a_resynchronisation(self):
+        # The Initiator is one epoch ahead: K_prime must be evolved once more
+        # before the 1st message verifies
+        ahead = (update_key(self.K, self.KDF_instance), update_key(self.K_prime, self.KDF_instance))
+        completed, instrumentation = self.handshake(ahead)
+        self.assertTrue(completed)
+        self.assertEqual(instrumentation.sink.events[0], {"event": "sync", "gap": -1, "sync": 0, "attempts": 2})
+
+    def test_events_of_an_abort(self):
+        completed, instrumentation = self.handshake((self.K, os.urandom(32)))
+        self.assertFalse(completed)
+        abort, handshake = instrumentation.sink.events
+        self.assertEqual(abort, {"event": "abort", "reason": "ERROR: Verification of the 1st message failed"})
+        self.assertEqual((handshake["event"], handshake["completed"]), ("handshake", False))
+        self.assertEqual(list(handshake["phases"]), ["phase_1"])
+
+    def test_json_lines_sink(self):
+        file = io.StringIO()
+        self.handshake((self.K, self.K_prime), JSONLinesSink(file))
+        events = [json.loads(line) for line in file.getvalue().splitlines()]
+        self.assertEqual([event["event"] for event in events], ["sync", "handshake"])
+
+    def test_prometheus_sink(self):
+        sink = PrometheusSink()
+        sink.emit({"event": "sync", "gap": 0, "sync": 0, "attempts": 1})
+        sink.emit({"event": "handshake", "completed": True, "counters": {"mac": 8, "kdf": 6}, "phases": {"phase_1": 0.5}})
+        sink.emit({"event": "abort", "reason": 'ERROR: "bad"\n'})
+        sink.emit({"event": "handshake", "completed": False, "counters": {"mac": 1}, "phases": {"phase_1": 0.25}})
+        self.assertEqual(sink.render().splitlines(), [
+            "# HELP sake_operations_total MAC, Vrfy, KDF and evolve operations",
+            "# TYPE sake_operations_total counter",
+            'sake_operations_total{operation="kdf"} 6',
+            'sake_operations_total{operation="mac"} 9',
+            "# HELP sake_handshakes_total Handshakes by outcome",
+            "# TYPE sake_handshakes_total counter",
+            'sake_handshakes_total{outcome="aborted"} 1',
+            'sake_handshakes_total{outcome="completed"} 1',
+            "# HELP sake_accepted_gap_total Accepted 1st messages by gap",
+            "# TYPE sake_accepted_gap_total counter",
+            'sake_accepted_gap_total{gap="0"} 1',
+            "# HELP sake_vrfy_attempts_total Accepted 1st messages by MAC attempts needed",
+            "# TYPE sake_vrfy_attempts_total counter",
+            'sake_vrfy_attempts_total{attempts="1"} 1',
+            "# HELP sake_aborts_total Aborted handshakes by reason",
+            "# TYPE sake_aborts_total counter",
+            'sake_aborts_total{reason="ERROR: \\"bad\\"\\n"} 1',
+            "# HELP sake_phase_seconds Time spent in each phase of the handshake",
+            "# TYPE sake_phase_seconds summary",
+            'sake_phase_seconds_sum{phase="phase_1"} 0.75',
+            'sake_phase_seconds_count{phase="phase_1"} 2',
+        ])
+
+    def test_prometheus_sink_of_handshakes(self):
+        sink = PrometheusSink(prefix="test")
+        for _ in range(3):
+            completed, instrumentation = self.handshake((self.K, self.K_prime), sink)
+            self.assertTrue(completed)
+            self.K, self.K_prime = update_key(self.K, self.KDF_instance), update_key(self.K_prime, self.KDF_instance)
+        text = sink.render()
+        self.assertIn('test_operations_total{operation="mac"} 24\n', text)
+        self.assertIn('test_handshakes_total{outcome="completed"} 3\n', text)
+        self.assertIn('test_phase_seconds_count{phase="phase_4"} 3\n', text)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+# *****************************************************************************
+# *                                                                           *
+# *                            Replay Guard Tests                             *
+# *                                                                           *
+# *  Description:                                                             *
+# *  A replayed 1st message must be rejected and a fresh one accepted, the    *
+# *  filters must rotate with the period and when full, and the rate of       *
+# *  false positives must stay within the configured one.                     *
+# *                                                                           *
+# *****************************************************************************
+
+import math
+import os
+import unittest
+from sake_am import *
+from sake_replay import *
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class ReplayTests(unittest.TestCase):
+
+    def setUp(self):
+        self.MAC_instance, self.KDF_instance = suite_instances("sha256")
+        self.K, self.K_prime = os.urandom(32), os.urandom(32)
+
+    def responder(self, guard):
+        return Responder("Initiator", "Responder", os.urandom(16), 16, self.K, self.K_prime, self.MAC_instance, self.KDF_instance, replay_guard=guard)
+
+    def test_replayed_message_is_rejected(self):
+        guard = ReplayGuard(capacity=100)
+        initiator = Initiator("Initiator", "Responder", os.urandom(16), 16, self.K, self.K_prime, self.MAC_instance, self.KDF_instance)
+        initiator.start_session()
+        message_1 = (initiator.id_a, initiator.r_a, initiator.tag_a)
+        self.assertIsNotNone(self.responder(guard).receive_1st_message(*message_1))
+
+        responder = self.responder(guard)
+        self.assertIsNone(responder.receive_1st_message(*message_1))
+        self.assertEqual(responder.ERROR, "ERROR: Replayed 1st message")
+        self.assertEqual(guard.stats()["hits"], 1)
+
+    def test_fresh_message_is_accepted(self):
+        guard = ReplayGuard(capacity=100)
+        for _ in range(20):
+            initiator = Initiator("Initiator", "Responder", os.urandom(16), 16, self.K, self.K_prime, self.MAC_instance, self.KDF_instance)
+            responder = self.responder(guard)
+            self.assertTrue(SAKE_AM_Procedure(initiator, responder))
+            self.K, self.K_prime = bytes(initiator.K), bytes(initiator.K_prime)
+        self.assertEqual(guard.stats()["insertions"], 20)
+
+    def test_forged_message_is_not_recorded(self):
+        guard = ReplayGuard(capacity=100)
+        r_a = os.urandom(16)
+        self.assertIsNone(self.responder(guard).receive_1st_message("Initiator", r_a, os.urandom(32)))
+        self.assertFalse(guard.seen("Initiator", r_a))
+
+    def test_generations_rotate_after_period(self):
+        clock = Clock()
+        guard = ReplayGuard(capacity=100, generations=2, period=10.0, clock=clock)
+        guard.add("Initiator", b"r_a")
+        clock.now = 9.0
+        self.assertTrue(guard.seen("Initiator", b"r_a"))
+        # Still remembered for one period in the older filter
+        clock.now = 10.0
+        self.assertTrue(guard.seen("Initiator", b"r_a"))
+        self.assertEqual(guard.stats()["rotations"], 1)
+        clock.now = 20.0
+        self.assertFalse(guard.seen("Initiator", b"r_a"))
+        self.assertEqual(guard.stats()["rotations"], 2)
+
+    def test_generations_rotate_when_full(self):
+        guard = ReplayGuard(capacity=10, generations=3)
+        for i in range(30):
+            guard.add("Initiator", i.to_bytes(4, "big"))
+        self.assertEqual(guard.stats()["rotations"], 2)
+        self.assertTrue(all(guard.seen("Initiator", i.to_bytes(4, "big")) for i in range(30)))
+        guard.add("Initiator", b"next")
+        self.assertFalse(any(guard.seen("Initiator", i.to_bytes(4, "big")) for i in range(10)))
+
+    def test_false_positive_rate(self):
+        target = 0.01
+        guard = ReplayGuard(capacity=20000, false_positive_rate=target, generations=2)
+        for i in range(40000):
+            guard.add("Initiator", i.to_bytes(8, "big"))
+        trials = 50000
+        positives = sum(guard.seen("Other", os.urandom(16)) for _ in range(trials))
+        estimate = guard.false_positive_rate()
+        self.assertLessEqual(estimate, target)
+        # Within 5 standard deviations of the estimate of the filters
+        margin = 5 * math.sqrt(trials * estimate * (1 - estimate)) + 5
+        self.assertLess(abs(positives - trials * estimate), margin)
+        self.assertLessEqual(positives / trials, 1.5 * target)
+
+    def test_invalid_parameters(self):
+        for kwargs in ({"capacity": 0}, {"generations": 1}, {"false_positive_rate": 0}, {"false_positive_rate": 1}):
+            with self.assertRaises(ValueError):
+                ReplayGuard(**kwargs)
+
+if __name__ == "__main__":
+    unittest.main()
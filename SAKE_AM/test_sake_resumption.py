@@ -0,0 +1,89 @@
+# *****************************************************************************
+# *                                                                           *
+# *                          Session Resumption Tests                         *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Tickets must be single use, bounded in size and lifetime, and neither    *
+# *  ticket secrets nor session keys may be left in the keyed states cached   *
+# *  by HMAC.                                                                 *
+# *                                                                           *
+# *****************************************************************************
+
+import os
+import unittest
+from sake_am import *
+from sake_resumption import *
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class ResumptionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.MAC_instance, self.KDF_instance = suite_instances("sha256")
+        self.clock = Clock()
+        self.tickets = TicketCache(size=4, ttl=60.0, clock=self.clock)
+
+    def complete_handshake(self, id_a="Initiator"):
+        K, K_prime = os.urandom(32), os.urandom(32)
+        initiator = Initiator(id_a, "Responder", os.urandom(16), 16, K, K_prime, self.MAC_instance, self.KDF_instance)
+        responder = Responder(id_a, "Responder", os.urandom(16), 16, K, K_prime, self.MAC_instance, self.KDF_instance)
+        self.assertTrue(SAKE_AM_Procedure(initiator, responder))
+        ticket_id = self.tickets.issue(id_a, self.MAC_instance, responder.session_key)
+        return Ticket.from_session(initiator, ticket_id)
+
+    def resume(self, ticket, id_a="Initiator"):
+        initiator = ResumptionInitiator(id_a, ticket, os.urandom(16), self.MAC_instance)
+        responder = ResumptionResponder("Responder", os.urandom(16), self.MAC_instance, self.tickets)
+        return Resumption_Procedure(initiator, responder), initiator, responder
+
+    def test_resumption_derives_fresh_keys(self):
+        ticket = self.complete_handshake()
+        keys = set()
+        for _ in range(3):
+            completed, initiator, responder = self.resume(ticket)
+            self.assertTrue(completed)
+            self.assertEqual(initiator.session_key, responder.session_key)
+            keys.add(initiator.session_key)
+            ticket = initiator.ticket
+        self.assertEqual(len(keys), 3)
+
+    def test_ticket_is_single_use(self):
+        ticket = self.complete_handshake()
+        self.assertTrue(self.resume(ticket)[0])
+        completed, initiator, responder = self.resume(ticket)
+        self.assertFalse(completed)
+        self.assertEqual(responder.ERROR, "ERROR: Unknown or expired ticket")
+
+    def test_forged_tag_keeps_ticket(self):
+        ticket = self.complete_handshake()
+        forged = Ticket(ticket.id_b, ticket.ticket_id, os.urandom(len(ticket.secret)))
+        self.assertFalse(self.resume(forged)[0])
+        self.assertTrue(self.resume(ticket)[0])
+
+    def test_expired_and_evicted_tickets(self):
+        ticket = self.complete_handshake()
+        self.clock.now = 61.0
+        self.assertFalse(self.resume(ticket)[0])
+        self.assertEqual(self.tickets.stats()["expired"], 1)
+
+        tickets = [self.complete_handshake(f"Initiator-{i}") for i in range(5)]
+        self.assertEqual(len(self.tickets), 4)
+        self.assertFalse(self.resume(tickets[0], "Initiator-0")[0])
+        self.assertTrue(self.resume(tickets[4], "Initiator-4")[0])
+
+    def test_secrets_are_not_cached(self):
+        self.MAC_instance.clear_cache()
+        ticket = self.complete_handshake()
+        completed, initiator, responder = self.resume(ticket)
+        self.assertTrue(completed)
+        cached = set(self.MAC_instance.keyed_states)
+        for secret in (ticket.secret, initiator.ticket.secret, initiator.session_key):
+            self.assertNotIn(bytes(secret), cached)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,214 @@
+# *****************************************************************************
+# *                                                                           *
+# *                              Sans-IO API Tests                            *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Handshakes driven through InitiatorConnection and ResponderConnection,   *
+# *  and the pre-derivation of the keys of the next epoch by KeyPrefetcher,   *
+# *  alone and behind the instrumentation of sake_metrics.py.                 *
+# *                                                                           *
+# *****************************************************************************
+
+import os
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from sake_am import *
+from sake_metrics import Instrumentation
+from sake_sansio import *
+
+class Peer:
+    # Key state of one Initiator as stored by the Responder and held by itself
+
+    def __init__(self, MAC_instance, initiator_kdf, responder_kdf, instrumented=False):
+        self.MAC_instance = MAC_instance
+        self.initiator_kdf = initiator_kdf
+        self.responder_kdf = responder_kdf
+        self.instrumented = instrumented
+        self.initiator_keys = self.responder_keys = (os.urandom(MAC_instance.LENGTH), os.urandom(MAC_instance.LENGTH))
+        self.responder_past = []
+        self.commits = 0
+
+    def instrumentation(self):
+        return Instrumentation() if self.instrumented else None
+
+    def load(self, id_a):
+        if id_a != "Initiator":
+            raise KeyError(id_a)
+        return Responder(id_a, "Responder", os.urandom(16), 16, *self.responder_keys, self.MAC_instance, self.responder_kdf,
+                         K_prime_past=self.responder_past, instrumentation=self.instrumentation())
+
+    def commit(self, responder):
+        self.responder_keys = (bytes(responder.K), bytes(responder.K_j_prime))
+        self.responder_past = [bytes(key) for key in responder.ring.past]
+        self.commits += 1
+
+    def connections(self):
+        initiator = Initiator("Initiator", "Responder", os.urandom(16), 16, *self.initiator_keys, self.MAC_instance, self.initiator_kdf, instrumentation=self.instrumentation())
+        return InitiatorConnection(initiator), ResponderConnection(self.load, self.commit)
+
+    def handshake(self, messages=2):
+        # Runs up to 'messages' round trips and returns the events of both sides
+        initiator_connection, responder_connection = self.connections()
+        initiator_connection.start()
+        events = []
+        for _ in range(messages):
+            events += responder_connection.receive_data(initiator_connection.data_to_send())
+            events += initiator_connection.receive_data(responder_connection.data_to_send())
+        initiator = initiator_connection.initiator
+        if initiator_connection.closed and initiator.ERROR is None:
+            self.initiator_keys = (bytes(initiator.K), bytes(initiator.K_prime))
+        initiator.close()
+        responder_connection.close()
+        return events
+
+class PrefetchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.MAC_instance, self.KDF_instance = suite_instances("sha256")
+
+    def test_prefetch_behind_instrumentation(self):
+        initiator_prefetcher, responder_prefetcher = KeyPrefetcher(self.KDF_instance), KeyPrefetcher(self.KDF_instance)
+        peer = Peer(self.MAC_instance, initiator_prefetcher, responder_prefetcher, instrumented=True)
+        self.assertIs(find_prefetcher(Instrumentation().wrap_kdf(responder_prefetcher)), responder_prefetcher)
+
+        for _ in range(3):
+            events = peer.handshake()
+            self.assertEqual([type(event) for event in events], [HandshakeCompleted, HandshakeCompleted])
+            self.assertEqual(events[0].session_key, events[1].session_key)
+            self.assertEqual(responder_prefetcher.pending(), 2)
+            self.assertEqual(initiator_prefetcher.pending(), 2)
+            initiator_prefetcher.idle()
+            responder_prefetcher.idle()
+        # Only the first handshake had to derive its key updates
+        self.assertEqual(responder_prefetcher.stats()["hits"], 4)
+        self.assertEqual(initiator_prefetcher.stats()["hits"], 4)
+        self.assertEqual(peer.initiator_keys, peer.responder_keys)
+
+    def test_hits_and_misses(self):
+        prefetcher = KeyPrefetcher(self.KDF_instance)
+        key, other = os.urandom(32), os.urandom(32)
+        prefetcher.prefetch(key)
+        # Not derived yet: the KDF is used
+        self.assertEqual(prefetcher.derive(key, KEY_UPDATE), update_key(key, self.KDF_instance))
+        prefetcher.prefetch(key)
+        prefetcher.idle()
+        self.assertEqual(prefetcher.derive(key, KEY_UPDATE), update_key(key, self.KDF_instance))
+        # Used once, and other derivations are not prefetched
+        self.assertEqual(prefetcher.derive(key, KEY_UPDATE), update_key(key, self.KDF_instance))
+        self.assertEqual(prefetcher.derive(other, b"Session Key"), self.KDF_instance.derive(other, b"Session Key"))
+        self.assertEqual(prefetcher.stats(), {"hits": 1, "misses": 2, "keys": 0, "queued": 0})
+
+    def test_idle_budget(self):
+        prefetcher = KeyPrefetcher(self.KDF_instance)
+        keys = [os.urandom(32) for _ in range(5)]
+        prefetcher.prefetch(*keys)
+        self.assertEqual(prefetcher.idle(2), 2)
+        self.assertEqual(prefetcher.pending(), 3)
+        self.assertEqual(prefetcher.idle(), 3)
+        self.assertEqual(prefetcher.idle(), 0)
+        for key in keys:
+            self.assertEqual(prefetcher.derive(key, KEY_UPDATE), update_key(key, self.KDF_instance))
+        self.assertEqual(prefetcher.stats()["hits"], 5)
+
+    def test_unfinished_future_is_not_waited_for(self):
+        release = threading.Event()
+
+        class SlowKDF:
+            identifier = self.KDF_instance.identifier
+
+            def derive(kdf, salt, input_key_material):
+                release.wait(5)
+                return self.KDF_instance.derive(salt, input_key_material)
+
+        with ThreadPoolExecutor(1) as executor:
+            prefetcher = KeyPrefetcher(SlowKDF(), executor)
+            key = os.urandom(32)
+            prefetcher.prefetch(key)
+            future = prefetcher.ready[key_digest(key)][2]
+            release_later = threading.Timer(0.05, release.set)
+            release_later.start()
+            # Derived again while the executor is still on it
+            self.assertEqual(prefetcher.derive(key, KEY_UPDATE), update_key(key, self.KDF_instance))
+            self.assertEqual(prefetcher.stats()["misses"], 1)
+            updated = future.result(5)
+            release_later.join()
+        # The key the executor produced late is zeroed
+        self.assertEqual(updated, bytearray(len(updated)))
+
+    def test_finished_future_is_used(self):
+        with ThreadPoolExecutor(1) as executor:
+            prefetcher = KeyPrefetcher(self.KDF_instance, executor)
+            key = os.urandom(32)
+            prefetcher.prefetch(key)
+            updated = prefetcher.ready[key_digest(key)][2].result(5)
+            self.assertEqual(prefetcher.derive(key, KEY_UPDATE), update_key(key, self.KDF_instance))
+        self.assertEqual(prefetcher.stats()["hits"], 1)
+        self.assertEqual(updated, bytearray(len(updated)))
+
+    def test_evicted_and_discarded_keys_are_wiped(self):
+        prefetcher = KeyPrefetcher(self.KDF_instance, size=2)
+        keys = [os.urandom(32) for _ in range(3)]
+        prefetcher.prefetch(keys[0], peer="A")
+        prefetcher.idle()
+        oldest = prefetcher.ready[key_digest(keys[0])][2]
+        prefetcher.prefetch(keys[1], keys[2], peer="B")
+        self.assertEqual(oldest, bytearray(len(oldest)))
+        self.assertNotIn(key_digest(keys[0]), prefetcher.ready)
+        self.assertNotIn("A", prefetcher.peers)
+
+        prefetcher.idle()
+        updated = [prefetcher.ready[key_digest(key)][2] for key in keys[1:]]
+        prefetcher.discard("B")
+        self.assertEqual(prefetcher.ready, {})
+        self.assertEqual(prefetcher.peers, {})
+        for key in updated:
+            self.assertEqual(key, bytearray(len(key)))
+
+    def test_prefetch_replaces_the_keys_of_the_peer(self):
+        prefetcher = KeyPrefetcher(self.KDF_instance)
+        old, new = os.urandom(32), os.urandom(32)
+        prefetcher.prefetch(old, peer="A")
+        prefetcher.prefetch(new, peer="A")
+        self.assertEqual(list(prefetcher.ready), [key_digest(new)])
+
+    def test_failed_connection(self):
+        prefetcher = KeyPrefetcher(self.KDF_instance)
+        peer = Peer(self.MAC_instance, self.KDF_instance, prefetcher)
+        peer.handshake()
+        prefetcher.idle()
+        self.assertEqual(len(prefetcher.ready), 2)
+
+        # A forged 1st message commits nothing. Trying gap -1 used the update of
+        # K_prime, and the one of K is kept for the next handshake.
+        connection = ResponderConnection(peer.load, peer.commit)
+        events = connection.receive_data(encode_message(MESSAGE_1, b"Initiator", os.urandom(16), os.urandom(32)))
+        self.assertEqual([type(event) for event in events], [HandshakeFailed])
+        self.assertEqual((peer.commits, len(prefetcher.ready)), (2, 1))
+
+        events = peer.handshake()
+        self.assertEqual([type(event) for event in events], [HandshakeCompleted, HandshakeCompleted])
+        self.assertEqual(prefetcher.stats()["hits"], 2)
+
+    def test_dropped_connection(self):
+        prefetcher = KeyPrefetcher(self.KDF_instance)
+        peer = Peer(self.MAC_instance, self.KDF_instance, prefetcher)
+        peer.handshake()
+        prefetcher.idle()
+        updated = [entry[2] for entry in prefetcher.ready.values()]
+
+        # Dropped after the 2nd message: the committed state moved on, so the
+        # keys prefetched for the peer are dropped and zeroed
+        self.assertEqual(peer.handshake(messages=1), [])
+        self.assertEqual(peer.commits, 3)
+        self.assertEqual((prefetcher.ready, prefetcher.peers), ({}, {}))
+        for key in updated:
+            self.assertEqual(key, bytearray(len(key)))
+
+        # The Initiator did not get the 2nd message, it is one epoch behind
+        events = peer.handshake()
+        self.assertEqual([type(event) for event in events], [HandshakeCompleted, HandshakeCompleted])
+        self.assertEqual(events[0].gap, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+# *****************************************************************************
+# *                                                                           *
+# *                               Server Tests                                *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Handshakes against a ResponderServer on loopback: concurrent handshakes  *
+# *  of the same peer must be serialised by its lock, a client that stalls    *
+# *  must release the peer on timeout, and an unknown peer is told so with    *
+# *  MESSAGE_ABORT.                                                           *
+# *                                                                           *
+# *****************************************************************************
+
+import asyncio
+import os
+import unittest
+from sake_am import *
+from sake_server import *
+from sake_wire import *
+
+class RecordingServer(ResponderServer):
+    # Records every step of the Responders and yields to the event loop around
+    # it, so that handshakes in flight interleave as much as they can
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.steps = []
+
+    async def run_step(self, responder, step, *args):
+        await asyncio.sleep(0.005)
+        self.steps.append(step)
+        result = await super().run_step(responder, step, *args)
+        await asyncio.sleep(0.005)
+        return result
+
+class ServerTests(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.MAC_instance, self.KDF_instance = suite_instances("sha256")
+        self.K, self.K_prime = os.urandom(32), os.urandom(32)
+
+    async def start(self, **options):
+        server = RecordingServer("Responder", 16, self.MAC_instance, self.KDF_instance, **options)
+        server.provision("Initiator", self.K, self.K_prime)
+        address = await server.start_tcp()
+        self.addAsyncCleanup(server.close)
+        return server, address
+
+    def initiator(self, id_a="Initiator", K=None, K_prime=None):
+        return Initiator(id_a, "Responder", os.urandom(16), 16, K or self.K, K_prime or self.K_prime, self.MAC_instance, self.KDF_instance)
+
+    async def test_handshakes_of_a_peer_are_serialised(self):
+        count = 5
+        server, address = await self.start(window=count)
+        # Every client holds the provisioning keys: each handshake only completes
+        # if it starts from the state committed by the previous one
+        initiators = [self.initiator() for _ in range(count)]
+        results = await asyncio.wait_for(asyncio.gather(*(initiate(address, initiator) for initiator in initiators)), 10)
+        self.assertEqual(results, [True] * count)
+        self.assertEqual(server.steps, ["receive_1st_message", "receive_3rd_message"] * count)
+        self.assertEqual(len({initiator.session_key for initiator in initiators}), count)
+
+        K, K_prime = self.K, self.K_prime
+        for _ in range(count):
+            K, K_prime = update_key(K, self.KDF_instance), update_key(K_prime, self.KDF_instance)
+        peer = server.peers["Initiator"]
+        self.assertEqual((peer.K, peer.K_prime), (K, K_prime))
+        self.assertEqual(server.completed, count)
+
+    async def test_timeout_releases_the_peer(self):
+        server, address = await self.start(timeout=0.2)
+        stalled = self.initiator()
+        stalled.start_session()
+        reader, writer = await asyncio.open_connection(*address)
+        writer.write(encode_message(MESSAGE_1, stalled.mac_input.id_a, stalled.r_a, stalled.tag_a))
+        await writer.drain()
+        message_type, _ = await read_message(reader, 5.0)
+        self.assertEqual(message_type, MESSAGE_2)
+
+        # Waits for the lock of the peer, held by the stalled handshake until
+        # the 3rd message times out. The Responder committed the 1st message,
+        # so this Initiator is one epoch behind.
+        initiator = self.initiator()
+        self.assertTrue(await asyncio.wait_for(initiate(address, initiator), 5.0))
+        self.assertEqual(server.timeouts, 1)
+        self.assertFalse(server.peers["Initiator"].lock.locked())
+        self.assertEqual(await reader.read(), b"")
+        writer.close()
+        await writer.wait_closed()
+
+    async def test_unknown_peer_is_aborted(self):
+        server, address = await self.start()
+        initiator = self.initiator("Ghost")
+        initiator.start_session()
+        reader, writer = await asyncio.open_connection(*address)
+        writer.write(encode_message(MESSAGE_1, initiator.mac_input.id_a, initiator.r_a, initiator.tag_a))
+        await writer.drain()
+        message_type, fields = await read_message(reader, 5.0)
+        self.assertEqual((message_type, bytes(fields[0])), (MESSAGE_ABORT, b"ERROR: Unknown peer"))
+        writer.close()
+        await writer.wait_closed()
+
+        initiator = self.initiator("Ghost")
+        self.assertFalse(await initiate(address, initiator))
+        self.assertEqual(initiator.ERROR, "ERROR: Unknown peer")
+        self.assertEqual(server.aborted, 2)
+        self.assertEqual(server.steps, [])
+
+if __name__ == "__main__":
+    unittest.main()
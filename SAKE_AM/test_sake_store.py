@@ -0,0 +1,114 @@
+# *****************************************************************************
+# *                                                                           *
+# *                              Key Store Tests                              *
+# *                                                                           *
+# *  Description:                                                             *
+# *  A copy torn by a crash or corrupted must leave the other copy in use,    *
+# *  commits must hold the lock of the record, and the lock must exclude the  *
+# *  other threads of the process as well as other processes.                 *
+# *                                                                           *
+# *****************************************************************************
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from sake_am import *
+from sake_sansio import *
+from sake_store import *
+
+def keys(count, length=32):
+    return [os.urandom(length) for _ in range(count)]
+
+class StoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = KeyStore.create(os.path.join(self.directory.name, "keys.db"), capacity=16, key_length=32, window=1)
+        self.K, self.K_prime = keys(2)
+        self.slot = self.store.provision("Initiator", self.K, self.K_prime)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def commit_new_keys(self):
+        K, K_prime = keys(2)
+        with self.store.locked("Initiator"):
+            self.store.commit("Initiator", K, K_prime, [self.K_prime], 1)
+        copy, record = self.store.current_copy(self.slot)
+        return copy, K, K_prime
+
+    def test_torn_copy_falls_back(self):
+        copy, K, K_prime = self.commit_new_keys()
+        # A crash in the next commit writes only half of the other copy
+        with self.store.locked("Initiator"):
+            self.store.commit("Initiator", *keys(2))
+        offset = self.store.copy_offset(self.slot, 1 - copy)
+        half = self.store.copy_size // 2
+        self.store.map[offset + half:offset + self.store.copy_size] = bytes(self.store.copy_size - half)
+        record = self.store.load("Initiator")
+        self.assertEqual((record.K, record.K_prime, record.K_prime_past, record.last_gap), (K, K_prime, [self.K_prime], 1))
+
+    def test_corrupted_copy_falls_back(self):
+        copy, K, K_prime = self.commit_new_keys()
+        with self.store.locked("Initiator"):
+            self.store.commit("Initiator", *keys(2))
+        # A single flipped bit in the newest copy
+        offset = self.store.copy_offset(self.slot, 1 - copy) + 20
+        self.store.map[offset] ^= 1
+        record = self.store.load("Initiator")
+        self.assertEqual((record.K, record.K_prime), (K, K_prime))
+
+    def test_commit_requires_lock(self):
+        with self.assertRaises(StoreError):
+            self.store.commit("Initiator", *keys(2))
+        with self.store.locked("Initiator"):
+            errors = []
+            thread = threading.Thread(target=lambda: errors.append(self.assertRaises(StoreError, self.store.commit, "Initiator", *keys(2))))
+            thread.start()
+            thread.join()
+        self.assertEqual(self.store.load("Initiator").K, self.K)
+
+    def test_lock_excludes_threads(self):
+        entered = []
+        def handshake():
+            with self.store.locked("Initiator"):
+                entered.append(time.monotonic())
+        with self.store.locked("Initiator"):
+            thread = threading.Thread(target=handshake)
+            thread.start()
+            time.sleep(0.05)
+            self.assertEqual(entered, [])
+            released = time.monotonic()
+        thread.join()
+        self.assertGreaterEqual(entered[0], released)
+
+    def test_responder_connection_releases(self):
+        MAC_instance, KDF_instance = suite_instances("sha256")
+
+        def load(id_a):
+            self.store.acquire(id_a)
+            try:
+                return self.store.load_responder(id_a, "Responder", os.urandom(16), 16, MAC_instance, KDF_instance)
+            except Exception:
+                self.store.release(id_a)
+                raise
+
+        # Completed, then dropped after the 1st message
+        for messages in (2, 1):
+            record = self.store.load("Initiator")
+            initiator = Initiator("Initiator", "Responder", os.urandom(16), 16, record.K, record.K_prime, MAC_instance, KDF_instance)
+            initiator_connection = InitiatorConnection(initiator)
+            connection = ResponderConnection(load, self.store.commit_responder, self.store.release)
+            initiator_connection.start()
+            for _ in range(messages):
+                connection.receive_data(initiator_connection.data_to_send())
+                initiator_connection.receive_data(connection.data_to_send())
+            connection.close()
+            self.assertEqual(self.store.holders, {})
+            self.assertEqual(initiator_connection.closed, messages == 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+# *****************************************************************************
+# *                                                                           *
+# *                             Wire Format Tests                             *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Every message type must survive an encode/decode round trip, whole or    *
+# *  fed in pieces, and malformed frames must raise WireError.                *
+# *                                                                           *
+# *****************************************************************************
+
+import asyncio
+import os
+import struct
+import unittest
+from sake_wire import *
+
+def sample_fields(message_type):
+    values = {U16: 3, BYTES16: os.urandom(300), BYTES8: os.urandom(32)}
+    return [values[kind] for kind in SCHEMAS[message_type]]
+
+def plain(fields):
+    return [field if isinstance(field, int) else bytes(field) for field in fields]
+
+class WireTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        for message_type in SCHEMAS:
+            with self.subTest(message_type=message_type):
+                fields = sample_fields(message_type)
+                frame = encode_message(message_type, *fields)
+                decoded_type, decoded = decode_message(frame)
+                self.assertEqual(decoded_type, message_type)
+                self.assertEqual(plain(decoded), fields)
+
+    def test_empty_fields(self):
+        decoded_type, decoded = decode_message(encode_message(MESSAGE_1, b"", b"", b""))
+        self.assertEqual((decoded_type, plain(decoded)), (MESSAGE_1, [b"", b"", b""]))
+
+    def test_split_frames(self):
+        messages = [(message_type, sample_fields(message_type)) for message_type in SCHEMAS]
+        stream = b"".join(encode_message(message_type, *fields) for message_type, fields in messages)
+        for piece in (1, 3, 7, 64, len(stream)):
+            with self.subTest(piece=piece):
+                decoder = FrameDecoder()
+                decoded = []
+                for start in range(0, len(stream), piece):
+                    decoded += decoder.feed(stream[start:start + piece])
+                self.assertEqual([(message_type, plain(fields)) for message_type, fields in decoded], messages)
+                self.assertEqual(decoder.buffer, bytearray())
+
+    def test_incomplete_frame_waits(self):
+        frame = encode_message(MESSAGE_3, os.urandom(32))
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(frame[:-1]), [])
+        self.assertEqual(len(decoder.feed(frame[-1:])), 1)
+
+    def test_truncated_fields(self):
+        frame = encode_message(MESSAGE_1, b"Initiator", os.urandom(16), os.urandom(32))
+        payload = bytes(frame[LENGTH.size:])
+        for end in range(2, len(payload)):
+            with self.subTest(end=end):
+                with self.assertRaisesRegex(WireError, "Truncated field"):
+                    decode_payload(payload[:end])
+        with self.assertRaisesRegex(WireError, "Truncated header"):
+            decode_payload(payload[:1])
+        with self.assertRaisesRegex(WireError, "Trailing bytes"):
+            decode_payload(payload + b"\0")
+        with self.assertRaisesRegex(WireError, "Frame length mismatch"):
+            decode_message(frame[:-1])
+        with self.assertRaisesRegex(WireError, "Truncated length"):
+            decode_message(frame[:3])
+
+    def test_unknown_type(self):
+        frame = encode_message(MESSAGE_3, os.urandom(32))
+        frame[5] = 0x42
+        with self.assertRaisesRegex(WireError, "Unknown message type 66"):
+            decode_message(frame)
+        with self.assertRaisesRegex(WireError, "Unknown message type"):
+            FrameDecoder().feed(frame)
+        with self.assertRaises(KeyError):
+            encode_message(0x42, b"")
+
+    def test_wrong_version(self):
+        frame = encode_message(MESSAGE_3, os.urandom(32))
+        frame[4] = VERSION + 1
+        with self.assertRaisesRegex(WireError, f"Unsupported version {VERSION + 1}"):
+            decode_message(frame)
+        with self.assertRaisesRegex(WireError, "Unsupported version"):
+            FrameDecoder().feed(frame)
+
+    def test_oversize_length(self):
+        # Refused from the length alone, before the payload arrives
+        header = struct.pack(">I", MAX_PAYLOAD + 1)
+        with self.assertRaisesRegex(WireError, "Frame too long"):
+            FrameDecoder().feed(header)
+        with self.assertRaisesRegex(WireError, "Frame too long"):
+            FrameDecoder(max_payload=16).feed(encode_message(MESSAGE_3, os.urandom(32)))
+
+        async def read():
+            reader = asyncio.StreamReader()
+            reader.feed_data(header)
+            return await read_message(reader, 1.0)
+        with self.assertRaisesRegex(WireError, "Frame too long"):
+            asyncio.run(read())
+
+    def test_encode_errors(self):
+        with self.assertRaisesRegex(WireError, "has 1 fields"):
+            encode_message(MESSAGE_3)
+        with self.assertRaisesRegex(WireError, "Field too long"):
+            encode_message(MESSAGE_3, bytes(256))
+
+if __name__ == "__main__":
+    unittest.main()
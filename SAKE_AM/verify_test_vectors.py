@@ -0,0 +1,185 @@
+# *****************************************************************************
+# *                                                                           *
+# *                 Incremental Test Vector Verification for SAKE AM          *
+# *                                                                           *
+# *  Description:                                                             *
+# *  Command line verifier for many test-vector files (paths or globs). Every *
+# *  record is identified by the digest of its content, and the result of     *
+# *  its verification is kept in an SQLite index along with the version of    *
+# *  the implementation: a hash of the modules that verify it. A record       *
+# *  already verified by the same version is skipped, so a run only verifies *
+# *  the records added or changed since the last one and reports only their  *
+# *  failures. Any change to those modules changes the version and drops the  *
+# *  results of the previous one.                                             *
+# *                                                                           *
+# *  Index:                                                                   *
+# *     records(digest, version, passed)   one row per verified record        *
+# *                                                                           *
+# *****************************************************************************
+
+import argparse
+import glob
+import hashlib
+import os
+import sqlite3
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from read_test_vector import init_worker, verify_lines
+
+# Modules whose code decides the result of a verification: records are run by
+# the Initiator and Responder of sake_am.py through read_test_vector.verify_lines
+IMPLEMENTATION_FILES = ("sake_am.py", "read_test_vector.py")
+
+DEFAULT_CACHE = ".sake_vectors.sqlite"
+QUERY_SIZE = 500                        # Digests per lookup, below the SQLite limit of parameters
+
+def implementation_version():
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in IMPLEMENTATION_FILES:
+        with open(os.path.join(directory, name), "rb") as file:
+            digest.update(name.encode() + b"\0" + file.read())
+    return digest.digest()
+
+def record_digest(line):
+    # Whitespace around the record does not change its digest
+    return hashlib.blake2b(line.strip().encode(), digest_size=16).digest()
+
+class VerificationCache:
+
+    def __init__(self, path, version):
+        self.version = version
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS records (digest BLOB NOT NULL, version BLOB NOT NULL, passed INTEGER NOT NULL, PRIMARY KEY (digest, version)) WITHOUT ROWID")
+        # Results of other versions of the implementation are no longer valid
+        self.connection.execute("DELETE FROM records WHERE version != ?", (version,))
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute("DELETE FROM records")
+        self.connection.commit()
+
+    def lookup(self, digests):
+        # {digest: passed} of the digests already verified by this version
+        known = {}
+        for start in range(0, len(digests), QUERY_SIZE):
+            part = digests[start:start + QUERY_SIZE]
+            query = f"SELECT digest, passed FROM records WHERE version = ? AND digest IN ({', '.join('?' * len(part))})"
+            for digest, passed in self.connection.execute(query, [self.version] + part):
+                known[digest] = bool(passed)
+        return known
+
+    def store(self, results):
+        # 'results' are (digest, passed) pairs
+        self.connection.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?)", [(digest, self.version, int(passed)) for digest, passed in results])
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+class FileReport:
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = 0
+        self.cached = 0
+        self.verified = 0
+        self.known_failures = 0
+        self.new_failures = []          # Line numbers of the failures found in this run
+
+def iter_pending(filename, cache, report, chunk_size):
+    # Yields (line numbers, lines, digests) of the records of 'filename' not yet
+    # verified, 'chunk_size' records at a time
+    with open(filename, "r") as file:
+        chunk = []
+        for line_number, line in enumerate(file, 1):
+            if line.strip():
+                chunk.append((line_number, line))
+            if len(chunk) == chunk_size:
+                yield from filter_chunk(chunk, cache, report)
+                chunk = []
+        if chunk:
+            yield from filter_chunk(chunk, cache, report)
+
+def filter_chunk(chunk, cache, report):
+    digests = [record_digest(line) for _, line in chunk]
+    known = cache.lookup(list(set(digests)))
+    report.records += len(chunk)
+    pending = ([], [], [])
+    for (line_number, line), digest in zip(chunk, digests):
+        passed = known.get(digest)
+        if passed is None:
+            pending[0].append(line_number)
+            pending[1].append(line)
+            pending[2].append(digest)
+            continue
+        report.cached += 1
+        if not passed:
+            report.known_failures += 1
+    if pending[0]:
+        yield pending
+
+def verify_file(filename, cache, executor, chunk_size, max_pending):
+    report = FileReport(filename)
+
+    def collect(line_numbers, digests, future):
+        results = future.result()
+        report.verified += len(results)
+        report.new_failures.extend(line_number for line_number, passed in zip(line_numbers, results) if not passed)
+        cache.store(zip(digests, results))
+
+    pending = deque()
+    for line_numbers, lines, digests in iter_pending(filename, cache, report, chunk_size):
+        # Without the batch cross-check: the result only depends on IMPLEMENTATION_FILES
+        pending.append((line_numbers, digests, executor.submit(verify_lines, lines, False)))
+        if len(pending) >= max_pending:
+            collect(*pending.popleft())
+    while pending:
+        collect(*pending.popleft())
+    cache.commit()
+    report.new_failures.sort()
+    return report
+
+def expand_paths(patterns):
+    # Files matching the paths or globs, in order and without repetitions
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for filename in matches:
+            if filename not in filenames:
+                filenames.append(filename)
+    return filenames
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Verify test-vector files, skipping the records already verified by this version of the implementation")
+    parser.add_argument("paths", nargs="+", help="Files or glob patterns")
+    parser.add_argument("--cache", default=DEFAULT_CACHE, help="SQLite index of verified records")
+    parser.add_argument("--clear", action="store_true", help="Forget every cached result before verifying")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    filenames = expand_paths(args.paths)
+    for filename in filenames:
+        if not os.path.isfile(filename):
+            print(f"ERROR: File {filename} does not exist")
+            exit(1)
+
+    cache = VerificationCache(args.cache, implementation_version())
+    if args.clear:
+        cache.clear()
+
+    failures = 0
+    with ProcessPoolExecutor(args.workers, initializer=init_worker) as executor:
+        for filename in filenames:
+            report = verify_file(filename, cache, executor, args.chunk_size, 2 * args.workers)
+            failures += report.known_failures + len(report.new_failures)
+            print(f"{filename} Records: {report.records} || Cached: {report.cached} || Verified: {report.verified} || New failures: {len(report.new_failures)} || Known failures: {report.known_failures}")
+            if report.new_failures:
+                print("Failed lines: " + ", ".join(str(line_number) for line_number in report.new_failures))
+    cache.close()
+
+    sys.exit(1 if failures else 0)